@@ -1,20 +1,27 @@
 # app.py — عربي سايكو: ذكاء اصطناعي + DSM5 استرشادي + CBT موسّع + اختبارات بأزرار أرقام/نعم-لا + شخصية + تحويل طبي
 # Python 3.10+ | python-telegram-bot v21.6
 
-import os, re, asyncio, json, logging
+import os, re, sys, csv, math, time, heapq, calendar, random, asyncio, contextvars, json, hashlib, hmac, sqlite3, threading, zlib, logging
+import dataclasses
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
-import requests
+import httpx
+np = None   # numpy اختياري (للتصحيح الجماعي المتجّه) — يُحمَّل عند أول استعمال عبر load_numpy()
 from telegram import (
     Update, ReplyKeyboardMarkup, ReplyKeyboardRemove,
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    ConversationHandler, ContextTypes, TypeHandler, BasePersistence, PersistenceInput,
+    BaseUpdateProcessor, BaseRateLimiter, BaseHandler, filters
 )
+from telegram.request import BaseRequest, HTTPXRequest
 
 # ========== إعداد عام ==========
 logging.basicConfig(level=logging.INFO)
@@ -22,19 +29,91 @@ log = logging.getLogger("arabi-psycho")
 
 VERSION = "2025-08-27.2"
 
-BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("يرجى ضبط TELEGRAM_BOT_TOKEN")
+BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN") or ""   # يُتحقق منه في main() لا عند الاستيراد
+TG_API_URL = (os.getenv("TG_API_URL") or "").rstrip("/")   # خادم Bot API محلي اختياري (مثال http://localhost:8081)
 
 # ذكاء اصطناعي
 AI_BASE_URL = (os.getenv("AI_BASE_URL") or "").strip()
 AI_API_KEY  = (os.getenv("AI_API_KEY") or "").strip()
 AI_MODEL    = (os.getenv("AI_MODEL") or "gpt-4o-mini").strip()
 
+# مجمّع اتصالات AI (keep-alive + HTTP/2 إن توفّر)
+AI_POOL_MAX        = int(os.getenv("AI_POOL_MAX", "32"))
+AI_POOL_KEEPALIVE  = int(os.getenv("AI_POOL_KEEPALIVE", "16"))
+AI_KEEPALIVE_SEC   = float(os.getenv("AI_KEEPALIVE_SEC", "60"))
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+AI_READ_TIMEOUT    = float(os.getenv("AI_READ_TIMEOUT", "45"))
+AI_HTTP2           = os.getenv("AI_HTTP2", "1") != "0"
+
+# بثّ الرد تدريجيًا (SSE) مع تعديل رسالة تيليجرام واحدة
+AI_STREAM          = os.getenv("AI_STREAM", "1") != "0"
+AI_STREAM_EDIT_SEC = float(os.getenv("AI_STREAM_EDIT_SEC", "1.2"))   # أقل فاصل بين تعديلين
+AI_STREAM_SPLIT    = int(os.getenv("AI_STREAM_SPLIT", "3900"))       # الانتقال لرسالة جديدة قبل حد 4096
+
 # روابط تحويل طبي (اختياري)
 CONTACT_THERAPIST_URL    = os.getenv("CONTACT_THERAPIST_URL", "")
 CONTACT_PSYCHIATRIST_URL = os.getenv("CONTACT_PSYCHIATRIST_URL", "")
 
+# تخزين دائم (SQLite) — PERSIST=0 لتعطيله
+DB_PATH           = os.getenv("DB_PATH", "arabi_psycho.db")
+PERSIST           = os.getenv("PERSIST", "1") != "0"
+PERSIST_FLUSH_SEC = float(os.getenv("PERSIST_FLUSH_SEC", "2"))
+
+# سجل الدرجات عبر الزمن (/history): نفس ملف DB_PATH افتراضيًا، وفي الذاكرة إن PERSIST=0
+HISTORY_DB        = os.getenv("HISTORY_DB", "")
+HISTORY_FLUSH_SEC = float(os.getenv("HISTORY_FLUSH_SEC", "1"))
+HISTORY_SHOW      = int(os.getenv("HISTORY_SHOW", "8"))      # آخر كم قياس يُرسم في الاتجاه
+
+# تذكيرات المتابعة (تعرّض، تنشيط سلوكي، إعادة PHQ-9/GAD-7): نفس ملف DB_PATH افتراضيًا
+REMINDERS          = os.getenv("REMINDERS", "1") != "0"
+REMIND_DB          = os.getenv("REMIND_DB", "")
+REMIND_EXPO_SEC    = float(os.getenv("REMIND_EXPO_SEC", "14400"))    # جلسة التعرض التالية (3–4 مرات يوميًا)
+REMIND_BA_SEC      = float(os.getenv("REMIND_BA_SEC", "21600"))      # متابعة خطة التنشيط السلوكي
+REMIND_RETEST_DAYS = float(os.getenv("REMIND_RETEST_DAYS", "14"))    # إعادة PHQ-9/GAD-7
+REMIND_QUIET       = os.getenv("REMIND_QUIET", "23-8")               # ساعات هدوء (بتوقيت REMIND_UTC_OFFSET)
+REMIND_UTC_OFFSET  = float(os.getenv("REMIND_UTC_OFFSET", "3"))
+REMIND_BATCH       = int(os.getenv("REMIND_BATCH", "200"))           # تذكيرات كل دفعة إرسال
+REMIND_HORIZON     = float(os.getenv("REMIND_HORIZON", "3600"))      # نافذة الفهرس المحمّلة في الذاكرة
+REMIND_STALE_SEC   = float(os.getenv("REMIND_STALE_SEC", "43200"))   # بعد توقف طويل: الأقدم من هذا يُسقط
+REMIND_RETRY_SEC   = float(os.getenv("REMIND_RETRY_SEC", "60"))      # تأخير أول إعادة بعد فشل إرسال (يتضاعف)
+REMIND_RETRIES     = int(os.getenv("REMIND_RETRIES", "5"))
+
+# تصدير مُجهَّل الهوية للشركاء السريريين (/export للمشرفين، أو: python app.py export ...)
+ADMIN_IDS         = {int(x) for x in re.findall(r"-?\d+", os.getenv("ADMIN_IDS", ""))}
+EXPORT_KEY        = os.getenv("EXPORT_KEY", "")     # مفتاح HMAC للمعرّفات المستعارة (إلزامي للتصدير)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000000"))   # صفوف كل ملف
+EXPORT_CHUNK_MB   = float(os.getenv("EXPORT_CHUNK_MB", "45"))   # سقف حجم الملف في /export (send_document ≤ 50MB)
+
+# بث إداري لكل المستخدمين (/broadcast للمشرفين): يُستأنف من آخر نقطة حفظ بعد الانهيار أو النشر
+BROADCAST_DB         = os.getenv("BROADCAST_DB", "")
+BROADCAST_RPS        = float(os.getenv("BROADCAST_RPS", "0"))       # 0 = 80% من TG_GLOBAL_RPS (الباقي للمحادثات)
+BROADCAST_BATCH      = int(os.getenv("BROADCAST_BATCH", "100"))     # مستلمون لكل قراءة ونقطة حفظ
+BROADCAST_REPORT_SEC = float(os.getenv("BROADCAST_REPORT_SEC", "15"))
+BROADCAST_LEASE_SEC  = float(os.getenv("BROADCAST_LEASE_SEC", "60"))  # مهلة استلام بث عامل متوقف
+BROADCAST_RETRIES    = int(os.getenv("BROADCAST_RETRIES", "5"))      # محاولات لفشل عابر قبل عدّه فشلًا
+
+# مخزن مشترك لعدة عُقد (اختياري): redis://host:6379/0
+REDIS_URL = os.getenv("REDIS_URL", "")
+
+# دورة حياة الجلسات: مهلة خمول لكل حالة + سقف للمستخدمين المقيمين في الذاكرة (الأبرد يُنقل للتخزين)
+SESSION_TTL       = os.getenv("SESSION_TTL", "*=86400,ai_chat=7200")  # ثوانٍ لكل حالة؛ بعدها يُغلق التمرين/الاختبار المفتوح
+SESSION_IDLE_SEC  = float(os.getenv("SESSION_IDLE_SEC", "3600"))     # خمول يُخرج المستخدم من الذاكرة
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "50000"))
+SESSION_SWEEP_SEC = float(os.getenv("SESSION_SWEEP_SEC", "30"))
+
+# مقاييس Prometheus: /metrics على منفذ الويبهوك نفسه، أو منفذ جانبي في وضع polling
+METRICS_ON    = os.getenv("METRICS", "1") != "0"
+METRICS_PORT  = int(os.getenv("METRICS_PORT", "9090"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")   # إن ضُبط: Authorization: Bearer <token>
+
+# حدود الإرسال إلى تيليجرام (~30 رسالة/ث عمومًا، ~1/ث لكل محادثة، 20/د للمجموعات) — TG_RATE_LIMIT=0 لتعطيلها
+TG_RATE_LIMIT  = os.getenv("TG_RATE_LIMIT", "1") != "0"
+TG_GLOBAL_RPS  = float(os.getenv("TG_GLOBAL_RPS", "30"))
+TG_CHAT_RPS    = float(os.getenv("TG_CHAT_RPS", "1"))
+TG_CHAT_BURST  = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_GROUP_RPM   = float(os.getenv("TG_GROUP_RPM", "20"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))    # محاولات بعد RetryAfter قبل رفع الخطأ
+
 # Webhook أو Polling
 PUBLIC_URL = os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL") or os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", "10000"))
@@ -44,6 +123,17 @@ AR_DIGITS = "٠١٢٣٤٥٦٧٨٩"
 EN_DIGITS = "0123456789"
 TRANS = str.maketrans(AR_DIGITS, EN_DIGITS)
 
+def load_numpy():
+    # استيراد numpy مؤجّل (~50-70ms) — لا يحتاجه مسار المحادثة
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np
+
 def normalize_num(s: str) -> str:
     return (s or "").strip().translate(TRANS)
 
@@ -53,38 +143,111 @@ def to_int(s: str) -> Optional[int]:
     except Exception:
         return None
 
-def has(substr: str, txt: str) -> bool:
-    return substr in (txt or "")
+# توحيد الكتابة العربية: حذف التشكيل والتطويل، توحيد الألف/الهمزات/التاء المربوطة/الألف المقصورة
+AR_NORM = str.maketrans({
+    **{c: None for c in "\u064b\u064c\u064d\u064e\u064f\u0650\u0651\u0652\u0670\u0640"},
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي",
+    **dict(zip(AR_DIGITS, EN_DIGITS)),
+})
+PUNCT_RE = re.compile(r"[^\w\s]+|([^\W\d_])\1{2,}")   # الرموز ← مسافة، والمدّ بتكرار الحرف (اموووت) ← حرف واحد
+
+def normalize_ar(s: str) -> str:
+    s = PUNCT_RE.sub(lambda m: m.group(1) or " ", (s or "").translate(AR_NORM).lower())
+    return " ".join(s.split())
+
+MSG_CHUNK = 3500
+
+def cut_at(text: str, limit: int) -> int:
+    # آخر سطر قبل الحد، وإلا آخر مسافة (ما لم يقصر الجزء عن النصف)، وإلا قطع صريح
+    for sep in ("\n", " "):
+        cut = text.rfind(sep, 0, limit)
+        if cut >= limit // 2:
+            return cut
+    return limit
+
+def split_message(text: str, limit: int = MSG_CHUNK) -> Tuple[str, ...]:
+    out = []
+    while len(text) > limit:
+        cut = cut_at(text, limit)
+        out.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        out.append(text)
+    return tuple(out)
 
 async def send_long(chat, text: str, kb=None):
-    chunk = 3500
-    for i in range(0, len(text), chunk):
-        await chat.send_message(text[i:i+chunk], reply_markup=kb if i+chunk>=len(text) else None)
+    chunks = PRE_SPLIT.get(text) or split_message(text)   # النصوص الثابتة مُقسّمة مسبقًا
+    for n, part in enumerate(chunks, 1):
+        await chat.send_message(part, reply_markup=kb if n == len(chunks) else None)
 
 # ========== أزرار القوائم ==========
-TOP_KB = ReplyKeyboardMarkup(
-    [
-        ["عربي سايكو 🧠"],
-        ["العلاج السلوكي المعرفي (CBT) 💊", "الاختبارات النفسية 📝"],
-        ["اختبارات الشخصية 🧩", "اضطرابات الشخصية 📚"],
-        ["الأخصائي النفسي 👨‍⚕️", "التحويل الطبي 🧑‍⚕️"]
-    ],
-    resize_keyboard=True
-)
+# مصدر واحد لكل قائمة: (نص الزر، رمز المسار) — منه تُبنى اللوحة وفهرس التوجيه معًا
+TOP_ROWS = [
+    [("عربي سايكو 🧠", "ai")],
+    [("العلاج السلوكي المعرفي (CBT) 💊", "cbt"), ("الاختبارات النفسية 📝", "tests")],
+    [("اختبارات الشخصية 🧩", "pers"), ("اضطرابات الشخصية 📚", "pd")],
+    [("الأخصائي النفسي 👨‍⚕️", "therapist"), ("التحويل الطبي 🧑‍⚕️", "referral")],
+]
 
-CBT_KB = ReplyKeyboardMarkup(
-    [
-        ["خطة CBT شاملة (مقترحة)"],
-        ["ما هو CBT؟", "أخطاء التفكير"],
-        ["طرق علاج القلق", "طرق علاج الاكتئاب"],
-        ["إدارة الغضب", "التخلّص من الخوف"],
-        ["سجلّ الأفكار (تمرين)", "التعرّض التدريجي (قلق/هلع)"],
-        ["التنشيط السلوكي (تحسين المزاج)", "الاسترخاء والتنفس"],
-        ["اليقظة الذهنية (Mindfulness)", "حل المشكلات"],
-        ["بروتوكول النوم", "◀️ رجوع"]
-    ],
-    resize_keyboard=True
-)
+CBT_ROWS = [
+    [("خطة CBT شاملة (مقترحة)", "plan")],
+    [("ما هو CBT؟", "about"), ("أخطاء التفكير", "dist")],
+    [("طرق علاج القلق", "anx"), ("طرق علاج الاكتئاب", "dep")],
+    [("إدارة الغضب", "anger"), ("التخلّص من الخوف", "fear")],
+    [("سجلّ الأفكار (تمرين)", "tr"), ("التعرّض التدريجي (قلق/هلع)", "expo")],
+    [("التنشيط السلوكي (تحسين المزاج)", "ba"), ("الاسترخاء والتنفس", "relax")],
+    [("اليقظة الذهنية (Mindfulness)", "mind"), ("حل المشكلات", "prob")],
+    [("بروتوكول النوم", "sleep"), ("◀️ رجوع", "back")],
+]
+
+def menu_kb(rows) -> ReplyKeyboardMarkup:
+    return ReplyKeyboardMarkup([[label for label, _ in row] for row in rows], resize_keyboard=True)
+
+TOP_KB = menu_kb(TOP_ROWS)
+CBT_KB = menu_kb(CBT_ROWS)
+
+class MenuIndex:
+    # الزر المضغوط ← dict حرفي؛ النص المكتوب يدويًا ← شجرة بادئات على النص الموحّد.
+    # كلفة البحث بطول النص فقط، لا بعدد الأزرار
+    MIN_PREFIX = 4   # أقل طول لبادئة ناقصة (مثل «التنشيط») حتى تُقبل
+
+    def __init__(self, items):
+        self.exact: Dict[str, str] = {}
+        self.root: list = [{}, None, None]   # [أبناء، مسار ينتهي هنا، المسار الوحيد تحت هذه العقدة أو ""]
+        for label, route in items:
+            self.exact[label] = route
+            node = self.root
+            for ch in normalize_ar(label):
+                nxt = node[0].get(ch)
+                if nxt is None:
+                    nxt = node[0][ch] = [{}, None, route]
+                elif nxt[2] != route:
+                    nxt[2] = ""
+                node = nxt
+            node[1] = route
+
+    @classmethod
+    def of(cls, rows):
+        return cls(item for row in rows for item in row)
+
+    def lookup(self, text: str) -> Optional[str]:
+        route = self.exact.get(text)
+        if route:
+            return route
+        key = normalize_ar(text)
+        node, best = self.root, None
+        for ch in key:
+            node = node[0].get(ch)
+            if node is None:
+                return best          # أطول زر كامل يبدأ به النص
+            if node[1]:
+                best = node[1]
+        if node[1] is None and len(key) >= self.MIN_PREFIX:
+            return node[2] or best   # بادئة ناقصة لا تحتمل إلا زرًا واحدًا
+        return best
+
+TOP_INDEX = MenuIndex.of(TOP_ROWS)
+CBT_INDEX = MenuIndex.of(CBT_ROWS)
 
 AI_CHAT_KB = ReplyKeyboardMarkup([["◀️ إنهاء جلسة عربي سايكو"]], resize_keyboard=True)
 
@@ -93,12 +256,89 @@ MENU, CBT_MENU, TESTS_MENU, PERS_MENU, AI_CHAT = range(5)
 TH_SITU, TH_EMO, TH_AUTO, TH_FOR, TH_AGAINST, TH_ALT, TH_RERATE = range(10,17)
 EXPO_WAIT, EXPO_FLOW = range(20,22)
 PANIC_Q, PTSD_Q, SURVEY = range(30,33)
+STATE_NAMES = dict(zip(
+    (MENU, CBT_MENU, TESTS_MENU, PERS_MENU, AI_CHAT, TH_SITU, TH_EMO, TH_AUTO, TH_FOR, TH_AGAINST, TH_ALT,
+     TH_RERATE, EXPO_WAIT, EXPO_FLOW, PANIC_Q, PTSD_Q, SURVEY),
+    "menu cbt_menu tests_menu pers_menu ai_chat th_situ th_emo th_auto th_for th_against th_alt "
+    "th_rerate expo_wait expo_flow panic_q ptsd_q survey".split()))
 
 # ========== أمان ==========
-CRISIS_WORDS = ["انتحار","سأؤذي نفسي","اذي نفسي","قتل نفسي","ما ابغى اعيش","فقدت الامل","اريد اموت","ابي اموت"]
+CRISIS_WORDS = [
+    "انتحار","انتحر","سأؤذي نفسي","اذي نفسي","اؤذي نفسي","قتل نفسي","اقتل نفسي","انهي حياتي",
+    "ما ابغى اعيش","ما ابي اعيش","مابي اعيش","لا اريد ان اعيش","ما اريد اعيش","فقدت الامل",
+    "اريد اموت","ابي اموت","ابغى اموت","بدي موت","نفسي اموت","الموت احسن","اجرح نفسي","ايذاء النفس",
+    "suicide","kill myself","end my life",
+]
+CRISIS_PATTERNS_FILE = os.getenv("CRISIS_PATTERNS_FILE", "")   # عبارات إضافية، عبارة في كل سطر
+CRISIS_REPLY = ("⚠️ سلامتك أولاً. إن كان لديك خطر فوري على نفسك/غيرك فاتصل بالطوارئ فورًا.\n"
+                "جرّب تنفّس 4-7-8 عشر مرات وابقَ مع شخص تثق به وحدّد موعدًا عاجلاً مع مختص.")
+
+class PhraseMatcher:
+    # Aho–Corasick: آلة واحدة لكل العبارات، مرور واحد على النص مهما زاد عدد العبارات.
+    # الحرف المكرر متتاليًا يُعدّ مرة واحدة في العبارات والنص معًا (امووت = اموت)
+    def __init__(self, phrases):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.out: List[Optional[str]] = [None]
+        for ph in phrases:
+            ph = normalize_ar(ph)
+            if not ph:
+                continue
+            st, prev = 0, ""
+            for ch in ph:
+                if ch == prev:
+                    continue
+                prev = ch
+                nxt = self.goto[st].get(ch)
+                if nxt is None:
+                    nxt = self.goto[st][ch] = len(self.goto)
+                    self.goto.append({}); self.out.append(None)
+                st = nxt
+            self.out[st] = self.out[st] or ph
+        self.fail = [0] * len(self.goto)
+        q = list(self.goto[0].values())
+        for st in q:   # BFS: روابط الفشل ووراثة المخرجات
+            for ch, nxt in self.goto[st].items():
+                f = self.fail[st]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] or self.out[self.fail[nxt]]
+                q.append(nxt)
+        self.size = sum(1 for o in self.out if o)
+
+    def find(self, txt: str) -> Optional[str]:
+        goto, fail, out = self.goto, self.fail, self.out
+        st, prev = 0, ""
+        for ch in normalize_ar(txt):
+            if ch == prev:
+                continue
+            prev = ch
+            while st and ch not in goto[st]:
+                st = fail[st]
+            st = goto[st].get(ch, 0)
+            if out[st]:
+                return out[st]
+        return None
+
+def load_phrases(path: str) -> List[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [ln.strip() for ln in f if ln.strip() and not ln.startswith("#")]
+    except OSError as e:
+        log.warning("crisis patterns %s: %s", path, e)
+        return []
+
+CRISIS = PhraseMatcher(CRISIS_WORDS + (load_phrases(CRISIS_PATTERNS_FILE) if CRISIS_PATTERNS_FILE else []))
+
 def is_crisis(txt: str) -> bool:
-    low = (txt or "").replace("أ","ا").replace("إ","ا").replace("آ","ا").lower()
-    return any(w in low for w in CRISIS_WORDS)
+    return CRISIS.find(txt) is not None
+
+async def crisis_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # يعمل قبل المحادثة (group=-1) على كل نص وفي كل حالة: تمارين CBT والتعرض والتنشيط وغيرها
+    msg = update.effective_message
+    if msg and msg.text and is_crisis(msg.text):
+        context.crisis = True   # يراه ai_chat_flow فلا يكرر الرد
+        await msg.reply_text(CRISIS_REPLY)
 
 # ========== ذكاء اصطناعي ==========
 AI_SYSTEM_GENERAL = (
@@ -113,35 +353,1036 @@ AI_SYSTEM_DSM = (
     "- اقترح محاور تقييم وتمارين CBT مناسبة وتنبيهات أمان عند اللزوم."
 )
 
-def ai_call(user_content: str, history: List[Dict[str,str]], dsm_mode: bool) -> str:
-    if not (AI_BASE_URL and AI_API_KEY and AI_MODEL):
-        return "تعذّر استخدام الذكاء الاصطناعي حاليًا (تأكد من المفاتيح/النموذج)."
-    headers = {"Authorization": f"Bearer {AI_API_KEY}", "Content-Type": "application/json"}
+_ai_client: Optional[httpx.AsyncClient] = None
+_ai_hedge_client: Optional[httpx.AsyncClient] = None
+
+def ai_enabled() -> bool:
+    return bool(AI_BASE_URL and AI_API_KEY and AI_MODEL)
+
+def _new_ai_client(base_url: str, key: str) -> httpx.AsyncClient:
+    http2 = AI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            http2 = False
+    return httpx.AsyncClient(
+        base_url=base_url.rstrip("/"),
+        headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=AI_POOL_MAX,
+            max_keepalive_connections=AI_POOL_KEEPALIVE,
+            keepalive_expiry=AI_KEEPALIVE_SEC,
+        ),
+        timeout=httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT, pool=AI_CONNECT_TIMEOUT),
+    )
+
+def ai_client() -> httpx.AsyncClient:
+    # عميل واحد مشترك لكل المحادثات: التزامن محدود بالمقابس لا بالخيوط
+    global _ai_client
+    if _ai_client is None or _ai_client.is_closed:
+        _ai_client = _new_ai_client(AI_BASE_URL, AI_API_KEY)
+    return _ai_client
+
+def ai_hedge_client() -> httpx.AsyncClient:
+    # مزوّد بديل لطلبات التحوّط (AI_HEDGE_BASE_URL)، وإلا العميل الأساسي نفسه
+    global _ai_hedge_client
+    if not AI_HEDGE_BASE_URL:
+        return ai_client()
+    if _ai_hedge_client is None or _ai_hedge_client.is_closed:
+        _ai_hedge_client = _new_ai_client(AI_HEDGE_BASE_URL, AI_HEDGE_API_KEY)
+    return _ai_hedge_client
+
+async def ai_warmup():
+    # فتح اتصال TCP+TLS مسبقًا حتى لا يدفع أول مستخدم ثمن المصافحة
+    if not ai_enabled():
+        return
+    try:
+        r = await ai_client().head("/")
+        log.info("AI client warm (%s, http=%s)", r.status_code, r.http_version)
+    except Exception as e:
+        log.warning("AI warmup فشل: %s", e)
+
+async def ai_close():
+    global _ai_client, _ai_hedge_client
+    for c in (_ai_client, _ai_hedge_client):
+        if c is not None:
+            await c.aclose()
+    _ai_client = _ai_hedge_client = None
+
+def ai_messages(user_content: str, history: List[Dict[str,str]], dsm_mode: bool) -> List[Dict[str,str]]:
     sys = AI_SYSTEM_DSM if dsm_mode else AI_SYSTEM_GENERAL
+    return [{"role":"system","content":sys}] + history + [{"role":"user","content":user_content}]
+
+def ai_payload(messages: List[Dict[str,str]], stream: bool = False, max_tokens: int = 700, model: str = "") -> dict:
     payload = {
-        "model": AI_MODEL,
-        "messages": [{"role":"system","content":sys}] + history + [{"role":"user","content":user_content}],
+        "model": model or AI_MODEL,
+        "messages": messages,
         "temperature": 0.4,
-        "max_tokens": 700,
+        "max_tokens": max_tokens,
     }
-    try:
-        r = requests.post(f"{AI_BASE_URL.rstrip('/')}/chat/completions", headers=headers, data=json.dumps(payload), timeout=45)
+    if stream:
+        payload["stream"] = True
+    return payload
+
+class AIError(Exception):
+    # رسالة الاستثناء جاهزة للعرض على المستخدم
+    pass
+
+AI_UNAVAILABLE = "تعذّر استخدام الذكاء الاصطناعي حاليًا (تأكد من المفاتيح/النموذج)."
+AI_BUSY = "⏳ خدمة الذكاء الاصطناعي مزدحمة أو متوقفة مؤقتًا. حاول بعد دقيقة، وجرّب تمارين CBT من القائمة إلى ذلك الحين."
+AI_QUEUED = "⏳ أنت في قائمة الانتظار — سيصلك الرد خلال لحظات."
+
+async def _ai_post(messages: List[Dict[str,str]], model: str, max_tokens: int = 700) -> str:
+    r = await leg_client().post("/chat/completions", json=ai_payload(messages, max_tokens=max_tokens, model=model))
+    r.raise_for_status()
+    j = r.json()
+    reply = j["choices"][0]["message"]["content"].strip()
+    ai_usage(model, messages, reply, j.get("usage"))
+    return reply
+
+async def _ai_stream(messages: List[Dict[str,str]], model: str):
+    # يولّد أجزاء النص من SSE (`data: {...}` حتى `data: [DONE]`)
+    payload = ai_payload(messages, stream=True, model=model)
+    parts, usage = [], None
+    async with leg_client().stream("POST", "/chat/completions", json=payload) as r:
         r.raise_for_status()
-        j = r.json()
-        return j["choices"][0]["message"]["content"].strip()
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue  # تعليقات keep-alive مثل ": OPENROUTER PROCESSING"
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+                usage = chunk.get("usage") or usage   # بعض المزوّدين يرسلونها في آخر جزء
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+            except (ValueError, KeyError, IndexError):
+                continue
+            if delta:
+                parts.append(delta)
+                yield delta
+    ai_usage(model, messages, "".join(parts), usage)
+
+# ========== مقاييس (صيغة Prometheus النصية) ==========
+LAT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    # counter/gauge: قيمة لكل مجموعة تسميات؛ histogram: [عدّ كل دلو + ‎+Inf] ومجموع
+    __slots__ = ("name", "help", "kind", "labels", "buckets", "values")
+
+    def __init__(self, name: str, help: str, kind: str, labels: Tuple[str, ...], buckets=None):
+        self.name, self.help, self.kind, self.labels, self.buckets = name, help, kind, labels, buckets
+        self.values: Dict[tuple, object] = {}
+
+    def inc(self, *lv, n: float = 1.0):
+        self.values[lv] = self.values.get(lv, 0.0) + n
+
+    def set(self, v: float, *lv):
+        self.values[lv] = v
+
+    def observe(self, v: float, *lv):
+        h = self.values.get(lv)
+        if h is None:
+            h = self.values[lv] = [[0] * (len(self.buckets) + 1), 0.0]
+        h[0][bisect_left(self.buckets, v)] += 1
+        h[1] += v
+
+    def _lbl(self, lv, extra: str = "") -> str:
+        parts = [f'{k}="{_esc(v)}"' for k, v in zip(self.labels, lv)] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self, out: List[str]):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for lv, v in list(self.values.items()):
+            if self.kind != "histogram":
+                out.append(f"{self.name}{self._lbl(lv)} {v}")
+                continue
+            cum = 0
+            for le, c in zip((*self.buckets, "+Inf"), v[0]):
+                cum += c
+                lbl = self._lbl(lv, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{lbl} {cum}")
+            out.append(f"{self.name}_sum{self._lbl(lv)} {v[1]}")
+            out.append(f"{self.name}_count{self._lbl(lv)} {cum}")
+
+class Metrics:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: list = []   # دوال تُحدّث المقاييس اللحظية عند كل قراءة
+
+    def _add(self, name, help, kind, labels, buckets=None) -> Metric:
+        m = Metric(name, help, kind, labels, buckets)
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name: str, help: str, *labels) -> Metric:
+        return self._add(name, help, "counter", labels)
+
+    def gauge(self, name: str, help: str, *labels) -> Metric:
+        return self._add(name, help, "gauge", labels)
+
+    def histogram(self, name: str, help: str, *labels, buckets=LAT_BUCKETS) -> Metric:
+        return self._add(name, help, "histogram", labels, buckets)
+
+    def render(self) -> str:
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception as e:
+                log.debug("metrics collector: %s", e)
+        out: List[str] = []
+        for m in self.metrics:
+            m.render(out)
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+M_HANDLER     = METRICS.histogram("bot_handler_seconds", "Handler latency by conversation state and handler", "state", "handler")
+M_HANDLER_ERR = METRICS.counter("bot_handler_errors_total", "Handler exceptions", "state", "handler", "error")
+M_SESSIONS    = METRICS.gauge("bot_sessions", "Active conversations per state", "state")
+M_UPD_ACTIVE  = METRICS.gauge("bot_updates_active", "Updates being processed now")
+M_AI          = METRICS.histogram("bot_ai_request_seconds", "AI provider call latency", "model", "outcome")
+M_AI_TOKENS   = METRICS.counter("bot_ai_tokens_total", "AI tokens (provider usage, else estimated)", "model", "kind")
+M_AI_ERR      = METRICS.counter("bot_ai_errors_total", "AI call errors by class", "model", "error")
+M_AI_QUEUE    = METRICS.gauge("bot_ai_scheduler", "AI scheduler inflight/waiting", "kind")
+M_AI_FIRST    = METRICS.histogram("bot_ai_first_answer_seconds", "Time to first streamed text or full reply, by winning leg", "kind", "leg")
+M_AI_HEDGE    = METRICS.counter("bot_ai_hedges_total", "Hedged AI requests: won/lost races, capped = deadline passed but not sent", "kind", "outcome")
+M_TG          = METRICS.histogram("bot_telegram_request_seconds", "Bot API request latency", "method")
+M_TG_RETRY    = METRICS.counter("bot_telegram_retry_after_total", "Bot API 429 (RetryAfter) responses", "method")
+M_TG_QUEUE    = METRICS.gauge("bot_telegram_queue", "Bot API requests waiting in the outbound limiter")
+M_TG_WAIT     = METRICS.histogram("bot_telegram_queue_seconds", "Time a Bot API request waited before it was sent", "method")
+M_RESIDENT    = METRICS.gauge("bot_sessions_resident", "Users whose session is held in memory")
+M_EVICT       = METRICS.counter("bot_session_evictions_total", "Sessions moved out of memory", "reason")
+M_EXPIRED     = METRICS.counter("bot_session_expired_total", "Open flows ended by idle timeout", "state")
+M_BCAST       = METRICS.counter("bot_broadcast_total", "Broadcast sends by outcome (sent/blocked/retry/failed)", "outcome")
+M_REMIND_WIN  = METRICS.gauge("bot_reminders_loaded", "Reminders held in the in-memory due window")
+M_REMIND      = METRICS.counter("bot_reminders_total", "Reminders dispatched by outcome (sent/blocked/retry/failed/stale)", "outcome")
+M_LOCAL       = METRICS.counter("bot_local_answers_total", "Offline BM25 answers by use (fallback/pre) and misses", "kind")
+
+def ai_usage(model: str, messages: List[Dict[str,str]], reply: str, usage: Optional[dict] = None):
+    usage = usage or {}
+    M_AI_TOKENS.inc(model, "prompt", n=usage.get("prompt_tokens") or hist_tokens(messages))
+    M_AI_TOKENS.inc(model, "completion", n=usage.get("completion_tokens") or count_tokens(reply))
+
+def ai_error_class(e: Exception) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return str(e.response.status_code)
+    return type(e).__name__
+
+def instrument(cb, state: str):
+    name = getattr(cb, "__name__", "handler")
+
+    async def timed(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await cb(update, context)
+        except Exception as e:
+            M_HANDLER_ERR.inc(state, name, type(e).__name__)
+            raise
+        finally:
+            M_HANDLER.observe(time.perf_counter() - t0, state, name)
+
+    timed.__name__ = name
+    return timed
+
+def instrument_app(app: Application):
+    # تغليف كل معالج مسجّل (داخل المحادثة بحسب الحالة، وخارجها global) + مقاييس لحظية
+    for handlers in app.handlers.values():
+        for h in handlers:
+            if not isinstance(h, ConversationHandler):
+                h.callback = instrument(h.callback, "global")
+                continue
+            groups = [("entry", h.entry_points), ("fallback", h.fallbacks)]
+            groups += [(STATE_NAMES.get(st, str(st)), hs) for st, hs in h.states.items()]
+            for state, hs in groups:
+                for x in hs:
+                    x.callback = instrument(x.callback, state)
+
+            sm = app.bot_data.get("sessions")
+            if sm is None or sm.conv is not h:
+                continue
+
+            def sessions(sm=sm):
+                counts: Dict[str, int] = dict.fromkeys(STATE_NAMES.values(), 0)
+                for st in list(sm.states.values()):
+                    name = STATE_NAMES.get(st, str(st))
+                    counts[name] = counts.get(name, 0) + 1
+                for name, n in counts.items():
+                    M_SESSIONS.set(n, name)
+            METRICS.collectors.append(sessions)
+
+    def live():
+        M_AI_QUEUE.set(AI_SCHED.inflight, "inflight")
+        M_AI_QUEUE.set(AI_SCHED.waiting, "waiting")
+        if isinstance(app.update_processor, ChatOrderedProcessor):
+            M_UPD_ACTIVE.set(app.update_processor.active)
+        if "sessions" in app.bot_data:
+            M_RESIDENT.set(len(app.bot_data["sessions"].lru))
+        if "reminders" in app.bot_data:
+            M_REMIND_WIN.set(len(app.bot_data["reminders"].due))
+        if isinstance(app.bot.rate_limiter, OutboundLimiter):
+            M_TG_QUEUE.set(app.bot.rate_limiter.waiting)
+    METRICS.collectors.append(live)
+
+class MeteredRequest(BaseRequest):
+    # يغلّف أي ناقل Bot API: زمن كل طريقة وعدد ردود 429
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, body = await self.inner.do_request(url, method, request_data, **kwargs)
+        finally:
+            M_TG.observe(time.perf_counter() - t0, endpoint)
+        if code == 429:
+            M_TG_RETRY.inc(endpoint)
+        return code, body
+
+def metrics_web(routes=()):
+    # تطبيق tornado صغير: /metrics (+ مسارات إضافية كالويبهوك)
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            if METRICS_TOKEN and self.request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+                self.set_status(401)
+                return
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write(METRICS.render())
+
+    return tornado.web.Application([(r"/metrics", MetricsHandler), *routes])
+
+# ========== جدولة طلبات AI ==========
+# كل طلبات AI تمر من هنا: حد للتزامن + دلو توكنات (طلب/ث) + إعادة محاولة بتراجع أُسّي
+# + قاطع دارة لكل نموذج + قائمة نماذج احتياطية مرتّبة.
+AI_MAX_INFLIGHT     = int(os.getenv("AI_MAX_INFLIGHT", "16"))
+AI_RPS              = float(os.getenv("AI_RPS", "5"))
+AI_BURST            = int(os.getenv("AI_BURST", "10"))
+AI_RETRIES          = int(os.getenv("AI_RETRIES", "2"))
+AI_BACKOFF_BASE     = float(os.getenv("AI_BACKOFF_BASE", "0.5"))
+AI_BACKOFF_MAX      = float(os.getenv("AI_BACKOFF_MAX", "10"))
+AI_BREAKER_FAILS    = int(os.getenv("AI_BREAKER_FAILS", "5"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+AI_FALLBACK_MODELS  = [m.strip() for m in os.getenv("AI_FALLBACK_MODELS", "").split(",") if m.strip()]
+AI_QUEUE_NOTICE_SEC = float(os.getenv("AI_QUEUE_NOTICE_SEC", "2"))
+
+# تحوّط (hedging): إن لم يبدأ الرد الأساسي خلال مئين AI_HEDGE_PCT من الأزمنة الأخيرة يُرسل طلب ثانٍ
+# لنموذج/مزوّد بديل؛ أول رد يفوز ويُلغى الآخر. AI_HEDGE_MAX_RATE يحدّ نسبة الطلبات الإضافية.
+AI_HEDGE          = os.getenv("AI_HEDGE", "0") != "0"
+AI_HEDGE_PCT      = float(os.getenv("AI_HEDGE_PCT", "95"))
+AI_HEDGE_MIN_SEC  = float(os.getenv("AI_HEDGE_MIN_SEC", "2"))      # أدنى مهلة، وهي المهلة قبل تجمّع العيّنات
+AI_HEDGE_MAX_RATE = float(os.getenv("AI_HEDGE_MAX_RATE", "0.1"))   # طلبات التحوّط ÷ الطلبات المؤهلة
+AI_HEDGE_MODEL    = (os.getenv("AI_HEDGE_MODEL") or (AI_FALLBACK_MODELS or [AI_MODEL])[0]).strip()
+AI_HEDGE_BASE_URL = (os.getenv("AI_HEDGE_BASE_URL") or "").strip()
+AI_HEDGE_API_KEY  = (os.getenv("AI_HEDGE_API_KEY") or AI_API_KEY).strip()
+AI_HEDGE_SAMPLES  = 200   # نافذة الأزمنة الأخيرة لكل نوع طلب
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        # صفر إن أمكن الأخذ فورًا، وإلا الثواني اللازمة لتوكن واحد
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def take(self):
+        while True:
+            d = self.delay()
+            if d <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(d)
+
+    def try_take(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+class CircuitBreaker:
+    def __init__(self, fails: int, cooldown: float):
+        self.max_fails, self.cooldown = fails, cooldown
+        self.fails = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0   # بدء التجربة الجارية في نصف المفتوح (0 = لا تجربة)
+
+    @property
+    def state(self) -> str:
+        if self.fails < self.max_fails:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        st = self.state
+        if st != "half-open":
+            return st == "closed"
+        # نصف مفتوح: طلب تجربة واحد فقط والباقي يُرفض حتى تُحسم؛ تجربة لم تُحسم (أُلغيت) تُستبدل بعد cooldown
+        now = time.monotonic()
+        if self.probe_at and now - self.probe_at < self.cooldown:
+            return False
+        self.probe_at = now
+        return True
+
+    def ok(self):
+        self.fails = 0
+        self.probe_at = 0.0
+
+    def fail(self):
+        self.fails += 1
+        self.probe_at = 0.0
+        if self.fails >= self.max_fails:
+            self.opened_at = time.monotonic()   # يُفتح (أو يُعاد فتحه بعد تجربة نصف مفتوحة فاشلة)
+
+def _classify(e: Exception) -> Tuple[str, Optional[float]]:
+    # "retry" = نفس النموذج بعد تراجع، "limited" = مثلها لكنه تحديد معدل لا عطل (لا يُحسب على القاطع)،
+    # "fallback" = انتقل للنموذج التالي، "fatal" = ارفع الخطأ؛ مع Retry-After بالثواني إن أرسله المزوّد
+    if isinstance(e, httpx.HTTPStatusError):
+        code = e.response.status_code
+        ra = e.response.headers.get("Retry-After")
+        try:
+            ra = float(ra) if ra is not None else None
+        except ValueError:
+            ra = None
+        if code == 429 or (ra is not None and code >= 500):
+            return "limited", ra
+        if code >= 500 or code == 408:
+            return "retry", None
+        if code in (400, 404, 422):
+            return "fallback", None   # نموذج غير متاح/لا يقبل الطلب
+        return "fatal", None
+    if isinstance(e, (httpx.TimeoutException, httpx.TransportError)):
+        return "retry", None
+    return "fatal", None
+
+_AI_LEG: "contextvars.ContextVar[Optional[Tuple[HedgeRace, str]]]" = contextvars.ContextVar("ai_leg", default=None)
+
+class HedgeRace:
+    # طلب أساسي وطلب تحوّط متسابقان. يفوز أول من يطالب بالرد (أول جزء مبثوث عبر ai_claim أو
+    # اكتمال الطلب) ويُلغى الآخر فورًا، فلا يصل المستخدم إلا رد واحد.
+    def __init__(self):
+        self.legs: Dict[asyncio.Task, str] = {}
+        self.winner: Optional[asyncio.Task] = None
+        self.t0 = time.perf_counter()
+        self.t_claim = 0.0
+
+    def start(self, call, model: str, leg: str) -> asyncio.Task:
+        async def run():
+            _AI_LEG.set((self, leg))
+            return await call(model)
+        task = asyncio.get_running_loop().create_task(run())
+        self.legs[task] = leg
+        return task
+
+    def claim(self, task: asyncio.Task):
+        if self.winner is None:
+            self.winner, self.t_claim = task, time.perf_counter()
+            for t in self.legs:
+                if t is not task:
+                    t.cancel()
+        elif self.winner is not task:
+            raise asyncio.CancelledError
+
+    async def result(self):
+        # نتيجة الفائز؛ إن فشل الطرفان يُرفع خطأ الطلب الأساسي (ليقرر المجدول الإعادة/البديل)
+        pending, errs = set(self.legs), {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.cancelled():
+                    continue
+                if t.exception() is not None:
+                    if t is self.winner:
+                        raise t.exception()   # بدأ بثّه ثم انقطع: لا إعادة ولا طرف آخر
+                    errs[self.legs[t]] = t.exception()
+                    continue
+                self.claim(t)
+                return t.result()
+        raise errs.get("primary") or errs["hedge"]
+
+def ai_claim():
+    # قبل أول أثر مرئي (أول جزء في البث): يحسم سباق التحوّط إن وُجد
+    leg = _AI_LEG.get()
+    if leg is not None:
+        leg[0].claim(asyncio.current_task())
+
+def leg_client() -> httpx.AsyncClient:
+    leg = _AI_LEG.get()
+    return ai_hedge_client() if leg is not None and leg[1] == "hedge" else ai_client()
+
+class AIScheduler:
+    def __init__(self):
+        self.sem = asyncio.Semaphore(AI_MAX_INFLIGHT)
+        self.bucket = TokenBucket(AI_RPS, AI_BURST)
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.inflight = self.waiting = 0
+        self.retries = self.fallbacks = self.rejected = 0
+        self.lat: Dict[str, deque] = {}   # نوع الطلب ← أزمنة أول رد (للمهلة المئينية)
+        self.eligible = self.hedged = self.hedge_wins = 0
+
+    def models(self) -> List[str]:
+        return list(dict.fromkeys([AI_MODEL] + AI_FALLBACK_MODELS))
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(AI_BREAKER_FAILS, AI_BREAKER_COOLDOWN)
+        return self.breakers[model]
+
+    async def run(self, call, on_queued=None, hedge: str = ""):
+        # call(model) -> coroutine؛ on_queued() يُستدعى مرة واحدة إن طال الانتظار
+        # hedge = نوع الطلب ("chat"/"stream") ليُتحوّط له، "" = بلا تحوّط (كالتلخيص في الخلفية)
+        if not ai_enabled():
+            raise AIError(AI_UNAVAILABLE)
+        notified = False
+
+        async def notice(wait: float):
+            nonlocal notified
+            if on_queued and not notified and wait >= AI_QUEUE_NOTICE_SEC:
+                notified = True
+                try:
+                    await on_queued()
+                except Exception as e:
+                    log.debug("queue notice: %s", e)
+
+        self.waiting += 1
+        try:
+            if not self.sem.locked():
+                await self.sem.acquire()
+            else:
+                acq = asyncio.ensure_future(self.sem.acquire())
+                try:
+                    done, _ = await asyncio.wait({acq}, timeout=AI_QUEUE_NOTICE_SEC)
+                    if not done:
+                        await notice(AI_QUEUE_NOTICE_SEC)   # طال الانتظار فعلًا
+                    await acq
+                except BaseException:
+                    if acq.done() and not acq.cancelled():
+                        self.sem.release()
+                    acq.cancel()
+                    raise
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+        try:
+            for n, model in enumerate(self.models()):
+                br = self.breaker(model)
+                if not br.allow():
+                    continue
+                if n:
+                    self.fallbacks += 1
+                for attempt in range(AI_RETRIES + 1):
+                    wait = self.bucket.delay()
+                    if wait:
+                        await notice(wait)
+                    await self.bucket.take()
+                    t0 = time.perf_counter()
+                    try:
+                        res = await self.attempt(call, model, hedge if n == 0 else "")
+                        br.ok()
+                        M_AI.observe(time.perf_counter() - t0, model, "ok")
+                        return res
+                    except AIError:
+                        M_AI.observe(time.perf_counter() - t0, model, "cut")
+                        raise
+                    except Exception as e:
+                        M_AI.observe(time.perf_counter() - t0, model, "error")
+                        M_AI_ERR.inc(model, ai_error_class(e))
+                        kind, ra = _classify(e)
+                        if kind == "fatal":
+                            raise
+                        if kind != "limited":
+                            br.fail()   # 5xx ومهلات فقط: تحديد المعدل لا يفتح القاطع
+                        log.warning("AI %s محاولة %d فشلت: %s", model, attempt + 1, e)
+                        if kind == "fallback" or attempt == AI_RETRIES or (kind == "retry" and not br.allow()):
+                            break
+                        self.retries += 1
+                        if ra is None:
+                            delay = min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+                        else:
+                            delay = ra + random.random() * AI_BACKOFF_BASE   # لا قبل Retry-After أبدًا
+                        await notice(delay)
+                        await asyncio.sleep(delay)
+            self.rejected += 1
+            raise AIError(AI_BUSY)
+        finally:
+            self.inflight -= 1
+            self.sem.release()
+
+    def deadline(self, kind: str) -> float:
+        lat = self.lat.get(kind)
+        if not lat or len(lat) < 20:
+            return AI_HEDGE_MIN_SEC
+        xs = sorted(lat)
+        return max(AI_HEDGE_MIN_SEC, xs[min(len(xs) - 1, int(len(xs) * AI_HEDGE_PCT / 100))])
+
+    def hedge_key(self) -> str:
+        return f"{AI_HEDGE_MODEL}@{AI_HEDGE_BASE_URL}" if AI_HEDGE_BASE_URL else AI_HEDGE_MODEL
+
+    async def attempt(self, call, model: str, kind: str):
+        if not (AI_HEDGE and kind):
+            return await call(model)
+        self.eligible += 1
+        race = HedgeRace()
+        primary = race.start(call, model, "primary")
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.deadline(kind))
+            if not done and race.winner is None:   # لم يكتمل ولم يبدأ البث بعد المهلة
+                br = self.breaker(self.hedge_key())
+                if self.hedged < AI_HEDGE_MAX_RATE * self.eligible and self.bucket.delay() <= 0 and br.allow():
+                    self.bucket.try_take()
+                    self.hedged += 1
+                    hedge = race.start(call, AI_HEDGE_MODEL, "hedge")
+                else:
+                    M_AI_HEDGE.inc(kind, "capped")
+            res = await race.result()
+        finally:
+            for t in race.legs:
+                t.cancel()
+            if hedge is not None and hedge.done() and not hedge.cancelled():
+                if hedge.exception() is not None:
+                    if _classify(hedge.exception())[0] != "limited":
+                        self.breaker(self.hedge_key()).fail()
+                else:
+                    self.breaker(self.hedge_key()).ok()
+        leg = race.legs[race.winner]
+        took = race.t_claim - race.t0
+        # إن فاز التحوّط فزمن الأساسي ≥ took: يُسجَّل كحد أدنى حتى لا تنخفض المهلة بحذف الأبطأ
+        self.lat.setdefault(kind, deque(maxlen=AI_HEDGE_SAMPLES)).append(took)
+        M_AI_FIRST.observe(took, kind, leg)
+        if hedge is not None:
+            M_AI_HEDGE.inc(kind, "won" if leg == "hedge" else "lost")
+            self.hedge_wins += leg == "hedge"
+        return res
+
+    def stats(self) -> str:
+        br = ", ".join(f"{m}:{self.breaker(m).state}" for m in self.models())
+        hedge = (f" | hedge {AI_HEDGE_MODEL}: {self.hedged}/{self.eligible} sent, {self.hedge_wins} won, "
+                 f"deadline " + "/".join(f"{k}={self.deadline(k):.1f}s" for k in sorted(self.lat))) if AI_HEDGE else ""
+        return (f"sched inflight={self.inflight}/{AI_MAX_INFLIGHT} | waiting={self.waiting} | rps={AI_RPS} | "
+                f"retries={self.retries} | fallbacks={self.fallbacks} | rejected={self.rejected} | breakers: {br}{hedge}")
+
+AI_SCHED = AIScheduler()
+
+async def ai_chat(messages: List[Dict[str,str]], max_tokens: int = 700, on_queued=None, hedge: str = "") -> str:
+    return await AI_SCHED.run(lambda model: _ai_post(messages, model, max_tokens), on_queued, hedge)
+
+async def ai_call(user_content: str, history: List[Dict[str,str]], dsm_mode: bool, on_queued=None) -> str:
+    return await ai_chat(ai_messages(user_content, history, dsm_mode), on_queued=on_queued, hedge="chat")
+
+async def ai_call_stream(user_content: str, history: List[Dict[str,str]], dsm_mode: bool, on_delta, on_queued=None) -> str:
+    messages = ai_messages(user_content, history, dsm_mode)
+
+    async def call(model: str) -> str:
+        parts: List[str] = []
+        try:
+            async for delta in _ai_stream(messages, model):
+                if not parts:
+                    ai_claim()   # أول جزء: هذا الطلب يفوز بسباق التحوّط
+                parts.append(delta)
+                await on_delta(delta)
+        except Exception:
+            if not parts:
+                raise   # لم يظهر شيء بعد: المجدول يعيد المحاولة/يبدّل النموذج
+            note = "\n\n(انقطع الرد قبل اكتماله.)"
+            await on_delta(note)
+            raise AIError("".join(parts).strip() + note)
+        return "".join(parts).strip()
+
+    return await AI_SCHED.run(call, on_queued, "stream")
+
+def retry_after_sec(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class StreamingReply:
+    # رسالة واحدة تُعدَّل مع وصول الرموز (بفاصل يحترم حدود التعديل) وتنتقل لرسالة جديدة قرب 4096 حرفًا
+    def __init__(self, message, interval: float = AI_STREAM_EDIT_SEC, limit: int = AI_STREAM_SPLIT):
+        self.message = message
+        self.interval = interval
+        self.limit = limit
+        self.msg = None       # رسالة تيليجرام الجاري تعديلها
+        self.buf = ""         # نص الرسالة الحالية
+        self.shown = ""       # آخر نص ظهر فعلاً للمستخدم
+        self.full = ""        # كل ما بُثّ (للمقارنة بالرد النهائي)
+        self.next_at = 0.0
+        self.t0 = time.monotonic()
+        self.first_visible: Optional[float] = None
+
+    async def push(self, delta: str):
+        self.buf += delta
+        self.full += delta
+        while len(self.buf) > self.limit:
+            cut = cut_at(self.buf, self.limit)
+            head, self.buf = self.buf[:cut], self.buf[cut:].lstrip()
+            if not await self._show(head, force=True):
+                await self._spill(head)
+            self.msg, self.shown = None, ""
+        if time.monotonic() >= self.next_at:
+            await self._show(self.buf)
+
+    async def finish(self, reply: str, kb=None):
+        if self.msg is None and not self.shown and not self.buf.strip():
+            # لا بث (أزمة/خطأ قبل أول رمز): رد عادي
+            await self.message.reply_text(reply, reply_markup=kb)
+            return
+        spilled = not await self._show(self.buf, force=True)
+        if spilled:
+            await self._spill(self.buf, kb)
+        if reply.strip() != self.full.strip():
+            # الرد النهائي غير ما بُثّ (خطأ/بديل محلي بعد جزء ظاهر): يُرسل كاملًا مع الأزرار
+            await send_long(self.message.chat, reply, kb)
+        if self.first_visible is not None:
+            log.info("AI stream: first text %.2fs, total %.2fs", self.first_visible, time.monotonic() - self.t0)
+
+    async def _spill(self, text: str, kb=None):
+        # فشل التعديل الأخير: ما لم يظهر بعد يُرسل رسالة جديدة بدل أن يبقى الرد مبتورًا
+        rest = text[len(self.shown):].lstrip() if text.startswith(self.shown) else text
+        if rest.strip():
+            await send_long(self.message.chat, rest, kb)
+        self.shown = text
+
+    async def _show(self, text: str, force: bool = False) -> bool:
+        if not text.strip() or text == self.shown:
+            return True
+        for _ in range(5 if force else 1):
+            try:
+                if self.msg is None:
+                    self.msg = await self.message.reply_text(text)
+                    if self.first_visible is None:
+                        self.first_visible = time.monotonic() - self.t0
+                else:
+                    await self.msg.edit_text(text)
+                self.shown = text
+                self.next_at = time.monotonic() + self.interval
+                return True
+            except RetryAfter as e:
+                self.next_at = time.monotonic() + retry_after_sec(e)
+                if force:
+                    await asyncio.sleep(retry_after_sec(e))
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self.shown = text
+                    return True
+                raise
+            except NetworkError:
+                if not force:
+                    return False
+                await asyncio.sleep(1)
+        return False
+
+# ========== إرسال مقيّد المعدل إلى تيليجرام ==========
+class OutboundLimiter(BaseRateLimiter):
+    # كل طلب Bot API يحمل chat_id يمر بدلو محادثته ثم بالدلو العام، وبترتيب وصوله داخل المحادثة
+    # (أقفال asyncio عادلة). RetryAfter يوقف المحادثة المعنية ثم يعيد المحاولة بدل إسقاط الرسالة،
+    # فيتحوّل الضغط إلى تأخير لا إلى رسائل ضائعة.
+    FREE = frozenset({"sendChatAction", "answerCallbackQuery"})   # لا تُحسب من حصة الرسائل
+
+    def __init__(self, global_rps: float = TG_GLOBAL_RPS, chat_rps: float = TG_CHAT_RPS,
+                 chat_burst: float = TG_CHAT_BURST, group_rpm: float = TG_GROUP_RPM,
+                 max_retries: int = TG_MAX_RETRIES):
+        self.glob = TokenBucket(global_rps, global_rps)
+        self.glock = asyncio.Lock()
+        self.chat_rps, self.chat_burst, self.group_rps = chat_rps, chat_burst, group_rpm / 60
+        self.max_retries = max_retries
+        self.chats: Dict[object, list] = {}     # chat_id -> [Lock, TokenBucket, طلبات معلّقة]
+        self.waiting = 0
+        self.sent = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def share(self, frac: float):
+        # وضع العمّال: الحد العام لكل البوت، فكل عملية تأخذ نصيب أقسامها منه (المحادثة لا تعبر الأقسام)
+        rate = self.glob.rate * frac
+        self.glob = TokenBucket(rate, max(1.0, rate))
+
+    def _slot(self, chat_id) -> list:
+        slot = self.chats.get(chat_id)
+        if slot is None:
+            group = isinstance(chat_id, str) or chat_id < 0     # @channel أو مجموعة
+            rate = self.group_rps if group else self.chat_rps
+            slot = self.chats[chat_id] = [asyncio.Lock(), TokenBucket(rate, self.chat_burst), 0]
+        return slot
+
+    def _prune(self):
+        # المحادثات الخاملة التي امتلأ دلوها لا تحمل حالة تستحق الإبقاء
+        for chat_id, (lock, bucket, n) in list(self.chats.items()):
+            bucket._refill()
+            if n == 0 and bucket.tokens >= bucket.burst:
+                del self.chats[chat_id]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or endpoint in self.FREE:
+            return await callback(*args, **kwargs)
+        retries = rate_limit_args.get("max_retries", self.max_retries) if isinstance(rate_limit_args, dict) else self.max_retries
+        slot = self._slot(chat_id)
+        slot[2] += 1
+        self.waiting += 1
+        queued, t0 = True, time.monotonic()
+        try:
+            async with slot[0]:
+                for attempt in range(retries + 1):
+                    await slot[1].take()
+                    async with self.glock:
+                        await self.glob.take()
+                    if queued:
+                        queued = False
+                        self.waiting -= 1
+                        M_TG_WAIT.observe(time.monotonic() - t0, endpoint)
+                    try:
+                        out = await callback(*args, **kwargs)
+                        self.sent += 1
+                        return out
+                    except RetryAfter as e:
+                        if attempt == retries:
+                            raise
+                        self.retries += 1
+                        log.warning("Bot API flood control: %s chat=%s retry in %.1fs", endpoint, chat_id, retry_after_sec(e))
+                        await asyncio.sleep(retry_after_sec(e))   # القفل محجوز: ما بعدها ينتظر ويحفظ الترتيب
+        finally:
+            if queued:
+                self.waiting -= 1
+            slot[2] -= 1
+            if len(self.chats) > 4096 and self.sent % 1024 == 0:
+                self._prune()
+
+    def stats(self) -> str:
+        return (f"outbound waiting={self.waiting} | sent={self.sent} | retry_after={self.retries} | "
+                f"chats tracked={len(self.chats)}")
+
+# ========== كاش ردود AI ==========
+# اختياري لكل وضع (AI_CACHE_MODES=free,dsm). المفتاح = الوضع + النص بعد التوحيد + بصمة السجل.
+AI_CACHE_MODES = {m.strip() for m in os.getenv("AI_CACHE_MODES", "").split(",") if m.strip()}
+AI_CACHE_SIZE  = int(os.getenv("AI_CACHE_SIZE", "1024"))
+AI_CACHE_TTL   = float(os.getenv("AI_CACHE_TTL", "86400"))
+AI_CACHE_DB    = os.getenv("AI_CACHE_DB", "")   # مسار SQLite لطبقة قرص تبقى بعد إعادة التشغيل
+
+class ResponseCache:
+    def __init__(self, size: int, ttl: float, db_path: str = ""):
+        self.size, self.ttl = size, ttl
+        self.mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = self.misses = self.disk_hits = 0
+        self.db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[float, str]] = {}   # كتابات القرص المؤجلة (تُجمع في معاملة واحدة)
+        self._task: Optional[asyncio.Task] = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS ai_cache (k TEXT PRIMARY KEY, ts REAL, v TEXT) WITHOUT ROWID")
+            self.db.execute("DELETE FROM ai_cache WHERE ts < ?", (time.time() - ttl,))
+
+    @staticmethod
+    def key(mode: str, text: str, history: List[Dict[str,str]]) -> str:
+        h = hashlib.sha1(json.dumps(history, ensure_ascii=False, separators=(",", ":")).encode()).hexdigest()
+        return hashlib.sha1(f"{mode}\x1f{normalize_ar(text)}\x1f{h}".encode()).hexdigest()
+
+    async def get(self, k: str) -> Optional[str]:
+        now = time.time()
+        hit = self.mem.get(k)
+        if hit and now - hit[0] < self.ttl:
+            self.mem.move_to_end(k)
+            self.hits += 1
+            return hit[1]
+        if hit:
+            del self.mem[k]
+        if self.db is not None:
+            # طبقة القرص خارج حلقة الأحداث (القراءة قد تنتظر كاتبًا آخر على الملف)
+            row = self._pending.get(k) or await asyncio.to_thread(self._read_sync, k)
+            if row and now - row[0] < self.ttl:
+                self._remember(k, row[0], row[1])
+                self.hits += 1; self.disk_hits += 1
+                return row[1]
+        self.misses += 1
+        return None
+
+    def put(self, k: str, v: str):
+        now = time.time()
+        self._remember(k, now, v)
+        if self.db is not None:
+            self._pending[k] = (now, v)
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _read_sync(self, k: str) -> Optional[Tuple[float, str]]:
+        with self._lock:
+            return self.db.execute("SELECT ts, v FROM ai_cache WHERE k=?", (k,)).fetchone()
+
+    async def flush(self):
+        # ما تراكم أثناء الكتابة السابقة يُكتب في الدفعة التالية
+        while self._pending:
+            rows, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write_sync, rows)
+            except Exception as e:
+                log.warning("ai_cache: تعذّرت الكتابة (%d): %s", len(rows), e)   # كاش: الفقد مقبول
+
+    def _write_sync(self, rows: Dict[str, Tuple[float, str]]):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO ai_cache (k, ts, v) VALUES (?,?,?)",
+                                    [(k, ts, v) for k, (ts, v) in rows.items()])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _remember(self, k: str, ts: float, v: str):
+        self.mem[k] = (ts, v)
+        self.mem.move_to_end(k)
+        while len(self.mem) > self.size:
+            self.mem.popitem(last=False)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0.0
+        return f"cache modes={','.join(sorted(AI_CACHE_MODES)) or '-'} | hits={self.hits} (disk {self.disk_hits}) | misses={self.misses} | hit%={rate:.1f} | size={len(self.mem)}"
+
+AI_CACHE = ResponseCache(AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_DB)
+
+# ========== ذاكرة المحادثة (ميزانية توكنات + تلخيص متدرّج) ==========
+# ai_hist = الأدوار الخام الأحدث، ai_sum = ملخص ما طُوي منها. يُرسَل الملخص + أحدث ما يسعه AI_PROMPT_BUDGET.
+AI_PROMPT_BUDGET   = int(os.getenv("AI_PROMPT_BUDGET", "1500"))    # توكنات السجل في كل طلب
+AI_SUMMARY_TRIGGER = int(os.getenv("AI_SUMMARY_TRIGGER", "2500"))  # طيّ الأدوار القديمة عند تجاوزها
+AI_SUMMARY_TOKENS  = int(os.getenv("AI_SUMMARY_TOKENS", "300"))
+AI_KEEP_RECENT     = int(os.getenv("AI_KEEP_RECENT", "6"))         # رسائل خام تبقى بعد الطيّ
+AI_HIST_MAX        = 60                                            # سقف أمان إن تعذّر التلخيص
+
+AI_SYSTEM_SUMMARY = (
+    "لخّص المحادثة التالية بين مستخدم و«عربي سايكو» في نقاط عربية موجزة لتُستخدم كذاكرة للجلسة.\n"
+    "احتفظ بالأعراض (المدة/الشدة/الأثر)، المواقف المهمة، الأهداف، التمارين المتفق عليها وأي تنبيهات أمان.\n"
+    "لا تضف معلومات غير موجودة."
+)
+
+def count_tokens(text: str) -> int:
+    # تقدير سريع: ~4 بايت UTF-8 لكل توكن (العربية ≈ حرفان لكل توكن)
+    return len((text or "").encode("utf-8")) // 4 + 4
+
+def hist_tokens(hist: List[Dict[str,str]]) -> int:
+    return sum(count_tokens(m["content"]) for m in hist)
+
+def memory_window(user_data) -> List[Dict[str,str]]:
+    hist: List[Dict[str,str]] = user_data.get("ai_hist", [])
+    summary = user_data.get("ai_sum", "")
+    budget = AI_PROMPT_BUDGET
+    out: List[Dict[str,str]] = []
+    if summary:
+        out.append({"role":"system","content":f"ملخص ما سبق من الجلسة:\n{summary}"})
+        budget -= count_tokens(summary)
+    recent: List[Dict[str,str]] = []
+    for m in reversed(hist):
+        budget -= count_tokens(m["content"])
+        if budget < 0 and recent:
+            break
+        recent.append(m)
+    if recent and recent[-1]["role"] == "assistant" and len(recent) < len(hist):
+        recent.pop()  # ابدأ النافذة برسالة مستخدم
+    return out + recent[::-1]
+
+_FOLDING: set = set()
+
+def maybe_fold(context: ContextTypes.DEFAULT_TYPE):
+    ud = context.user_data
+    hist = ud.get("ai_hist", [])
+    if not ai_enabled():
+        del hist[:max(0, len(hist) - AI_HIST_MAX)]
+        return
+    if id(ud) in _FOLDING or len(hist) <= AI_KEEP_RECENT or hist_tokens(hist) <= AI_SUMMARY_TRIGGER:
+        return
+    _FOLDING.add(id(ud))
+    context.application.create_task(fold_history(ud, hist), update=None)
+
+async def fold_history(ud, hist: List[Dict[str,str]]):
+    # يعمل في الخلفية: لا ينتظر المستخدم التلخيص
+    n = len(hist) - AI_KEEP_RECENT
+    old = hist[:n]
+    try:
+        prev = ud.get("ai_sum", "")
+        convo = "\n".join(f"{'المستخدم' if m['role']=='user' else 'المساعد'}: {m['content']}" for m in old)
+        if prev:
+            convo = f"ملخص سابق:\n{prev}\n\nتتمة:\n{convo}"
+        summary = await ai_chat(
+            [{"role":"system","content":AI_SYSTEM_SUMMARY}, {"role":"user","content":convo}],
+            max_tokens=AI_SUMMARY_TOKENS,
+        )
+        if ud.get("ai_hist") is hist:   # لم تبدأ جلسة جديدة أثناء التلخيص
+            ud["ai_sum"] = summary
+            del hist[:n]
     except Exception as e:
-        return f"تعذّر الاتصال بالذكاء الاصطناعي: {e}"
+        log.warning("تلخيص السجل فشل: %s", e)
+        if ud.get("ai_hist") is hist and len(hist) > AI_HIST_MAX:
+            del hist[:len(hist) - AI_HIST_MAX]
+    finally:
+        _FOLDING.discard(id(ud))
 
-async def ai_respond(text: str, context: ContextTypes.DEFAULT_TYPE) -> str:
+def reset_memory(user_data, mode: str):
+    user_data["ai_hist"] = []
+    user_data["ai_mode"] = mode
+    user_data.pop("ai_sum", None)
+
+async def ai_respond(text: str, context: ContextTypes.DEFAULT_TYPE, on_delta=None, on_queued=None) -> str:
     if is_crisis(text):
-        return ("⚠️ سلامتك أولاً. إن كان لديك خطر فوري على نفسك/غيرك فاتصل بالطوارئ فورًا.\n"
-                "جرّب تنفّس 4-7-8 عشر مرات وابقَ مع شخص تثق به وحدّد موعدًا عاجلاً مع مختص.")
-    hist: List[Dict[str,str]] = context.user_data.get("ai_hist", [])
-    hist = hist[-20:]
-    dsm_mode = (context.user_data.get("ai_mode") == "dsm")
-    reply = await asyncio.to_thread(ai_call, text, hist, dsm_mode)
-    hist += [{"role":"user","content":text},{"role":"assistant","content":reply}]
-    context.user_data["ai_hist"] = hist[-20:]
+        return CRISIS_REPLY
+    hist: List[Dict[str,str]] = context.user_data.setdefault("ai_hist", [])
+    window = memory_window(context.user_data)
+    mode = context.user_data.get("ai_mode") or "free"
+    dsm_mode = (mode == "dsm")
+    key = ResponseCache.key(mode, text, window) if mode in AI_CACHE_MODES else None
+    # رسالة المستخدم تُحفظ أولًا (تبقى سياقًا حتى لو فشل الرد)، والرد فقط إن كان من النموذج فعلًا:
+    # AI_BUSY والبديل المحلي ورد مقطوع لا تُعاد للنموذج كأنها كلامه
+    hist.append({"role":"user","content":text})
+    real = True
+    reply = await AI_CACHE.get(key) if key else None
+    if reply is None:
+        try:
+            if on_delta is not None:
+                reply = await ai_call_stream(text, window, dsm_mode, on_delta, on_queued)
+            else:
+                reply = await ai_call(text, window, dsm_mode, on_queued)
+            if key:
+                AI_CACHE.put(key, reply)
+        except AIError as e:
+            real, reply = False, str(e)
+            if reply in (AI_UNAVAILABLE, AI_BUSY):   # لا بديل لرد انقطع بعد ظهور جزء منه
+                reply = local_reply(text, reply)
+        except Exception as e:
+            log.warning("AI call فشل: %r", e)
+            real, reply = False, local_reply(text, AI_BUSY)
+    if real:
+        hist.append({"role":"assistant","content":reply})
+    maybe_fold(context)
     return reply
 
 # ========== CBT نصوص ==========
@@ -197,7 +1438,7 @@ CBT_TXT = {
 }
 
 # ========== تمارين/حالات ==========
-@dataclass
+@dataclass(slots=True)
 class ThoughtRecord:
     situation: str = ""
     emotion: str = ""
@@ -208,13 +1449,14 @@ class ThoughtRecord:
     start: Optional[int] = None
     end: Optional[int] = None
 
-@dataclass
+@dataclass(slots=True)
 class ExposureState:
     suds: Optional[int] = None
     plan: Optional[str] = None
 
-@dataclass
+@dataclass(frozen=True)
 class Survey:
+    # تعريف ثابت مشترك بين كل المستخدمين؛ تقدّم كل مستخدم في Progress
     id: str
     title: str
     items: List[str]
@@ -222,13 +1464,20 @@ class Survey:
     min_v: int
     max_v: int
     reverse: List[int] = field(default_factory=list)
-    ans: List[int] = field(default_factory=list)
+    # قواعد التصحيح (تُترجم مرة واحدة إلى Scorer عند الإقلاع)
+    label: str = ""                                                    # الاسم في سطر النتيجة
+    multiplier: float = 1                                              # WHO-5: ×4
+    bands: List[Tuple[float, str]] = field(default_factory=list)       # (حد أعلى شامل، الوصف)
+    subscales: Dict[str, List[int]] = field(default_factory=dict)      # اسم → بنود (متوسط)
+    sub_bands: List[Tuple[float, str]] = field(default_factory=list)
+    alerts: List[Tuple[int, int, str]] = field(default_factory=list)   # (بند، حد أدنى، تنبيه)
+    fmt: str = "**{label}:** {total}/{max} — {band}{alerts}"
 
 def survey_prompt(s: Survey, i: int) -> str:
     return f"({i+1}/{len(s.items)}) {s.items[i]}\n{ s.scale }\nاختر رقمًا من الأزرار:"
 
 # ======== لوحات الأزرار للأسئلة ========
-def scale_kb(min_v: int, max_v: int) -> InlineKeyboardMarkup:
+def build_scale_kb(min_v: int, max_v: int) -> InlineKeyboardMarkup:
     btns = [InlineKeyboardButton(str(i), callback_data=f"s:{i}") for i in range(min_v, max_v+1)]
     rows, row = [], []
     for b in btns:
@@ -238,7 +1487,7 @@ def scale_kb(min_v: int, max_v: int) -> InlineKeyboardMarkup:
     if row: rows.append(row)
     return InlineKeyboardMarkup(rows)
 
-def yes_no_kb(tag: str) -> InlineKeyboardMarkup:
+def build_yes_no_kb(tag: str) -> InlineKeyboardMarkup:
     # tag أحد: "panic" | "pc" | "bin"  (نفس الدالة لكل اختبارات نعم/لا)
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("نعم", callback_data=f"{tag}:yes"),
@@ -246,47 +1495,63 @@ def yes_no_kb(tag: str) -> InlineKeyboardMarkup:
     ])
 
 # ========== بنوك أسئلة ==========
+INF = float("inf")
+
 PHQ9 = Survey("phq9","PHQ-9 — الاكتئاب",
     ["قلة الاهتمام/المتعة","الإحباط/اليأس","مشاكل النوم","التعب/قلة الطاقة","تغيّر الشهية",
      "الشعور بالسوء عن النفس","صعوبة التركيز","بطء/توتر ملحوظ","أفكار بإيذاء النفس"],
-    "0=أبدًا،1=عدة أيام،2=أكثر من نصف الأيام،3=تقريبًا كل يوم",0,3)
+    "0=أبدًا،1=عدة أيام،2=أكثر من نصف الأيام،3=تقريبًا كل يوم",0,3,
+    label="PHQ-9", bands=[(4,"لا/خفيف جدًا"),(9,"خفيف"),(14,"متوسط"),(19,"متوسط-شديد"),(INF,"شديد")],
+    alerts=[(8,1,"⚠️ بند أفكار الإيذاء >0 — اطلب مساعدة فورية.")])
 
 GAD7 = Survey("gad7","GAD-7 — القلق",
     ["توتر/قلق/عصبية","عدم القدرة على إيقاف القلق","الانشغال بالهموم","صعوبة الاسترخاء",
      "تململ/صعوبة الهدوء","العصبية/الانزعاج بسهولة","الخوف من حدوث أمر سيئ"],
-    "0=أبدًا،1=عدة أيام،2=أكثر من نصف الأيام،3=تقريبًا كل يوم",0,3)
+    "0=أبدًا،1=عدة أيام،2=أكثر من نصف الأيام،3=تقريبًا كل يوم",0,3,
+    label="GAD-7", bands=[(4,"طبيعي/خفيف جدًا"),(9,"قلق خفيف"),(14,"قلق متوسط"),(INF,"قلق شديد")])
 
 MINISPIN = Survey("minispin","Mini-SPIN — الرهاب الاجتماعي",
     ["أتجنب مواقف اجتماعية خوف الإحراج","أقلق أن يلاحظ الآخرون ارتباكي","أخاف التحدث أمام الآخرين"],
-    "0=أبدًا،1=قليلًا،2=إلى حد ما،3=كثيرًا،4=جداً",0,4)
+    "0=أبدًا،1=قليلًا،2=إلى حد ما،3=كثيرًا،4=جداً",0,4,
+    label="Mini-SPIN", bands=[(5,"أقل من حد الإشارة"),(INF,"مؤشر رهاب اجتماعي محتمل")])
 
 TIPI = Survey("tipi","TIPI — الخمسة الكبار (10)",
     ["منفتح/اجتماعي","ناقد قليل المودة (عكسي)","منظم/موثوق","يتوتر بسهولة",
      "منفتح على الخبرة","انطوائي/خجول (عكسي)","ودود/متعاون","مهمل/عشوائي (عكسي)",
      "هادئ وثابت (عكسي)","تقليدي/غير خيالي (عكسي)"],
-    "قيّم 1–7 (1=لا تنطبق…7=تنطبق تمامًا)",1,7,reverse=[1,5,7,8,9])
+    "قيّم 1–7 (1=لا تنطبق…7=تنطبق تمامًا)",1,7,reverse=[1,5,7,8,9],
+    subscales={"الانبساط":[0,5],"التوافق":[1,6],"الانضباط":[2,7],"الاستقرار الانفعالي":[3,8],"الانفتاح":[4,9]},
+    sub_bands=[(2.5,"منخفض"),(5.4999,"متوسط"),(INF,"عالٍ")],
+    fmt="**TIPI (1–7):**{subs}")
 
 ISI7 = Survey("isi7","ISI-7 — شدّة الأرق",
     ["صعوبة بدء النوم","صعوبة الاستمرار بالنوم","الاستيقاظ المبكر","الرضا عن النوم",
      "تأثير الأرق على الأداء بالنهار","ملاحظة الآخرين لمشكلتك","القلق/الانزعاج من نومك"],
-    "0=لا،1=خفيف،2=متوسط،3=شديد،4=شديد جدًا",0,4)
+    "0=لا،1=خفيف،2=متوسط،3=شديد،4=شديد جدًا",0,4,
+    label="ISI-7", bands=[(7,"أرق ضئيل"),(14,"أرق خفيف"),(21,"أرق متوسط"),(INF,"أرق شديد")])
 
 PSS10 = Survey("pss10","PSS-10 — الضغوط المُدركة",
     ["كم شعرت بأن الأمور خرجت عن سيطرتك؟","كم انزعجت من أمر غير متوقع؟","كم شعرت بالتوتر؟",
      "كم شعرت بأنك تتحكم بالأمور؟ (عكسي)","كم شعرت بالثقة في التعامل مع مشكلاتك؟ (عكسي)",
      "كم شعرت أن الأمور تسير كما ترغب؟ (عكسي)","كم لم تستطع التأقلم مع كل ما عليك؟",
      "كم سيطرت على الانفعالات؟ (عكسي)","كم شعرت بأن المشاكل تتراكم؟","كم وجدت وقتًا للأشياء المهمة؟ (عكسي)"],
-    "0=أبدًا،1=نادرًا،2=أحيانًا،3=كثيرًا،4=دائمًا",0,4,reverse=[3,4,5,7,9])
+    "0=أبدًا،1=نادرًا،2=أحيانًا،3=كثيرًا،4=دائمًا",0,4,reverse=[3,4,5,7,9],
+    label="PSS-10", bands=[(13,"منخفض"),(26,"متوسط"),(INF,"عالٍ")],
+    fmt="**{label}:** {total}/{max} — ضغط {band}")
 
 WHO5 = Survey("who5","WHO-5 — الرفاه",
     ["شعرتُ بأنني مبتهج وفي مزاج جيد","شعرتُ بالهدوء والسكينة","شعرتُ بالنشاط والحيوية",
      "كنتُ أستيقظ مرتاحًا","كان يومي مليئًا بما يهمّني"],
-    "0=لم يحصل مطلقًا…5=طوال الوقت",0,5)
+    "0=لم يحصل مطلقًا…5=طوال الوقت",0,5,
+    label="WHO-5", multiplier=4,
+    bands=[(50,"منخفض (≤50) — يُستحسن تحسين الروتين والتواصل/التقييم."),(INF,"جيد.")])
 
 K10 = Survey("k10","K10 — الضيق النفسي (4 أسابيع)",
     ["كم مرة شعرت بالتعب بلا سبب؟","عصبي/متوتر؟","ميؤوس؟","قلق شديد؟","كل شيء جهد عليك؟",
      "لا تستطيع الهدوء؟","حزين بشدة؟","لا شيء يفرحك؟","لا تحتمل أي تأخير؟","شعور بلا قيمة؟"],
-    "1=أبدًا،2=قليلًا،3=أحيانًا،4=غالبًا،5=دائمًا",1,5)
+    "1=أبدًا،2=قليلًا،3=أحيانًا،4=غالبًا،5=دائمًا",1,5,
+    label="K10", bands=[(19,"خفيف"),(24,"متوسط"),(29,"شديد"),(INF,"شديد جدًا")],
+    fmt="**{label}:** {total}/{max} — ضيق {band}")
 
 PC_PTSD5 = [
   "آخر شهر: كوابيس/ذكريات مزعجة لحدث صادم؟ (نعم/لا)",
@@ -315,6 +1580,116 @@ MSI_BPD = [
   "توتر شديد/أفكار غريبة تحت الضغط؟ (نعم/لا)","تجنّب/اختبارات للآخرين خوف الهجر؟ (نعم/لا)"
 ]
 
+PANIC_QS = [
+  "خلال 4 أسابيع: هل حدثت لديك نوبات هلع مفاجئة؟ (نعم/لا)",
+  "هل تخاف من حدوث نوبة أخرى أو تتجنب أماكن بسببها؟ (نعم/لا)"
+]
+
+# اختبارات نعم/لا بنفس محرك التصحيح (نعم=1، لا=0)
+YES_NO = "نعم/لا"
+PANIC_S = Survey("panic","فحص نوبات الهلع",PANIC_QS,YES_NO,0,1,
+    bands=[(1,"سلبي — لا مؤشر قوي حاليًا"),(INF,"إيجابي — قد تكون هناك نوبات هلع")],
+    fmt="**نتيجة فحص الهلع:** {band}")
+PCPTSD_S = Survey("pcptsd5","PC-PTSD-5 — الصدمة",PC_PTSD5,YES_NO,0,1,
+    label="PC-PTSD-5", bands=[(2,"سلبي — أقل من حد الإشارة."),(INF,"إيجابي (≥3 «نعم») — يُوصى بالتقييم.")])
+SAPAS_S = Survey("sapas","SAPAS — شاشة اضطراب الشخصية",SAPAS,YES_NO,0,1,
+    label="SAPAS", bands=[(2,"سلبي."),(INF,"إيجابي (≥3) يُستحسن التقييم.")])
+MSI_S = Survey("msi","MSI-BPD — مؤشرات الحدّية",MSI_BPD,YES_NO,0,1,
+    label="MSI-BPD", bands=[(6,"سلبي."),(INF,"إيجابي (≥7) يُستحسن التقييم.")])
+
+SURVEYS: Dict[str, Survey] = {s.id: s for s in (
+    PHQ9, GAD7, MINISPIN, TIPI, ISI7, PSS10, WHO5, K10, PANIC_S, PCPTSD_S, SAPAS_S, MSI_S)}
+
+# ========== محرك التصحيح ==========
+@dataclass
+class ScoreResult:
+    total: float
+    band: str
+    subscales: Dict[str, Tuple[float, str]]
+    alerts: List[str]
+    text: str
+
+class Scorer:
+    # قواعد Survey مترجمة مرة واحدة: عكس البنود، المضاعِف، الحدود، المقاييس الفرعية، التنبيهات.
+    # score() لإجابات مستخدم واحد، score_matrix() لمصفوفة NumPy كاملة (صف لكل إجابة) دفعة واحدة.
+    def __init__(self, s: Survey):
+        self.s = s
+        self.n = len(s.items)
+        self.flip = s.min_v + s.max_v            # قيمة البند العكسي = min+max-x
+        self.rev = set(s.reverse)
+        self.uppers = [b[0] for b in s.bands]
+        self.labels = [b[1] for b in s.bands]
+        self.sub_uppers = [b[0] for b in s.sub_bands]
+        self.sub_labels = [b[1] for b in s.sub_bands]
+        self.max_total = self.n * s.max_v * s.multiplier
+        self.sub_names = list(s.subscales)
+        self.rev_mask = None   # مصفوفات numpy تُبنى عند أول score_matrix
+
+    def _vectorize(self):
+        s = self.s
+        self.rev_mask = np.zeros(self.n, dtype=bool)
+        self.rev_mask[list(self.rev)] = True
+        self.np_uppers = np.array(self.uppers, dtype=float)
+        self.sub_w = np.zeros((self.n, len(self.sub_names)))
+        for j, name in enumerate(self.sub_names):
+            self.sub_w[s.subscales[name], j] = 1.0 / len(s.subscales[name])
+
+    @staticmethod
+    def _band(uppers: List[float], labels: List[str], x: float) -> str:
+        return labels[min(bisect_left(uppers, x), len(labels) - 1)] if labels else ""
+
+    def values(self, ans: List[int]) -> List[int]:
+        return [self.flip - a if i in self.rev else a for i, a in enumerate(ans)]
+
+    def band(self, total: float) -> str:
+        return self._band(self.uppers, self.labels, total)
+
+    def score(self, ans: List[int]) -> ScoreResult:
+        s = self.s
+        vals = self.values(ans)
+        total = sum(vals) * s.multiplier
+        total = int(total) if float(total).is_integer() else total
+        band = self.band(total)
+        subs = {}
+        for name, idx in s.subscales.items():
+            v = sum(vals[i] for i in idx) / len(idx)
+            subs[name] = (v, self._band(self.sub_uppers, self.sub_labels, v))
+        alerts = [msg for i, thr, msg in s.alerts if i < len(ans) and ans[i] >= thr]
+        mx = int(self.max_total) if float(self.max_total).is_integer() else self.max_total
+        text = s.fmt.format(
+            label=s.label or s.id, total=total, max=mx, band=band,
+            alerts="".join("\n" + a for a in alerts),
+            subs="".join(f"\n• {k}: {v:.1f} ({b})" for k, (v, b) in subs.items()),
+        )
+        return ScoreResult(total, band, subs, alerts, text)
+
+    def text(self, ans: List[int]) -> str:
+        return self.score(ans).text
+
+    def score_matrix(self, m) -> Dict[str, "np.ndarray"]:
+        # m: مصفوفة (صفوف × بنود) بالإجابات الخام. يعيد مصفوفات: total، band (فهرس في bands)،
+        # sub:<اسم> لكل مقياس فرعي، alert:<بند> (منطقي) لكل قاعدة تنبيه.
+        if load_numpy() is None:
+            raise RuntimeError("score_matrix يحتاج numpy (pip install numpy)")
+        if self.rev_mask is None:
+            self._vectorize()
+        m = np.asarray(m)
+        if m.ndim != 2 or m.shape[1] != self.n:
+            raise ValueError(f"{self.s.id}: متوقع مصفوفة (N, {self.n})")
+        vals = np.where(self.rev_mask, self.flip - m, m)
+        total = vals.sum(axis=1) * self.s.multiplier
+        out = {"total": total,
+               "band": np.minimum(np.searchsorted(self.np_uppers, total, side="left"), max(len(self.uppers) - 1, 0))}
+        if self.sub_names:
+            subs = vals @ self.sub_w
+            for j, name in enumerate(self.sub_names):
+                out[f"sub:{name}"] = subs[:, j]
+        for i, thr, _ in self.s.alerts:
+            out[f"alert:{i}"] = m[:, i] >= thr
+        return out
+
+SCORERS: Dict[str, Scorer] = {sid: Scorer(s) for sid, s in SURVEYS.items()}
+
 # ========== اضطرابات الشخصية ==========
 PD_TEXT = (
     "🧩 **اضطرابات الشخصية — DSM-5 (عناقيد A/B/C)**\n\n"
@@ -339,7 +1714,7 @@ PD_DETAILS = {
     10:"الوسواسية القهرية للشخصية (OCPD): كمالية مفرطة، صرامة، انشغال بالقواعد/الترتيب على حساب المرونة."
 }
 
-def pd_inline_keyboard():
+def build_pd_keyboard():
     rows = [
         [InlineKeyboardButton("1 الزورية", callback_data="pd:1"),
          InlineKeyboardButton("2 التجنّبية", callback_data="pd:2")],
@@ -355,8 +1730,102 @@ def pd_inline_keyboard():
     ]
     return InlineKeyboardMarkup(rows)
 
+# ========== إجابات محلية (BM25 بلا شبكة) ==========
+# فهرس في الذاكرة فوق CBT_TXT وPD_DETAILS وبنوك الأسئلة: بديل فوري حين يغيب AI أو يتعطل،
+# وإجابة مبدئية اختيارية إن تأخر رده أكثر من LOCAL_PREANSWER_SEC.
+LOCAL_ANSWER        = os.getenv("LOCAL_ANSWER", "1") != "0"
+LOCAL_MIN_SCORE     = float(os.getenv("LOCAL_MIN_SCORE", "2.5"))
+LOCAL_PREANSWER_SEC = float(os.getenv("LOCAL_PREANSWER_SEC", "0"))   # 0 = بلا إجابة مبدئية
+
+LOCAL_NOTE = "ⓘ إجابة مختصرة من مكتبة عربي سايكو — الذكاء الاصطناعي غير متاح الآن."
+LOCAL_PRE  = "⏳ ريثما يكتمل الرد، هذا من مكتبة عربي سايكو:"
+
+AR_STOP = {normalize_ar(w) for w in (
+    "في من على إلى عن مع أو ثم لا لم لن ما ماذا لماذا كيف هل متى أين أنا أنت هو هي نحن هم إن أن إني "
+    "عندي لدي هذا هذه ذلك تلك التي الذي كل قد جدا كثير أريد ودي أبي شي شيء يعني صار بعد قبل عند كان "
+    "يكون اللي وش ايش ليش اذا إذا لو حتى بس لكن كذلك أيضا يوم اليوم أحس أشعر حاسس".split())}
+AR_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال", "و", "ب", "ف", "ك", "ل")
+AR_SUFFIXES = ("ات", "ون", "ين", "ها", "يه", "ه")
+
+def ar_terms(text: str) -> List[str]:
+    # توحيد + إسقاط كلمات الربط + تجذيع خفيف (أداة التعريف وبعض اللواحق)
+    out = []
+    for w in normalize_ar(text).split():
+        if w in AR_STOP:
+            continue
+        for p in AR_PREFIXES:
+            if w.startswith(p) and len(w) - len(p) >= 3:
+                w = w[len(p):]
+                break
+        for x in AR_SUFFIXES:
+            if w.endswith(x) and len(w) - len(x) >= 3:
+                w = w[:-len(x)]
+                break
+        if len(w) > 1:
+            out.append(w)
+    return out
+
+class LocalKB:
+    # docs: (نوع، نص البحث، نص الإجابة). أوزان BM25 محسوبة مسبقًا لكل (مصطلح، مستند)
+    # فالاستعلام = جمع قوائم قليلة بلا أي حساب لوغاريتمي.
+    def __init__(self, docs: List[Tuple[str, str, str]], k1: float = 1.2, b: float = 0.75):
+        self.docs = docs
+        tfs = [Counter(ar_terms(text)) for _, text, _ in docs]
+        n = len(tfs)
+        avg = sum(sum(tf.values()) for tf in tfs) / max(n, 1)
+        df = Counter(t for tf in tfs for t in tf)
+        self.post: Dict[str, List[Tuple[int, float]]] = {}
+        for d, tf in enumerate(tfs):
+            norm = k1 * (1 - b + b * sum(tf.values()) / avg)
+            for t, f in tf.items():
+                idf = math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))
+                self.post.setdefault(t, []).append((d, idf * f * (k1 + 1) / (f + norm)))
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[float, int]]:
+        acc: Dict[int, float] = {}
+        for t in set(ar_terms(query)):
+            for d, w in self.post.get(t, ()):
+                acc[d] = acc.get(d, 0.0) + w
+        return heapq.nlargest(k, ((sc, d) for d, sc in acc.items()))
+
+    def answer(self, query: str, min_score: float = 0.0) -> Optional[str]:
+        # أفضل نص إرشادي (CBT/شخصية) ومعه أقرب اختبار؛ الاختبار وحده إن لم يطابق غيره
+        hits = [d for sc, d in self.search(query, 5) if sc >= (min_score or LOCAL_MIN_SCORE)]
+        info = next((self.docs[d][2] for d in hits if self.docs[d][0] != "test"), None)
+        test = next((self.docs[d][2] for d in hits if self.docs[d][0] == "test"), None)
+        if info and test:
+            return f"{info}\n\n{test}"
+        return info or test
+
+# كلمات يكتبها الناس ولا ترد حرفيًا في النص
+LOCAL_ALIASES = {
+    "about": "العلاج المعرفي السلوكي أفكار مشاعر سلوك",
+    "anx": "قلق توتر خوف", "dep": "اكتئاب حزن ضيق متعة طاقة", "anger": "عصبية غضب انفعال",
+    "relax": "توتر ضغط تنفس استرخاء", "sleep": "أرق نوم سهر", "mind": "تشتت حاضر تركيز",
+}
+
+def local_docs() -> List[Tuple[str, str, str]]:
+    docs = []
+    labels = {route: label for row in CBT_ROWS for label, route in row}
+    for key, txt in CBT_TXT.items():
+        docs.append(("cbt", f"{labels.get(key, '')} {LOCAL_ALIASES.get(key, '')}\n{txt}", txt))
+    for txt in PD_DETAILS.values():
+        docs.append(("pd", f"اضطراب الشخصية {txt}", f"🧩 {txt}\nⓘ للاسترشاد فقط — ليس تشخيصًا. جرّب SAPAS/MSI-BPD من «اختبارات الشخصية»."))
+    for s in SURVEYS.values():
+        docs.append(("test", f"{s.title} {s.label}\n" + "\n".join(s.items),
+                     f"📝 لقياس ذلك جرّب اختبار **{s.title}** ({len(s.items)} أسئلة) من قائمة الاختبارات."))
+    return docs
+
+LOCAL_KB = LocalKB(local_docs())
+
+def local_reply(text: str, why: str) -> str:
+    # بديل AI: إجابة من الفهرس مع تنبيه، وإلا رسالة الخطأ كما هي
+    hit = LOCAL_KB.answer(text) if LOCAL_ANSWER else None
+    M_LOCAL.inc("fallback" if hit else "miss")
+    return f"{hit}\n\n{LOCAL_NOTE}" if hit else why
+
 # ========== التحويل الطبي ==========
-def referral_keyboard():
+def build_referral_keyboard():
     rows = []
     if CONTACT_THERAPIST_URL:
         rows.append([InlineKeyboardButton("تحويل إلى أخصائي نفسي", url=CONTACT_THERAPIST_URL)])
@@ -366,7 +1835,7 @@ def referral_keyboard():
         rows.append([InlineKeyboardButton("راسلنا على تيليجرام", url="https://t.me/")])
     return InlineKeyboardMarkup(rows)
 
-def therapist_keyboard_only():
+def build_therapist_keyboard():
     rows = []
     if CONTACT_THERAPIST_URL:
         rows.append([InlineKeyboardButton("التواصل مع أخصائي نفسي", url=CONTACT_THERAPIST_URL)])
@@ -383,7 +1852,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MENU
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("/start — القائمة\n/help — المساعدة\n/ping — اختبار سريع")
+    await update.message.reply_text("/start — القائمة\n/help — المساعدة\n/history — تطوّر نتائجك\n"
+                                    "/reminders — تذكيراتك (off لإيقافها)\n/ping — اختبار سريع")
 
 async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("pong ✅")
@@ -391,13 +1861,32 @@ async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_version(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"نسخة عربي سايكو: {VERSION}")
 
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    proc = context.application.update_processor
+    lines = [proc.stats() if isinstance(proc, ChatOrderedProcessor) else "updates: sequential"]
+    p = context.application.persistence
+    if isinstance(p, BatchedPersistence):
+        lines.append(f"persist loaded={len(p.loaded)} | flushes={p.flushes} | last flush={p.last_flush_ms:.1f}ms")
+    if "sessions" in context.bot_data:
+        lines.append(context.bot_data["sessions"].stats())
+    if "reminders" in context.bot_data:
+        lines.append(context.bot_data["reminders"].stats())
+    if "broadcast" in context.bot_data:
+        lines.append(context.bot_data["broadcast"].stats())
+    if isinstance(context.bot.rate_limiter, OutboundLimiter):
+        lines.append(context.bot.rate_limiter.stats())
+    await update.message.reply_text("\n".join(lines))
+
 async def cmd_ai_diag(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        f"AI_BASE_URL set={bool(AI_BASE_URL)} | KEY set={bool(AI_API_KEY)} | MODEL={AI_MODEL}"
+        f"AI_BASE_URL set={bool(AI_BASE_URL)} | KEY set={bool(AI_API_KEY)} | MODEL={AI_MODEL}\n"
+        f"pool={AI_POOL_MAX}/{AI_POOL_KEEPALIVE} | timeouts={AI_CONNECT_TIMEOUT}/{AI_READ_TIMEOUT}s | http2={AI_HTTP2}\n"
+        f"{AI_CACHE.stats()}\n"
+        f"{AI_SCHED.stats()}"
     )
 
 # ======= رسائل موحّدة مع أزرار =======
-def tests_psych_inline():
+def build_tests_psych_kb():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("PHQ-9 (اكتئاب)", callback_data="test:phq9"),
          InlineKeyboardButton("GAD-7 (قلق)", callback_data="test:gad7")],
@@ -410,13 +1899,82 @@ def tests_psych_inline():
          InlineKeyboardButton("فحص نوبات الهلع", callback_data="test:panic")],
     ])
 
-def tests_personality_inline():
+def build_tests_personality_kb():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("TIPI (الخمسة الكبار)", callback_data="test:tipi")],
         [InlineKeyboardButton("SAPAS (شاشة عامة)", callback_data="test:sapas"),
          InlineKeyboardButton("MSI-BPD (حدّية)", callback_data="test:msi")],
     ])
 
+def build_ai_start_kb():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("ابدأ جلسة عربي سايكو 🤖", callback_data="start_ai")],
+        [InlineKeyboardButton("جلسة عربي سايكو + DSM", callback_data="start_ai_dsm")],
+        [InlineKeyboardButton("DSM-5 تشخيص استرشادي فقط", callback_data="start_dsm")],
+    ])
+
+def build_expo_help_kb():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("أمثلة 3–4/10", callback_data="expo_suggest")],
+        [InlineKeyboardButton("شرح سريع", callback_data="expo_help")]
+    ])
+
+def build_expo_go_kb():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ ابدأ الآن", callback_data="expo_start")],
+        [InlineKeyboardButton("تم — قيّم الدرجة", callback_data="expo_rate")]
+    ])
+
+# ========== طبقة العرض: لوحات ونصوص جاهزة ==========
+# كائنات تيليجرام مجمّدة (immutable) تُبنى مرة واحدة وتُشارك بين كل المستخدمين،
+# بدل إعادة بناء InlineKeyboardMarkup لكل سؤال ولكل مستخدم.
+KB_SCALE = {(s.min_v, s.max_v): build_scale_kb(s.min_v, s.max_v) for s in SURVEYS.values() if s.scale != YES_NO}
+KB_YES_NO = {tag: build_yes_no_kb(tag) for tag in ("panic", "pc", "bin")}
+KB_PD = build_pd_keyboard()
+KB_REFERRAL = build_referral_keyboard()
+KB_THERAPIST = build_therapist_keyboard()
+KB_TESTS_PSYCH = build_tests_psych_kb()
+KB_TESTS_PERSONALITY = build_tests_personality_kb()
+KB_AI_START = build_ai_start_kb()
+KB_EXPO_HELP = build_expo_help_kb()
+KB_EXPO_GO = build_expo_go_kb()
+
+# نصوص الأسئلة جاهزة لكل (اختبار، بند)، والنصوص الطويلة الثابتة مُقسّمة مسبقًا لـ send_long
+PROMPTS: Dict[str, Tuple[str, ...]] = {
+    sid: tuple(survey_prompt(s, i) for i in range(len(s.items))) for sid, s in SURVEYS.items()
+}
+PRE_SPLIT: Dict[str, Tuple[str, ...]] = {
+    t: split_message(t) for t in (*CBT_TXT.values(), PD_TEXT, *PD_DETAILS.values())
+}
+
+def scale_kb(min_v: int, max_v: int) -> InlineKeyboardMarkup:
+    kb = KB_SCALE.get((min_v, max_v))
+    if kb is None:
+        kb = KB_SCALE[(min_v, max_v)] = build_scale_kb(min_v, max_v)
+    return kb
+
+def yes_no_kb(tag: str) -> InlineKeyboardMarkup:
+    return KB_YES_NO[tag]
+
+def pd_inline_keyboard():
+    return KB_PD
+
+def referral_keyboard():
+    return KB_REFERRAL
+
+def therapist_keyboard_only():
+    return KB_THERAPIST
+
+def tests_psych_inline():
+    return KB_TESTS_PSYCH
+
+def tests_personality_inline():
+    return KB_TESTS_PERSONALITY
+
+def question_text(s: Survey, i: int) -> str:
+    pre = PROMPTS.get(s.id)
+    return pre[i] if pre and i < len(pre) else survey_prompt(s, i)
+
 # ========== المستوى الأعلى ==========
 async def pd_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(PD_TEXT, reply_markup=pd_inline_keyboard())
@@ -437,59 +1995,59 @@ async def pd_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MENU
 
 async def top_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
+    fn = TOP_ROUTES.get(TOP_INDEX.lookup(update.message.text or ""))
+    if fn:
+        return await fn(update, context)
+    await update.message.reply_text("اختر من الأزرار أو اكتب /help.", reply_markup=TOP_KB)
+    return MENU
 
-    if has("عربي سايكو", t):
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("ابدأ جلسة عربي سايكو 🤖", callback_data="start_ai")],
-            [InlineKeyboardButton("جلسة عربي سايكو + DSM", callback_data="start_ai_dsm")],
-            [InlineKeyboardButton("DSM-5 تشخيص استرشادي فقط", callback_data="start_dsm")],
-        ])
-        await update.message.reply_text(
-            "معك **عربي سايكو** — معالج نفسي افتراضي بالذكاء الاصطناعي (ليس بديلاً للطوارئ/التشخيص الطبي).\nاختر:",
-            reply_markup=kb
-        )
-        return MENU
+async def menu_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "معك **عربي سايكو** — معالج نفسي افتراضي بالذكاء الاصطناعي (ليس بديلاً للطوارئ/التشخيص الطبي).\nاختر:",
+        reply_markup=KB_AI_START
+    )
+    return MENU
 
-    if has("العلاج السلوكي", t):
-        await update.message.reply_text(
-            "اختر وحدة من CBT (يمكنك البدء بـ **خطة CBT شاملة (مقترحة)**):",
-            reply_markup=CBT_KB
-        )
-        return CBT_MENU
-
-    if has("الاختبارات النفسية", t):
-        text = ("📝 **الاختبارات النفسية (زر موحّد)**\n"
-                "اختر اختبارًا: اكتئاب، قلق، رهاب اجتماعي، أرق، ضغوط، رفاه، ضيق نفسي، PTSD، فحص هلع.")
-        await update.message.reply_text(text, reply_markup=tests_psych_inline())
-        return MENU
+async def menu_cbt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "اختر وحدة من CBT (يمكنك البدء بـ **خطة CBT شاملة (مقترحة)**):",
+        reply_markup=CBT_KB
+    )
+    return CBT_MENU
 
-    if has("اختبارات الشخصية", t):
-        text = ("🧩 **اختبارات الشخصية (زر موحّد)**\n"
-                "• TIPI (الخمسة الكبار)\n• SAPAS (شاشة عامة)\n• MSI-BPD (مؤشرات الحدّية)")
-        await update.message.reply_text(text, reply_markup=tests_personality_inline())
-        return MENU
+async def menu_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = ("📝 **الاختبارات النفسية (زر موحّد)**\n"
+            "اختر اختبارًا: اكتئاب، قلق، رهاب اجتماعي، أرق، ضغوط، رفاه، ضيق نفسي، PTSD، فحص هلع.")
+    await update.message.reply_text(text, reply_markup=tests_psych_inline())
+    return MENU
 
-    if has("اضطرابات الشخصية", t):
-        await pd_open(update, context)
-        return MENU
+async def menu_pers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = ("🧩 **اختبارات الشخصية (زر موحّد)**\n"
+            "• TIPI (الخمسة الكبار)\n• SAPAS (شاشة عامة)\n• MSI-BPD (مؤشرات الحدّية)")
+    await update.message.reply_text(text, reply_markup=tests_personality_inline())
+    return MENU
 
-    if has("الأخصائي النفسي", t):
-        await update.message.reply_text("تواصل مع أخصائي نفسي:", reply_markup=therapist_keyboard_only())
-        return MENU
+async def menu_pd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await pd_open(update, context)
+    return MENU
 
-    if has("التحويل الطبي", t):
-        await update.message.reply_text("اختر نوع التحويل:", reply_markup=referral_keyboard())
-        return MENU
+async def menu_therapist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("تواصل مع أخصائي نفسي:", reply_markup=therapist_keyboard_only())
+    return MENU
 
-    await update.message.reply_text("اختر من الأزرار أو اكتب /help.", reply_markup=TOP_KB)
+async def menu_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("اختر نوع التحويل:", reply_markup=referral_keyboard())
     return MENU
 
+TOP_ROUTES = {
+    "ai": menu_ai, "cbt": menu_cbt, "tests": menu_tests, "pers": menu_pers,
+    "pd": menu_pd, "therapist": menu_therapist, "referral": menu_referral,
+}
+
 # ========== بدء/إدارة جلسة AI ==========
 async def ai_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    context.user_data["ai_hist"] = []
-    context.user_data["ai_mode"] = "free"
+    reset_memory(context.user_data, "free")
     await q.message.chat.send_message(
         "بدأت جلسة **عربي سايكو**. اكتب ما يضايقك الآن وسأساعدك بخطوات عملية.\n"
         "لإنهاء الجلسة: «◀️ إنهاء جلسة عربي سايكو».", reply_markup=AI_CHAT_KB
@@ -498,8 +2056,7 @@ async def ai_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ai_start_dsm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    context.user_data["ai_hist"] = []
-    context.user_data["ai_mode"] = "dsm"
+    reset_memory(context.user_data, "dsm")
     await q.message.chat.send_message(
         "✅ دخلت جلسة **عربي سايكو + DSM** (استرشادي غير تشخيصي).\n"
         "صف الأعراض بالمدة/الشدة/الأثر وسأقترح محاور تقييم وتمارين CBT مناسبة.",
@@ -509,71 +2066,159 @@ async def ai_start_dsm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def dsm_start_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    context.user_data["ai_hist"] = []
-    context.user_data["ai_mode"] = "dsm"
+    reset_memory(context.user_data, "dsm")
     await q.message.chat.send_message(
         "✅ دخلت وضع **DSM-5 الاسترشادي** (غير تشخيصي).",
         reply_markup=AI_CHAT_KB
     )
     return AI_CHAT
 
+# طلب واحد في الطيران لكل محادثة: الرسائل التي تصل أثناءه تُجمَّع ثم تُرسل كطلب متابعة واحد
+AI_DEBOUNCE_SEC = float(os.getenv("AI_DEBOUNCE_SEC", "1.0"))
+AI_DEBOUNCE_MAX = float(os.getenv("AI_DEBOUNCE_MAX", "4.0"))
+
+class ChatFlight:
+    __slots__ = ("task", "pending")
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None   # طلب AI الجاري لهذه المحادثة
+        self.pending: list = []   # رسائل تيليجرام تنتظر الدمج
+
+_FLIGHTS: Dict[int, ChatFlight] = {}
+
 async def ai_chat_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
+    chat_id = update.effective_chat.id
     if text in ("◀️ إنهاء جلسة عربي سايكو","/خروج","خروج","رجوع","◀️ رجوع"):
+        fl = _FLIGHTS.pop(chat_id, None)
+        if fl and fl.task is not None:
+            fl.task.cancel()   # لا رد متأخر ولا سجل يتسرّب للجلسة التالية
+        context.user_data.pop("ai_hist", None)
+        context.user_data.pop("ai_sum", None)
         await update.message.reply_text("انتهت الجلسة. رجعناك للقائمة.", reply_markup=TOP_KB)
         return MENU
-    await update.effective_chat.send_action(ChatAction.TYPING)
-    reply = await ai_respond(text, context)
-    await update.message.reply_text(reply, reply_markup=AI_CHAT_KB)
+    if getattr(context, "crisis", False):
+        return AI_CHAT   # رد الأمان أُرسل من crisis_guard
+    fl = _FLIGHTS.setdefault(chat_id, ChatFlight())
+    fl.pending.append(update.message)
+    if fl.task is None:
+        # المعالج يعود فورًا (الحالة تبقى AI_CHAT) والطلب يجري في مهمة نملكها،
+        # فتصل رسائل المستخدم أثناء انتظار AI وزر الإنهاء ولا تُسقط
+        fl.task = context.application.create_task(ai_flight(chat_id, fl, context), update=update)
     return AI_CHAT
 
-# ========== CBT Router ==========
-async def cbt_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
+async def ai_flight(chat_id: int, fl: ChatFlight, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        while fl.pending:
+            msgs, fl.pending = fl.pending, []
+            merged = "\n".join((m.text or "").strip() for m in msgs)
+            try:
+                await ai_reply(msgs[-1], merged, context)
+            except Exception as e:
+                # النص محفوظ في ai_hist (ai_respond يسجّله قبل الطلب) فيصل النموذجَ مع الرسالة التالية
+                log.warning("AI reply فشل: %r", e)
+                try:
+                    await msgs[-1].reply_text(AI_BUSY, reply_markup=AI_CHAT_KB)
+                except TelegramError as e2:
+                    log.debug("AI_BUSY: %s", e2)
+            await debounce(fl)
+    finally:
+        fl.task = None
+        if _FLIGHTS.get(chat_id) is fl:
+            _FLIGHTS.pop(chat_id, None)
 
-    if t == "◀️ رجوع":
-        await update.message.reply_text("رجعناك للقائمة.", reply_markup=TOP_KB);  return MENU
+async def debounce(fl: ChatFlight):
+    # انتظر حتى يتوقف تدفق الرسائل (أو AI_DEBOUNCE_MAX) قبل طلب المتابعة
+    waited, n = 0.0, -1
+    while fl.pending and n != len(fl.pending) and waited < AI_DEBOUNCE_MAX:
+        n = len(fl.pending)
+        await asyncio.sleep(AI_DEBOUNCE_SEC)
+        waited += AI_DEBOUNCE_SEC
 
-    if has("خطة CBT شاملة", t):
-        await send_long(update.effective_chat, CBT_TXT["plan"], CBT_KB);  return CBT_MENU
-
-    if has("ما هو CBT", t):  await send_long(update.effective_chat, CBT_TXT["about"], CBT_KB);  return CBT_MENU
-    if has("أخطاء التفكير", t):  await send_long(update.effective_chat, CBT_TXT["dist"], CBT_KB);  return CBT_MENU
-    if has("طرق علاج القلق", t):  await send_long(update.effective_chat, CBT_TXT["anx"], CBT_KB);  return CBT_MENU
-    if has("طرق علاج الاكتئاب", t):  await send_long(update.effective_chat, CBT_TXT["dep"], CBT_KB);  return CBT_MENU
-    if has("إدارة الغضب", t):  await send_long(update.effective_chat, CBT_TXT["anger"], CBT_KB);  return CBT_MENU
-    if has("التخلّص من الخوف", t):  await send_long(update.effective_chat, CBT_TXT["fear"], CBT_KB);  return CBT_MENU
-    if has("الاسترخاء", t):  await update.message.reply_text(CBT_TXT["relax"], reply_markup=CBT_KB);  return CBT_MENU
-    if has("اليقظة", t):  await update.message.reply_text(CBT_TXT["mind"], reply_markup=CBT_KB);  return CBT_MENU
-    if has("حل المشكلات", t):  await update.message.reply_text(CBT_TXT["prob"], reply_markup=CBT_KB);  return CBT_MENU
-    if has("بروتوكول النوم", t):  await update.message.reply_text(CBT_TXT["sleep"], reply_markup=CBT_KB);  return CBT_MENU
-
-    if has("التنشيط السلوكي", t):
-        context.user_data["ba_wait"] = True
-        await update.message.reply_text("أرسل 3 أنشطة صغيرة اليوم (10–20د) مفصولة بفواصل/أسطر.", reply_markup=ReplyKeyboardRemove())
-        return CBT_MENU
+async def ai_reply(message, text: str, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await message.chat.send_action(ChatAction.TYPING)
+    except TelegramError as e:
+        log.debug("typing: %s", e)   # مؤشر الكتابة اختياري: لا يوقف الرد
 
-    if has("سجلّ الأفكار", t):
-        context.user_data["tr"] = ThoughtRecord()
-        await update.message.reply_text("📝 اكتب **الموقف** باختصار (متى/أين/مع من؟).", reply_markup=ReplyKeyboardRemove())
-        return TH_SITU
+    async def queued():
+        await message.reply_text(AI_QUEUED)
 
-    if has("التعرّض التدريجي", t):
-        context.user_data["expo"] = ExposureState()
-        await update.message.reply_text("أرسل درجة قلقك الحالية 0–10.", reply_markup=ReplyKeyboardRemove())
-        return EXPO_WAIT
+    pre = preanswer(message, text)
+    try:
+        if AI_STREAM and ai_enabled():
+            out = StreamingReply(message)
+
+            async def push(delta: str):
+                if pre is not None:
+                    pre.cancel()   # بدأ الرد الحقيقي بالظهور
+                await out.push(delta)
+
+            reply = await ai_respond(text, context, on_delta=push, on_queued=queued)
+            await out.finish(reply, kb=AI_CHAT_KB)
+        else:
+            reply = await ai_respond(text, context, on_queued=queued)
+            await message.reply_text(reply, reply_markup=AI_CHAT_KB)
+    finally:
+        if pre is not None:
+            pre.cancel()
+
+def preanswer(message, text: str) -> Optional[asyncio.Task]:
+    # إجابة محلية تظهر إن لم يبدأ رد AI خلال LOCAL_PREANSWER_SEC
+    if LOCAL_PREANSWER_SEC <= 0 or not LOCAL_ANSWER or not ai_enabled() or is_crisis(text):
+        return None
+    hit = LOCAL_KB.answer(text)
+    if hit is None:
+        return None
+
+    async def later():
+        await asyncio.sleep(LOCAL_PREANSWER_SEC)
+        M_LOCAL.inc("pre")
+        await message.reply_text(f"{LOCAL_PRE}\n\n{hit}")
+    return asyncio.get_running_loop().create_task(later())
+
+# ========== CBT Router ==========
+async def cbt_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    t = update.message.text or ""
+    route = CBT_INDEX.lookup(t)
+    if route in CBT_TXT:
+        await send_long(update.effective_chat, CBT_TXT[route], CBT_KB);  return CBT_MENU
+    fn = CBT_ROUTES.get(route)
+    if fn:
+        return await fn(update, context)
 
     # إدخال أنشطة BA
     if context.user_data.get("ba_wait"):
         context.user_data["ba_wait"] = False
         parts = [s.strip() for s in re.split(r"[,\n،]+", t) if s.strip()]
         plan = "خطة اليوم:\n• " + "\n• ".join(parts[:3] or ["نشاط بسيط 10–20 دقيقة الآن."])
+        remind(update, context, "ba", REMIND_BA_SEC)
         await update.message.reply_text(plan + "\nقيّم مزاجك قبل/بعد 0–10.", reply_markup=CBT_KB)
         return CBT_MENU
 
     await update.message.reply_text("اختر وحدة من القائمة:", reply_markup=CBT_KB)
     return CBT_MENU
 
+async def cbt_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("رجعناك للقائمة.", reply_markup=TOP_KB)
+    return MENU
+
+async def cbt_ba(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["ba_wait"] = True
+    await update.message.reply_text("أرسل 3 أنشطة صغيرة اليوم (10–20د) مفصولة بفواصل/أسطر.", reply_markup=ReplyKeyboardRemove())
+    return CBT_MENU
+
+async def cbt_tr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["tr"] = ThoughtRecord()
+    await update.message.reply_text("📝 اكتب **الموقف** باختصار (متى/أين/مع من؟).", reply_markup=ReplyKeyboardRemove())
+    return TH_SITU
+
+async def cbt_expo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["expo"] = ExposureState()
+    await update.message.reply_text("أرسل درجة قلقك الحالية 0–10.", reply_markup=ReplyKeyboardRemove())
+    return EXPO_WAIT
+
+CBT_ROUTES = {"back": cbt_back, "ba": cbt_ba, "tr": cbt_tr, "expo": cbt_expo}
+
 # سجل الأفكار
 async def tr_situ(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tr: ThoughtRecord = context.user_data["tr"]; tr.situation = update.message.text.strip()
@@ -602,6 +2247,9 @@ async def tr_alt(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def tr_rerate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tr: ThoughtRecord = context.user_data["tr"]; tr.end = to_int(update.message.text)
+    for kind, v in (("tr_before", tr.start), ("tr_after", tr.end)):
+        if v is not None:
+            score_history().record(update.effective_user.id, kind, v)
     txt = (
         "✅ **ملخص سجلّ الأفكار**\n"
         f"• الموقف: {tr.situation}\n• الشعور قبل: {tr.emotion}\n• الفكرة: {tr.auto}\n"
@@ -619,11 +2267,9 @@ async def expo_wait(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if n is None or not (0 <= n <= 10):
         await update.message.reply_text("أرسل رقمًا من 0 إلى 10.");  return EXPO_WAIT
     st: ExposureState = context.user_data["expo"]; st.suds = n
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("أمثلة 3–4/10", callback_data="expo_suggest")],
-        [InlineKeyboardButton("شرح سريع", callback_data="expo_help")]
-    ])
-    await update.message.reply_text(f"درجتك = {n}/10. اكتب موقفًا مناسبًا 3–4/10 أو استخدم الأزرار.", reply_markup=kb)
+    score_history().record(update.effective_user.id, "suds", n)
+    remind(update, context, "expo", REMIND_EXPO_SEC)
+    await update.message.reply_text(f"درجتك = {n}/10. اكتب موقفًا مناسبًا 3–4/10 أو استخدم الأزرار.", reply_markup=KB_EXPO_HELP)
     return EXPO_FLOW
 
 async def expo_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -636,11 +2282,7 @@ async def expo_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def expo_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     st: ExposureState = context.user_data["expo"]; st.plan = (update.message.text or "").strip()
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ ابدأ الآن", callback_data="expo_start")],
-        [InlineKeyboardButton("تم — قيّم الدرجة", callback_data="expo_rate")]
-    ])
-    await update.message.reply_text(f"خطة التعرض:\n• {st.plan}\nابدأ والبقاء حتى يهبط القلق ≥ النصف.", reply_markup=kb)
+    await update.message.reply_text(f"خطة التعرض:\n• {st.plan}\nابدأ والبقاء حتى يهبط القلق ≥ النصف.", reply_markup=KB_EXPO_GO)
     return EXPO_FLOW
 
 async def expo_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -649,36 +2291,54 @@ async def expo_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if q.data == "expo_rate":  await q.edit_message_text("أرسل الدرجة الجديدة 0–10.");  return EXPO_WAIT
     return EXPO_FLOW
 
-# ========== اختبارات ثنائية نعم/لا ==========
-@dataclass
-class BinState:
+# ========== تقدّم المستخدم في اختبار ==========
+@dataclass(slots=True)
+class Progress:
+    # كل ما يخص المستخدم: مفتاح البنك المشترك في SURVEYS + الموضع + إجابة بايت واحد لكل بند
+    sid: str
     i: int = 0
-    yes: int = 0
-    qs: List[str] = field(default_factory=list)
+    ans: bytearray = field(default_factory=bytearray)
+
+    @property
+    def survey(self) -> Survey:
+        return SURVEYS[self.sid]
+
+# ======= بدء اختبار (من زر مضمّن أو من نص) =======
+TEST_LABELS = {
+    "phq9":"PHQ-9 اكتئاب","gad7":"GAD-7 قلق","minispin":"Mini-SPIN رهاب اجتماعي","isi7":"ISI-7 أرق",
+    "pss10":"PSS-10 ضغوط","who5":"WHO-5 رفاه","k10":"K10 ضيق نفسي","pcptsd5":"PC-PTSD-5 صدمة","panic":"فحص نوبات الهلع",
+    "tipi":"TIPI الخمسة الكبار","sapas":"SAPAS اضطراب شخصية","msi":"MSI-BPD حدّية"
+}
+TEST_BY_LABEL = {label: code for code, label in TEST_LABELS.items()}
+PERS_TESTS = ("tipi", "sapas", "msi")
+# اختبارات نعم/لا: الرمز ← (وسم الأزرار، حالة المحادثة)
+BIN_TESTS = {"panic": ("panic", PANIC_Q), "pcptsd5": ("pc", PTSD_Q), "sapas": ("bin", SURVEY), "msi": ("bin", SURVEY)}
+
+async def begin_test(chat, context: ContextTypes.DEFAULT_TYPE, code: str):
+    s = SURVEYS[code]
+    context.user_data["s"] = Progress(code)
+    if code in BIN_TESTS:
+        tag, state = BIN_TESTS[code]
+        await chat.send_message(s.items[0], reply_markup=yes_no_kb(tag))
+        return state
+    # الاستبيانات الرقمية — أرسل السؤال الأول بأزرار أرقام
+    await chat.send_message(f"بدء **{s.title}**.", reply_markup=ReplyKeyboardRemove())
+    await ask_numeric_question(chat, s, 0)
+    return SURVEY
+
+def active_test(context: ContextTypes.DEFAULT_TYPE, binary: bool) -> Optional[Progress]:
+    p = context.user_data.get("s")
+    return p if isinstance(p, Progress) and (p.sid in BIN_TESTS) == binary else None
 
-# ======= بدء اختبار عبر زر =======
 async def start_test_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     code = q.data.split(":",1)[1]
-    mapping = {
-        "phq9":"PHQ-9 اكتئاب","gad7":"GAD-7 قلق","minispin":"Mini-SPIN رهاب اجتماعي","isi7":"ISI-7 أرق",
-        "pss10":"PSS-10 ضغوط","who5":"WHO-5 رفاه","k10":"K10 ضيق نفسي","pcptsd5":"PC-PTSD-5 صدمة","panic":"فحص نوبات الهلع",
-        "tipi":"TIPI الخمسة الكبار","sapas":"SAPAS اضطراب شخصية","msi":"MSI-BPD حدّية"
-    }
-    text = mapping.get(code)
-    if not text: return MENU
-    class M:
-        def __init__(self, chat): self.chat=chat; self.text=text
-        async def reply_text(self, *a, **k): return await q.message.chat.send_message(*a, **k)
-    update2 = Update(update.update_id, message=M(q.message.chat))
-    if code in ("tipi","sapas","msi"):
-        return await pers_router(update2, context)
-    else:
-        return await tests_router(update2, context)
+    if code not in TEST_LABELS: return MENU
+    return await begin_test(q.message.chat, context, code)
 
 # ======= مُساعد إرسال السؤال الرقمي بأزرار =======
 async def ask_numeric_question(chat, s: Survey, i: int, edit_msg=None):
-    txt = survey_prompt(s, i)
+    txt = question_text(s, i)
     kb = scale_kb(s.min_v, s.max_v)
     if edit_msg:
         await edit_msg.edit_text(txt, reply_markup=kb)
@@ -689,118 +2349,51 @@ async def ask_numeric_question(chat, s: Survey, i: int, edit_msg=None):
 async def survey_ans_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     n = int(q.data.split(":",1)[1])
-    s: Survey = context.user_data.get("s")
-    i = context.user_data.get("s_i", 0)
-    if not s: 
+    p = active_test(context, binary=False)
+    if not p:
         await q.message.edit_text("لا توجد استبانة نشطة.")
         return MENU
+    s = p.survey
     if not (s.min_v <= n <= s.max_v):
         return SURVEY
-    s.ans.append(n); i += 1
-    if i >= len(s.items):
-        # حساب النتيجة (نفس منطق النص)
-        txt = ""
-        if s.id=="gad7":
-            total=sum(s.ans); lvl = "طبيعي/خفيف جدًا" if total<=4 else "قلق خفيف" if total<=9 else "قلق متوسط" if total<=14 else "قلق شديد"
-            txt = f"**GAD-7:** {total}/21 — {lvl}"
-        elif s.id=="phq9":
-            total=sum(s.ans)
-            if   total<=4: lvl="لا/خفيف جدًا"
-            elif total<=9: lvl="خفيف"
-            elif total<=14: lvl="متوسط"
-            elif total<=19: lvl="متوسط-شديد"
-            else: lvl="شديد"
-            warn = "\n⚠️ بند أفكار الإيذاء >0 — اطلب مساعدة فورية." if s.ans[8]>0 else ""
-            txt = f"**PHQ-9:** {total}/27 — {lvl}{warn}"
-        elif s.id=="minispin":
-            total=sum(s.ans); msg="مؤشر رهاب اجتماعي محتمل" if total>=6 else "أقل من حد الإشارة"
-            txt = f"**Mini-SPIN:** {total}/12 — {msg}"
-        elif s.id=="tipi":
-            vals = s.ans[:]
-            for idx in s.reverse: vals[idx] = 8 - vals[idx]
-            extr=(vals[0]+vals[5])/2; agre=(vals[1]+vals[6])/2; cons=(vals[2]+vals[7])/2; emot=(vals[3]+vals[8])/2; open_=(vals[4]+vals[9])/2
-            def lab(x): return "عالٍ" if x>=5.5 else ("منخفض" if x<=2.5 else "متوسط")
-            txt=(f"**TIPI (1–7):**\n"
-                 f"• الانبساط: {extr:.1f} ({lab(extr)})\n• التوافق: {agre:.1f} ({lab(agre)})\n"
-                 f"• الانضباط: {cons:.1f} ({lab(cons)})\n• الاستقرار الانفعالي: {emot:.1f} ({lab(emot)})\n"
-                 f"• الانفتاح: {open_:.1f} ({lab(open_)})")
-        elif s.id=="isi7":
-            total=sum(s.ans)
-            if   total<=7: lvl="أرق ضئيل"
-            elif total<=14: lvl="أرق خفيف"
-            elif total<=21: lvl="أرق متوسط"
-            else: lvl="أرق شديد"
-            txt = f"**ISI-7:** {total}/28 — {lvl}"
-        elif s.id=="pss10":
-            vals=s.ans[:]
-            for idx in s.reverse: vals[idx] = s.max_v - vals[idx]
-            total=sum(vals)
-            lvl = "منخفض" if total<=13 else "متوسط" if total<=26 else "عالٍ"
-            txt = f"**PSS-10:** {total}/40 — ضغط {lvl}"
-        elif s.id=="who5":
-            total=sum(s.ans)*4
-            note="منخفض (≤50) — يُستحسن تحسين الروتين والتواصل/التقييم." if total<=50 else "جيد."
-            txt = f"**WHO-5:** {total}/100 — {note}"
-        elif s.id=="k10":
-            total=sum(s.ans)
-            if   total<=19: lvl="خفيف"
-            elif total<=24: lvl="متوسط"
-            elif total<=29: lvl="شديد"
-            else: lvl="شديد جدًا"
-            txt = f"**K10:** {total}/50 — ضيق {lvl}"
-        else:
-            txt = "تم الحساب."
+    p.ans.append(n); p.i += 1
+    if p.i >= len(s.items):
+        context.user_data.pop("s", None)
+        sc = SCORERS.get(p.sid)
+        res = sc.score(p.ans) if sc else None
+        txt = res.text if res else "تم الحساب."
+        if res:
+            score_history().record(update.effective_user.id, p.sid, res.total)
+        if p.sid in REMIND_TEXTS:
+            remind(update, context, p.sid, REMIND_RETEST_DAYS * 86400)
 
         await q.message.edit_text("تم تسجيل الإجابة الأخيرة ✅")
         await q.message.chat.send_message(txt, reply_markup=TOP_KB)
         return MENU
     else:
-        context.user_data["s_i"] = i
-        await ask_numeric_question(q.message.chat, s, i, edit_msg=q.message)
+        await ask_numeric_question(q.message.chat, s, p.i, edit_msg=q.message)
         return SURVEY
 
 # ======= رد على ضغط زر نعم/لا =======
 async def bin_ans_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     tag, ans = q.data.split(":")
-    yes = 1 if ans == "yes" else 0
-
-    # حدّد أي حالة
-    if tag == "panic":
-        st: BinState = context.user_data["panic"]
-        st.yes += yes; st.i += 1
-        if st.i < len(st.qs):
-            await q.message.edit_text(st.qs[st.i], reply_markup=yes_no_kb("panic"))
-            return PANIC_Q
-        msg = "إيجابي — قد تكون هناك نوبات هلع" if st.yes==2 else "سلبي — لا مؤشر قوي حاليًا"
-        await q.message.edit_text("تم ✅")
-        await q.message.chat.send_message(f"**نتيجة فحص الهلع:** {msg}", reply_markup=TOP_KB)
-        return MENU
-
-    if tag == "pc":
-        st: BinState = context.user_data["pc"]
-        st.yes += yes; st.i += 1
-        if st.i < len(st.qs):
-            await q.message.edit_text(st.qs[st.i], reply_markup=yes_no_kb("pc"))
-            return PTSD_Q
-        result = "إيجابي (≥3 «نعم») — يُوصى بالتقييم." if st.yes>=3 else "سلبي — أقل من حد الإشارة."
-        await q.message.edit_text("تم ✅")
-        await q.message.chat.send_message(f"**PC-PTSD-5:** {st.yes}/5 — {result}", reply_markup=TOP_KB)
+    p = active_test(context, binary=True)
+    if not p:
+        await q.message.edit_text("لا يوجد اختبار نشط.")
         return MENU
-
-    # tag == "bin" (SAPAS/MSI)
-    st: BinState = context.user_data["bin"]
-    st.yes += yes; st.i += 1
-    if st.i < len(st.qs):
-        await q.message.edit_text(st.qs[st.i], reply_markup=yes_no_kb("bin"))
-        return SURVEY
-    if len(st.qs)==8:
-        cut=3; msg = f"**SAPAS:** {st.yes}/8 — " + ("إيجابي (≥3) يُستحسن التقييم." if st.yes>=cut else "سلبي.")
-    else:
-        cut=7; msg = f"**MSI-BPD:** {st.yes}/10 — " + ("إيجابي (≥7) يُستحسن التقييم." if st.yes>=cut else "سلبي.")
+    qs, here = p.survey.items, BIN_TESTS[p.sid][1]
+    p.ans.append(1 if ans == "yes" else 0); p.i += 1
+    if p.i < len(qs):
+        await q.message.edit_text(qs[p.i], reply_markup=yes_no_kb(tag))
+        return here
+    context.user_data.pop("s", None)
+    sc = SCORERS.get(p.sid)
+    res = sc.score(p.ans) if sc else None
+    msg = res.text if res else f"{sum(p.ans)}/{len(qs)}"
+    score_history().record(update.effective_user.id, p.sid, res.total if res else sum(p.ans))
     await q.message.edit_text("تم ✅")
     await q.message.chat.send_message(msg, reply_markup=TOP_KB)
-    context.user_data.pop("bin", None)
     return MENU
 
 # ========== Router الاختبارات ==========
@@ -808,88 +2401,1584 @@ async def tests_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t = update.message.text or ""
     if t == "◀️ رجوع":
         await update.message.reply_text("رجعناك للقائمة.", reply_markup=TOP_KB);  return MENU
-
-    key = {
-        "PHQ-9 اكتئاب":"phq9","GAD-7 قلق":"gad7","Mini-SPIN رهاب اجتماعي":"minispin",
-        "TIPI الخمسة الكبار":"tipi","ISI-7 أرق":"isi7","PSS-10 ضغوط":"pss10","WHO-5 رفاه":"who5","K10 ضيق نفسي":"k10",
-        "PC-PTSD-5 صدمة":"pcptsd5","فحص نوبات الهلع":"panic"
-    }.get(t)
-
-    if key is None:
+    code = TEST_BY_LABEL.get(t)
+    if code is None or code in ("sapas", "msi"):
         await update.message.reply_text("اختر اختبارًا:", reply_markup=tests_psych_inline());  return MENU
-
-    if key == "panic":
-        context.user_data["panic"] = BinState(i=0, yes=0, qs=[
-            "خلال 4 أسابيع: هل حدثت لديك نوبات هلع مفاجئة؟ (نعم/لا)",
-            "هل تخاف من حدوث نوبة أخرى أو تتجنب أماكن بسببها؟ (نعم/لا)"
-        ])
-        await update.message.reply_text(context.user_data["panic"].qs[0], reply_markup=yes_no_kb("panic"));  return PANIC_Q
-
-    if key == "pcptsd5":
-        context.user_data["pc"] = BinState(i=0, yes=0, qs=PC_PTSD5)
-        await update.message.reply_text(PC_PTSD5[0], reply_markup=yes_no_kb("pc"));  return PTSD_Q
-
-    # الاستبيانات الرقمية — أرسل السؤال الأول بأزرار أرقام
-    s_map = {"phq9":PHQ9,"gad7":GAD7,"minispin":MINISPIN,"tipi":TIPI,"isi7":ISI7,"pss10":PSS10,"who5":WHO5,"k10":K10}
-    s0 = s_map[key]
-    s = Survey(s0.id, s0.title, list(s0.items), s0.scale, s0.min_v, s0.max_v, list(s0.reverse))
-    context.user_data["s"] = s; context.user_data["s_i"] = 0
-    await update.message.reply_text(f"بدء **{s.title}**.", reply_markup=ReplyKeyboardRemove())
-    await ask_numeric_question(update.message.chat, s, 0)
-    return SURVEY
+    return await begin_test(update.message.chat, context, code)
 
 # اختبارات الشخصية (TIPI/SAPAS/MSI)
 async def pers_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t = update.message.text or ""
     if t == "◀️ رجوع":
         await update.message.reply_text("رجعناك للقائمة.", reply_markup=TOP_KB);  return MENU
-
-    if t == "SAPAS اضطراب شخصية":
-        context.user_data["bin"] = BinState(i=0, yes=0, qs=SAPAS)
-        await update.message.reply_text(SAPAS[0], reply_markup=yes_no_kb("bin"));  return SURVEY
-
-    if t == "MSI-BPD حدّية":
-        context.user_data["bin"] = BinState(i=0, yes=0, qs=MSI_BPD)
-        await update.message.reply_text(MSI_BPD[0], reply_markup=yes_no_kb("bin"));  return SURVEY
-
-    if t == "TIPI الخمسة الكبار":
-        s = Survey(TIPI.id, TIPI.title, list(TIPI.items), TIPI.scale, TIPI.min_v, TIPI.max_v, list(TIPI.reverse))
-        context.user_data["s"] = s; context.user_data["s_i"] = 0
-        await update.message.reply_text(f"بدء **{s.title}**.", reply_markup=ReplyKeyboardRemove())
-        await ask_numeric_question(update.message.chat, s, 0)
-        return SURVEY
-
-    await update.message.reply_text("اختر اختبار شخصية:", reply_markup=tests_personality_inline())
-    return MENU
+    code = TEST_BY_LABEL.get(t)
+    if code not in PERS_TESTS:
+        await update.message.reply_text("اختر اختبار شخصية:", reply_markup=tests_personality_inline())
+        return MENU
+    return await begin_test(update.message.chat, context, code)
 
 # تدفق الهلع (نص احتياطي لو كتب العميل بدلاً من الضغط)
 async def panic_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    st: BinState = context.user_data["panic"]; ans = (update.message.text or "").strip().lower()
+    ans = (update.message.text or "").strip().lower()
     if ans not in ("نعم","لا","yes","no"): 
         await update.message.reply_text("اضغط نعم/لا من الأزرار.", reply_markup=yes_no_kb("panic"));  return PANIC_Q
     return PANIC_Q  # الأزرار هي الأساس
 
 # تدفق PTSD (نص احتياطي)
 async def ptsd_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    st: BinState = context.user_data["pc"]; ans = (update.message.text or "").strip().lower()
+    ans = (update.message.text or "").strip().lower()
     if ans not in ("نعم","لا","yes","no"): 
         await update.message.reply_text("اضغط نعم/لا من الأزرار.", reply_markup=yes_no_kb("pc"));  return PTSD_Q
     return PTSD_Q
 
 # تدفق الاستبيانات الرقمية (نص احتياطي)
 async def survey_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    s: Survey = context.user_data["s"]; i = context.user_data["s_i"]
+    p = context.user_data.get("s")
+    if not isinstance(p, Progress):
+        await update.message.reply_text("لا توجد استبانة نشطة.", reply_markup=TOP_KB);  return MENU
+    if p.sid in BIN_TESTS:
+        await update.message.reply_text("اضغط نعم/لا من الأزرار.", reply_markup=yes_no_kb("bin"));  return SURVEY
+    s = p.survey
     await update.message.reply_text("اختر الرقم من الأزرار بالأسفل.", reply_markup=scale_kb(s.min_v, s.max_v))
     return SURVEY
 
+# ========== التخزين الدائم (SQLite WAL / Redis) ==========
+# user_data يُحمَّل لكل مستخدم عند أول تحديث له (لا عند الإقلاع)، والكتابات القذرة تُجمع
+# وتُكتب في معاملة واحدة كل PERSIST_FLUSH_SEC. الحالات (dataclasses) تُرمّز موضعيًا وبشكل مضغوط.
+PERSIST_TYPES = {c.__name__: c for c in (ThoughtRecord, ExposureState, Progress)}
+
+def _enc(o):
+    if isinstance(o, (bytes, bytearray)):
+        return {"$b": o.hex()}
+    if dataclasses.is_dataclass(o):
+        return {"$": type(o).__name__, "v": [_enc(getattr(o, f.name)) for f in dataclasses.fields(o)]}
+    if isinstance(o, dict):
+        return {k: _enc(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_enc(v) for v in o]
+    return o
+
+def _dec(o):
+    if isinstance(o, dict):
+        if "$b" in o:
+            return bytearray.fromhex(o["$b"])
+        if "$" in o and o["$"] in PERSIST_TYPES:
+            return PERSIST_TYPES[o["$"]](*[_dec(v) for v in o["v"]])
+        return {k: _dec(v) for k, v in o.items()}
+    if isinstance(o, list):
+        return [_dec(v) for v in o]
+    return o
+
+def pack_state(data: dict) -> bytes:
+    raw = json.dumps(_enc(data), ensure_ascii=False, separators=(",", ":")).encode()
+    return b"z" + zlib.compress(raw, 6) if len(raw) > 512 else b"j" + raw
+
+def unpack_state(blob: bytes) -> dict:
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return _dec(json.loads(raw))
+
+class BatchedPersistence(BasePersistence):
+    # أساس مشترك: تحميل كسول لكل مستخدم + تجميع الكتابات القذرة في دفعة واحدة.
+    # الواجهات الخلفية تنفّذ _read_user / _read_convs / _write.
+    def __init__(self, flush_sec: float = PERSIST_FLUSH_SEC):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_sec,
+        )
+        self._users: Dict[int, Optional[bytes]] = {}      # None = حذف
+        self._convs: Dict[Tuple[str, str], Optional[int]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._writing: Tuple[dict, dict] = ({}, {})      # الدفعة التي تُكتب الآن
+        self.loaded: set = set()
+        self.evicting: set = set()     # أُخرجوا من الذاكرة: drop_user_data القادم من PTB لا يمسّ سجلهم
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+
+    # --- تحميل كسول ---
+    async def load_user(self, user_id: int) -> dict:
+        self.loaded.add(user_id)
+        hit, blob = self._unflushed(0, user_id)
+        if not hit:
+            blob = await self._read_user(user_id)
+        return unpack_state(blob) if blob else {}
+
+    def forget(self, user_id: int):
+        # إخراج من الذاكرة لا حذف: عودته تعيد التحميل، ولا يُكتب {} فوق سجله
+        self.loaded.discard(user_id)
+        self.evicting.add(user_id)
+
+    def _unflushed(self, i: int, k):
+        # مستخدم أُخرج من الذاكرة ثم عاد قبل وصول كتابته للقرص: النسخة المعلّقة هي الأحدث
+        for buf in ((self._users, self._convs)[i], self._writing[i]):
+            if k in buf:
+                return True, buf[k]
+        return False, None
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_conversations(self, name: str) -> dict:
+        # الحالات صغيرة (رقم لكل محادثة) فتُحمَّل كلها عند الإقلاع وتبقى مقيمة؛ user_data وحده كسول
+        return {tuple(int(x) for x in k.split(":")): st for k, st in (await self._read_convs(name)).items()}
+
+    # --- كتابات مؤجلة ---
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if user_id in self.loaded:     # لا تكتب فوق سجل لم يُحمَّل بعد
+            self._users[user_id] = pack_state(data)
+            self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self.evicting:
+            self.evicting.discard(user_id)
+            return
+        self._users[user_id] = None
+        self._schedule()
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
+        self._convs[(name, ":".join(map(str, key)))] = new_state
+        self._schedule()
+
+    def _schedule(self):
+        # PTB يستدعي update_* لكل المفاتيح القذرة معًا؛ نجمعها في كتابة واحدة
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        fails = 0
+        while self._users or self._convs:
+            try:
+                await self._timed_write(*self._take())
+            except Exception as e:
+                # الدفعة أُعيدت للمخزن المؤقت: إعادة محاولة بعد مهلة، ثم تُترك للكتابة/الإغلاق التالي
+                fails += 1
+                log.warning("persistence: تعذّرت الكتابة (%d): %s", fails, e)
+                if fails >= 3:
+                    return
+                await asyncio.sleep(self.update_interval)
+
+    def _take(self):
+        users, convs = self._users, self._convs
+        self._users, self._convs = {}, {}
+        return users, convs
+
+    async def _timed_write(self, users, convs):
+        if not users and not convs:
+            return
+        t0 = time.perf_counter()
+        self._writing = (users, convs)
+        try:
+            await self._write(users, convs)
+        except BaseException:
+            # لا يضيع شيء: ما لم يُكتب يعود للمخزن المؤقت دون أن يغطي تعديلات أحدث وصلت أثناء الكتابة
+            for k, v in users.items():
+                self._users.setdefault(k, v)
+            for k, v in convs.items():
+                self._convs.setdefault(k, v)
+            raise
+        finally:
+            self._writing = ({}, {})
+        self.flushes += 1
+        self.last_flush_ms = (time.perf_counter() - t0) * 1000
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._timed_write(*self._take())
+
+    async def recipients(self, cursor: str, n: int) -> Tuple[List[int], str]:
+        # دفعة معرّفات + مؤشر الدفعة التالية ("" = انتهت) — للبث
+        raise NotImplementedError
+
+    async def count_users(self) -> Optional[int]:
+        return None
+
+    async def _read_user(self, user_id: int) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def _read_convs(self, name: str) -> Dict[str, int]:
+        raise NotImplementedError
+
+    async def _write(self, users: Dict[int, Optional[bytes]], convs: Dict[Tuple[str, str], Optional[int]]):
+        raise NotImplementedError
+
+    # --- غير مستخدمة في هذا البوت ---
+    async def get_chat_data(self): return {}
+    async def get_bot_data(self): return {}
+    async def get_callback_data(self): return None
+    async def update_chat_data(self, chat_id, data): pass
+    async def update_bot_data(self, data): pass
+    async def update_callback_data(self, data): pass
+    async def drop_chat_data(self, chat_id): pass
+    async def refresh_user_data(self, user_id, user_data): pass
+    async def refresh_chat_data(self, chat_id, chat_data): pass
+    async def refresh_bot_data(self, bot_data): pass
+
+def sqlite_connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+class SQLitePersistence(BatchedPersistence):
+    # ملف واحد في وضع WAL؛ يصلح أيضًا كمخزن مشترك لعدة عمليات على نفس الجهاز
+    def __init__(self, path: str, flush_sec: float = PERSIST_FLUSH_SEC):
+        super().__init__(flush_sec)
+        self.path = path
+        self._wlock = threading.Lock()
+        self._w = sqlite_connect(path)      # كاتب (خيط الخلفية)
+        self._r = sqlite_connect(path)      # قارئ (حلقة الأحداث) — WAL يسمح بالقراءة أثناء الكتابة
+        with self._wlock:
+            self._w.executescript(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, ts REAL);"
+                "CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state INTEGER,"
+                " PRIMARY KEY (name, key)) WITHOUT ROWID;"
+            )
+
+    async def _read_user(self, user_id: int) -> Optional[bytes]:
+        # استعلام بمفتاح أساسي (عشرات الميكروثانية) — أرخص من القفز لخيط آخر
+        row = self._r.execute("SELECT data FROM user_data WHERE user_id=?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def _read_convs(self, name: str) -> Dict[str, int]:
+        return dict(self._r.execute("SELECT key, state FROM conversations WHERE name=?", (name,)).fetchall())
+
+    async def recipients(self, cursor: str, n: int) -> Tuple[List[int], str]:
+        # ترقيم بالمفتاح (user_id > آخر معرّف): كل دفعة بحث واحد في الفهرس مهما بلغ الموضع
+        ids = [r[0] for r in self._r.execute("SELECT user_id FROM user_data WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                                             (int(cursor or -2**63), n))]
+        return ids, (str(ids[-1]) if len(ids) == n else "")
+
+    async def count_users(self) -> Optional[int]:
+        return await asyncio.to_thread(self._count_sync)   # مسح كامل للفهرس: خارج حلقة الأحداث
+
+    def _count_sync(self) -> int:
+        with self._wlock:
+            return self._w.execute("SELECT count(*) FROM user_data").fetchone()[0]
+
+    async def _write(self, users, convs):
+        await asyncio.to_thread(self._write_sync, users, convs)
+
+    def _write_sync(self, users: Dict[int, Optional[bytes]], convs: Dict[Tuple[str, str], Optional[int]]):
+        now = time.time()
+        with self._wlock:
+            db = self._w
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR REPLACE INTO user_data (user_id, data, ts) VALUES (?,?,?)",
+                               [(u, b, now) for u, b in users.items() if b is not None])
+                db.executemany("DELETE FROM user_data WHERE user_id=?", [(u,) for u, b in users.items() if b is None])
+                db.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?,?,?)",
+                               [(n, k, st) for (n, k), st in convs.items() if st is not None])
+                db.executemany("DELETE FROM conversations WHERE name=? AND key=?",
+                               [(n, k) for (n, k), st in convs.items() if st is None])
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")   # وإلا يبقى الاتصال داخل معاملة وتفشل كل BEGIN لاحقة
+                raise
+
+class RedisPersistence(BatchedPersistence):
+    # مخزن مشترك بين عدة عُقد (أي خادم يتكلم بروتوكول Redis)؛ يحتاج حزمة redis>=5
+    def __init__(self, url: str, flush_sec: float = PERSIST_FLUSH_SEC, prefix: str = "arabi"):
+        super().__init__(flush_sec)
+        import redis.asyncio as aioredis
+        self.r = aioredis.from_url(url)
+        self.prefix = prefix
+
+    async def _read_user(self, user_id: int) -> Optional[bytes]:
+        return await self.r.get(f"{self.prefix}:ud:{user_id}")
+
+    async def _read_convs(self, name: str) -> Dict[str, int]:
+        raw = await self.r.hgetall(f"{self.prefix}:conv:{name}")
+        return {k.decode(): int(v) for k, v in raw.items()}
+
+    async def recipients(self, cursor: str, n: int) -> Tuple[List[int], str]:
+        # SCAN بمؤشر قابل للاستئناف (قد يعيد مفتاحًا مرتين عند إعادة تحجيم الجدول)
+        cur, keys = await self.r.scan(int(cursor or 0), match=f"{self.prefix}:ud:*", count=n)
+        ids = [int(k.rsplit(b":", 1)[1]) for k in keys]
+        return ids, ("" if int(cur) == 0 else str(int(cur)))
+
+    async def _write(self, users, convs):
+        pipe = self.r.pipeline(transaction=False)
+        for u, b in users.items():
+            if b is None:
+                pipe.delete(f"{self.prefix}:ud:{u}")
+            else:
+                pipe.set(f"{self.prefix}:ud:{u}", b)
+        for (n, k), st in convs.items():
+            if st is None:
+                pipe.hdel(f"{self.prefix}:conv:{n}", k)
+            else:
+                pipe.hset(f"{self.prefix}:conv:{n}", k, st)
+        await pipe.execute()
+
+    async def flush(self) -> None:
+        await super().flush()
+        await self.r.aclose()
+
+async def load_user_state(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # يعمل قبل كل المعالجات: أول تحديث للمستخدم يجلب سجله من القرص
+    p = context.application.persistence
+    user = getattr(update, "effective_user", None)
+    if isinstance(p, BatchedPersistence) and user and user.id not in p.loaded:
+        context.user_data.update(await p.load_user(user.id))
+
+# ========== سجل الدرجات عبر الزمن ==========
+# صف لكل قياس (user_id, kind, ts بالملّي ثانية, value) مع فهرس (user_id, kind, ts): آخر N قياسات
+# لمستخدم ومقياس = بحث واحد في الفهرس مهما طال السجل. الإضافات تُجمع وتُكتب في معاملة واحدة
+# كل HISTORY_FLUSH_SEC من خيط خلفي، فلا تؤخر رسالة النتيجة.
+HISTORY_KINDS = {**TEST_LABELS, "suds": "SUDS التعرّض", "tr_before": "الشعور قبل سجل الأفكار",
+                 "tr_after": "الشعور بعد سجل الأفكار"}
+SPARK = "▁▂▃▄▅▆▇█"
+
+class ScoreHistory:
+    def __init__(self, path: str, flush_sec: float = HISTORY_FLUSH_SEC):
+        self.path, self.flush_sec = path, flush_sec
+        self._wlock = threading.Lock()
+        self._w = sqlite_connect(path)
+        # ":memory:" لا يُشارك بين اتصالين: اتصال واحد بقفل واحد
+        self._r, self._rlock = (self._w, self._wlock) if path == ":memory:" else (sqlite_connect(path), threading.Lock())
+        with self._wlock:
+            self._migrate()
+            # rowid لكل قياس: نتيجتان في نفس الميلي ثانية (تحديث مُعاد/نقرة مزدوجة) لا تستبدل إحداهما الأخرى
+            self._w.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, user_id INTEGER, kind TEXT,"
+                            " ts INTEGER, value REAL)")
+            self._w.execute("CREATE INDEX IF NOT EXISTS history_user ON history (user_id, kind, ts)")
+        self._buf: List[tuple] = []
+        self._writing: List[tuple] = []
+        self._task: Optional[asyncio.Task] = None
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+
+    # --- إضافة مؤجلة ---
+    def record(self, user_id: int, kind: str, value: float, ts: Optional[int] = None):
+        self._buf.append((user_id, kind, ts or int(time.time() * 1000), value))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def _migrate(self):
+        # الجدول القديم: مفتاح أساسي (user_id, kind, ts) WITHOUT ROWID — يُنسخ مرة واحدة للمخطط الجديد
+        row = self._w.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='history'").fetchone()
+        if not row or "WITHOUT ROWID" not in row[0].upper():
+            return
+        self._w.execute("BEGIN IMMEDIATE")
+        try:
+            self._w.execute("ALTER TABLE history RENAME TO history_v1")
+            self._w.execute("CREATE TABLE history (id INTEGER PRIMARY KEY, user_id INTEGER, kind TEXT, ts INTEGER, value REAL)")
+            self._w.execute("INSERT INTO history (user_id, kind, ts, value) SELECT user_id, kind, ts, value FROM history_v1")
+            self._w.execute("DROP TABLE history_v1")
+            self._w.execute("COMMIT")
+        except BaseException:
+            self._w.execute("ROLLBACK")
+            raise
+        log.info("history: نُقل الجدول إلى مخطط rowid")
+
+    async def _flush_later(self):
+        for _ in range(3):
+            await asyncio.sleep(self.flush_sec)
+            try:
+                await self.flush()
+                return
+            except Exception:
+                pass   # الصفوف أُعيدت للمخزن؛ محاولة أخرى بعد flush_sec
+
+    async def flush(self):
+        while self._buf:
+            rows, self._buf = self._buf, []
+            self._writing = rows
+            t0 = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write_sync, rows)
+            except BaseException as e:
+                self._buf[:0] = rows   # لا يضيع قياس: يُكتب مع الدفعة التالية
+                log.warning("history: تعذّرت كتابة %d صف: %r", len(rows), e)
+                raise
+            finally:
+                self._writing = []
+            self.rows_written += len(rows)
+            self.last_flush_ms = (time.perf_counter() - t0) * 1000
+
+    def _write_sync(self, rows: List[tuple]):
+        with self._wlock:
+            self._w.execute("BEGIN IMMEDIATE")
+            try:
+                self._w.executemany("INSERT INTO history (user_id, kind, ts, value) VALUES (?,?,?,?)", rows)
+                self._w.execute("COMMIT")
+            except BaseException:
+                self._w.execute("ROLLBACK")
+                raise
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            await self.flush()
+        except Exception:
+            log.error("history: %d قياس لم يُكتب عند الإغلاق", len(self._buf))
+
+    # --- قراءة (بحث بالفهرس على حلقة الأحداث؛ أرخص من القفز لخيط) ---
+    def _pending(self, user_id: int, kind: str) -> List[Tuple[int, float]]:
+        return [(ts, v) for u, k, ts, v in self._writing + self._buf if u == user_id and k == kind]
+
+    def series(self, user_id: int, kind: str, n: int = HISTORY_SHOW) -> List[Tuple[int, float]]:
+        # الأقدم أولًا: آخر n قياسات (المعلّق منها قبل الكتابة محسوب)
+        with self._rlock:
+            rows = self._r.execute("SELECT ts, value FROM history WHERE user_id=? AND kind=? ORDER BY ts DESC LIMIT ?",
+                                   (user_id, kind, n)).fetchall()
+        pend = self._pending(user_id, kind)
+        if pend:
+            rows = sorted(set(rows) | set(pend), reverse=True)[:n]
+        return rows[::-1]
+
+    def summary(self, user_id: int, kind: str) -> Tuple[int, Optional[Tuple[int, float]]]:
+        # (عدد القياسات، أول قياس)
+        with self._rlock:
+            n, = self._r.execute("SELECT COUNT(*) FROM history WHERE user_id=? AND kind=?", (user_id, kind)).fetchone()
+            first = self._r.execute("SELECT ts, value FROM history WHERE user_id=? AND kind=? ORDER BY ts LIMIT 1",
+                                    (user_id, kind)).fetchone()
+        pend = self._pending(user_id, kind)
+        if pend:
+            first = min(([first] if first else []) + pend)
+        return n + len(pend), first
+
+_HISTORY: Optional[ScoreHistory] = None
+
+def score_history() -> ScoreHistory:
+    global _HISTORY
+    if _HISTORY is None:
+        _HISTORY = ScoreHistory(HISTORY_DB or (DB_PATH if PERSIST else ":memory:"))
+    return _HISTORY
+
+def _num(x: float) -> str:
+    return str(int(x)) if float(x).is_integer() else f"{x:.1f}"
+
+def _delta(d: float) -> str:
+    return "=" if d == 0 else ("↑" if d > 0 else "↓") + _num(abs(d))
+
+def spark(vals: List[float]) -> str:
+    lo, hi = min(vals), max(vals)
+    return "".join(SPARK[round((v - lo) / (hi - lo) * 7) if hi > lo else 3] for v in vals)
+
+def history_text(h: ScoreHistory, user_id: int) -> str:
+    lines = []
+    for kind, label in HISTORY_KINDS.items():
+        rows = h.series(user_id, kind)
+        if not rows:
+            continue
+        vals = [v for _, v in rows]
+        n, (first_ts, first_v) = h.summary(user_id, kind)
+        band = SCORERS[kind].band(vals[-1]) if kind in SCORERS else ""
+        line = f"• **{label}**: {_num(vals[-1])}" + (f" ({band})" if band else "")
+        if len(vals) > 1:
+            line += f" | عن السابق {_delta(vals[-1] - vals[-2])}"
+        if n > 2:
+            line += f" | منذ {time.strftime('%Y-%m-%d', time.localtime(first_ts / 1000))} {_delta(vals[-1] - first_v)}"
+        lines.append(f"{line}\n  {spark(vals)}  ({n} قياس)")
+    return "📈 **تطوّر نتائجك**\n" + "\n".join(lines) if lines else ""
+
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = history_text(score_history(), update.effective_user.id)
+    await send_long(update.effective_chat, txt or "لا توجد قياسات بعد. أكمل اختبارًا أو تمرينًا وستظهر نتائجك هنا.")
+
+# ========== تذكيرات ومتابعة ==========
+# الفهرس الكامل في SQLite: (user_id, kind) مفتاح أساسي — تذكير واحد معلّق لكل نوع، فالإضافة والإلغاء
+# = كتابة صف واحد — وفهرس على due. في الذاكرة فقط نافذة REMIND_HORIZON القادمة: كومة (due, uid, kind)
+# + dict للصالح منها (إلغاء O(1) بحذف مؤجّل، إضافة O(log n)). ملايين التذكيرات البعيدة تبقى على القرص
+# وتُحمّل النافذة التالية قبل حلولها؛ بعد إعادة التشغيل تُحمّل من الفهرس نفسه.
+REMIND_TEXTS = {
+    "expo": "⏰ وقت جلسة تعرّض قصيرة: نفس الموقف 3–4/10، ابقَ حتى يهبط القلق للنصف بلا طمأنة.\n"
+            "بعدها: «العلاج السلوكي المعرفي (CBT) 💊» ← «التعرّض التدريجي» وسجّل درجتك.",
+    "ba":   "⏰ كيف سارت أنشطة اليوم؟ نفّذ ولو نشاطًا واحدًا 5–10 دقائق، وقيّم مزاجك قبل/بعد 0–10.",
+    "phq9": "⏰ حان موعد إعادة PHQ-9 — أعده من «الاختبارات النفسية 📝» لمتابعة التغيّر (/history).",
+    "gad7": "⏰ حان موعد إعادة GAD-7 — أعده من «الاختبارات النفسية 📝» لمتابعة التغيّر (/history).",
+}
+REMIND_OFF_HINT = "\n\nلإيقاف التذكيرات: /reminders off"
+
+def parse_quiet(spec: str) -> Optional[Tuple[int, int]]:
+    a, _, b = spec.partition("-")
+    return (int(a) % 24, int(b) % 24) if b else None
+
+REMIND_QUIET_H = parse_quiet(REMIND_QUIET)
+
+def after_quiet(ts: float) -> float:
+    # موعد يقع في ساعات الهدوء يُؤجّل إلى نهايتها
+    if REMIND_QUIET_H is None:
+        return ts
+    a, b = REMIND_QUIET_H
+    local = ts + REMIND_UTC_OFFSET * 3600
+    h = int(local // 3600 % 24)
+    quiet = (a <= h or h < b) if a > b else (a <= h < b)
+    if not quiet:
+        return ts
+    end = local - local % 86400 + b * 3600
+    if end <= local:
+        end += 86400
+    return end - REMIND_UTC_OFFSET * 3600
+
+class ReminderScheduler:
+    def __init__(self, path: str, batch: int = REMIND_BATCH, horizon: float = REMIND_HORIZON,
+                 flush_sec: float = HISTORY_FLUSH_SEC):
+        self.path, self.batch, self.horizon, self.flush_sec = path, batch, horizon, flush_sec
+        self._lock = threading.Lock()
+        self._db = sqlite_connect(path)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS reminders (user_id INTEGER, kind TEXT, due REAL, chat_id INTEGER,"
+                             " PRIMARY KEY (user_id, kind)) WITHOUT ROWID")
+            self._db.execute("CREATE INDEX IF NOT EXISTS reminders_due ON reminders (due)")
+        self.heap: List[Tuple[float, int, str]] = []
+        self.due: Dict[Tuple[int, str], Tuple[float, int]] = {}   # النافذة المحمّلة: المفتاح ← (due, chat)
+        self.loaded_until = 0.0          # كل تذكير موعده ≤ هذا موجود في due
+        self.shards: Optional[set] = None   # في وضع العمّال: أقسام هذا العامل فقط
+        self._ops: Dict[Tuple[int, str], Optional[Tuple[float, int]]] = {}   # كتابات معلّقة (None = حذف)
+        self._writing: Dict[Tuple[int, str], Optional[Tuple[float, int]]] = {}
+        self._touched: set = set()       # مفاتيح تغيّرت أثناء قراءة نافذة
+        self._inflight: Dict[Tuple[int, str], float] = {}   # قيد الإرسال: صفّه باقٍ على القرص حتى النجاح
+        self._tries: Dict[Tuple[int, str], int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self.sent = self.blocked = self.retried = self.failed = self.stale = 0
+        self.last_batch_ms = 0.0
+
+    # --- إضافة/إلغاء (على حلقة الأحداث، بلا I/O) ---
+    def schedule(self, user_id: int, chat_id: int, kind: str, due: float):
+        key = (user_id, kind)
+        self._inflight.pop(key, None)   # جدولة جديدة أثناء الإرسال: لا يحذفها نجاح القديم
+        self._tries.pop(key, None)
+        self._write(key, (due, chat_id))
+        if due <= self.loaded_until:
+            self.due[key] = (due, chat_id)
+            heapq.heappush(self.heap, (due, user_id, kind))
+            if self.heap[0][0] == due:
+                self._wake.set()
+        else:
+            self.due.pop(key, None)
+
+    def cancel(self, user_id: int, kind: Optional[str] = None):
+        for k in ([kind] if kind else REMIND_TEXTS):
+            self._write((user_id, k), None)
+            self.due.pop((user_id, k), None)
+            self._inflight.pop((user_id, k), None)
+            self._tries.pop((user_id, k), None)
+
+    def _write(self, key, val):
+        self._ops[key] = val
+        self._touched.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError:
+                pass   # خارج حلقة الأحداث (أدوات/قياس): flush() صراحةً
+
+    async def _flush_later(self):
+        for _ in range(3):
+            await asyncio.sleep(self.flush_sec)
+            try:
+                await self.flush()
+                return
+            except Exception:
+                pass   # العمليات أُعيدت للمعلّق؛ محاولة أخرى بعد flush_sec
+
+    async def flush(self):
+        while self._ops:
+            ops, self._ops = self._ops, {}
+            self._writing = ops
+            try:
+                await asyncio.to_thread(self._write_sync, ops)
+            except BaseException as e:
+                for key, v in ops.items():
+                    self._ops.setdefault(key, v)   # ما تغيّر بعدها أحدث
+                log.warning("reminders: تعذّرت كتابة %d عملية: %r", len(ops), e)
+                raise
+            finally:
+                self._writing = {}
+
+    def _write_sync(self, ops):
+        up = [(u, k, v[0], v[1]) for (u, k), v in ops.items() if v is not None]
+        rm = [key for key, v in ops.items() if v is None]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO reminders (user_id, kind, due, chat_id) VALUES (?,?,?,?)", up)
+                self._db.executemany("DELETE FROM reminders WHERE user_id=? AND kind=?", rm)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # --- نافذة الذاكرة ---
+    def _read_window(self, lo: float, hi: float) -> List[tuple]:
+        with self._lock:
+            return self._db.execute("SELECT user_id, kind, due, chat_id FROM reminders WHERE due > ? AND due <= ?",
+                                    (lo, hi)).fetchall()
+
+    async def refill(self, now: float):
+        lo, hi = self.loaded_until, now + self.horizon
+        self.loaded_until = hi   # ما يُضاف أثناء القراءة يدخل الذاكرة مباشرة
+        self._touched = set()
+        rows = await asyncio.to_thread(self._read_window, lo, hi)
+        for u, k, due, chat in rows:
+            key = (u, k)
+            # الكتابات المعلّقة أحدث من القرص
+            if key in self._touched or key in self._ops or key in self._writing:
+                continue
+            if self.shards is not None and u % SHARDS not in self.shards:
+                continue
+            self.due[key] = (due, chat)
+            heapq.heappush(self.heap, (due, u, k))
+        for key, v in {**self._writing, **self._ops}.items():   # معلّق لم يُكتب بعد ويقع في النافذة الجديدة
+            if v is not None and lo < v[0] <= hi and key not in self._touched:
+                self.due[key] = v
+                heapq.heappush(self.heap, (v[0], *key))
+        if len(self.heap) > 2 * len(self.due) + 1024:   # تنظيف المدخلات الملغاة
+            self.heap = [(d, u, k) for (u, k), (d, _) in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, now: float) -> List[Tuple[int, int, str, float]]:
+        out = []
+        while self.heap and self.heap[0][0] <= now and len(out) < self.batch:
+            due, u, k = heapq.heappop(self.heap)
+            cur = self.due.get((u, k))
+            if cur is None or cur[0] != due:
+                continue   # أُلغي أو أُعيدت جدولته
+            del self.due[(u, k)]
+            self._inflight[(u, k)] = due   # يُحذف من القرص بعد الإرسال فقط
+            out.append((u, cur[1], k, due))
+        return out
+
+    def _done(self, key, due: float):
+        if self._inflight.pop(key, None) == due:
+            self._tries.pop(key, None)
+            self._write(key, None)
+
+    def _retry(self, user_id: int, chat_id: int, kind: str, due: float) -> bool:
+        # True = أُعيدت جدولته؛ False = أُلغي أثناء الإرسال أو نفدت محاولاته (يُعدّ فشلًا هنا)
+        key = (user_id, kind)
+        if self._inflight.get(key) != due:
+            return False   # أُلغي أو أُعيدت جدولته أثناء الإرسال
+        n = self._tries.get(key, 0) + 1
+        if n > REMIND_RETRIES:
+            self._done(key, due)
+            self.failed += 1
+            M_REMIND.inc("failed")
+            return False
+        self.schedule(user_id, chat_id, kind, after_quiet(time.time() + REMIND_RETRY_SEC * 2 ** (n - 1)))
+        self._tries[key] = n
+        return True
+
+    # --- الإرسال ---
+    async def run(self, bot):
+        while True:
+            now = time.time()
+            if now + self.horizon / 2 >= self.loaded_until:
+                await self.refill(now)
+            batch = self.pop_due(now)
+            if batch:
+                t0 = time.perf_counter()
+                await asyncio.gather(*(self._send(bot, *r, now) for r in batch))
+                self.last_batch_ms = (time.perf_counter() - t0) * 1000
+                continue
+            nxt = min(self.heap[0][0] if self.heap else now + 60, self.loaded_until - self.horizon / 2, now + 60)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, nxt - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, bot, user_id: int, chat_id: int, kind: str, due: float, now: float):
+        if now - due > REMIND_STALE_SEC:
+            self._done((user_id, kind), due)
+            self.stale += 1
+            M_REMIND.inc("stale")
+            return
+        try:
+            await bot.send_message(chat_id, REMIND_TEXTS[kind] + REMIND_OFF_HINT)   # عبر OutboundLimiter
+        except Forbidden:
+            self.cancel(user_id)   # حظر البوت: لا تذكيرات بعد الآن
+            self.blocked += 1
+            M_REMIND.inc("blocked")
+        except asyncio.CancelledError:
+            self._retry(user_id, chat_id, kind, due)   # stop() أثناء الدفعة: يبقى مجدولًا
+            raise
+        except Exception as e:
+            if self._retry(user_id, chat_id, kind, due):
+                self.retried += 1
+                M_REMIND.inc("retry")
+                log.warning("reminder %s → %s فشل، سيُعاد: %s", kind, chat_id, e)
+            else:
+                log.warning("reminder %s → %s فشل دون إعادة: %s", kind, chat_id, e)
+        else:
+            self._done((user_id, kind), due)
+            self.sent += 1
+            M_REMIND.inc("sent")
+
+    def start(self, bot):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        try:
+            await self.flush()
+        except Exception:
+            log.error("reminders: %d عملية لم تُكتب عند الإيقاف", len(self._ops))
+
+    def pending(self, user_id: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            rows = dict(self._db.execute("SELECT kind, due FROM reminders WHERE user_id=?", (user_id,)).fetchall())
+        for (u, k), v in {**self._writing, **self._ops}.items():
+            if u == user_id:
+                if v is None:
+                    rows.pop(k, None)
+                else:
+                    rows[k] = v[0]
+        return sorted(rows.items(), key=lambda kv: kv[1])
+
+    def stats(self) -> str:
+        return (f"reminders window={len(self.due)} | sent={self.sent} | blocked={self.blocked} | "
+                f"retried={self.retried} | failed={self.failed} | stale={self.stale} | last batch={self.last_batch_ms:.0f}ms")
+
+def remind(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, delay: float):
+    r = context.bot_data.get("reminders")
+    if r is None or context.user_data.get("remind_off"):
+        return
+    r.schedule(update.effective_user.id, update.effective_chat.id, kind, after_quiet(time.time() + delay))
+
+REMIND_NAMES = {"expo": "جلسة التعرّض التالية", "ba": "متابعة التنشيط السلوكي",
+                "phq9": "إعادة PHQ-9", "gad7": "إعادة GAD-7"}
+
+async def cmd_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    r = context.bot_data.get("reminders")
+    uid = update.effective_user.id
+    arg = (context.args or [""])[0].lower()
+    if arg in ("off", "ايقاف", "إيقاف"):
+        context.user_data["remind_off"] = True
+        if r is not None:
+            r.cancel(uid)
+        await update.message.reply_text("🔕 أُوقفت التذكيرات. لإعادتها: /reminders on")
+        return
+    if arg in ("on", "تشغيل"):
+        context.user_data.pop("remind_off", None)
+        await update.message.reply_text("🔔 التذكيرات مفعّلة — ستصلك بعد التمارين والاختبارات.")
+        return
+    rows = r.pending(uid) if r is not None else []
+    if context.user_data.get("remind_off"):
+        await update.message.reply_text("🔕 التذكيرات موقوفة. لإعادتها: /reminders on")
+        return
+    if not rows:
+        await update.message.reply_text("لا توجد تذكيرات مجدولة — تُضاف تلقائيًا بعد التعرّض والتنشيط والاختبارات.")
+        return
+    off = REMIND_UTC_OFFSET * 3600
+    lines = [f"• {REMIND_NAMES.get(k, k)}: {time.strftime('%Y-%m-%d %H:%M', time.gmtime(due + off))}" for k, due in rows]
+    await update.message.reply_text("⏰ **تذكيراتك**\n" + "\n".join(lines) + REMIND_OFF_HINT)
+
+# ========== بث إداري ==========
+# المستلمون يُقرؤون دفعةً دفعة من تخزين الجلسات (لا قائمة كاملة في الذاكرة). بعد كل دفعة يُحفظ المؤشر
+# والعدادات في جدول broadcasts، فالانهيار يعيد إرسال دفعة واحدة على الأكثر. عقد إيجار (lease) يضمن أن
+# عاملًا واحدًا ينفّذ البث، ويستلمه غيره إن توقف. الإيقاع BROADCAST_RPS أقل من الحد العام، ويتوقف البث
+# مؤقتًا كلما انتظرت ردود تفاعلية في OutboundLimiter.
+class Broadcaster:
+    def __init__(self, path: str, source: BatchedPersistence, rps: float = 0.0, batch: int = BROADCAST_BATCH):
+        self.source, self.batch = source, batch
+        self.fixed = rps > 0
+        self.rps = rps or TG_GLOBAL_RPS * 0.8
+        self.bucket = TokenBucket(self.rps, 1)
+        self.owner = f"{os.getpid()}:{os.urandom(4).hex()}"
+        self._lock = threading.Lock()
+        self._db = sqlite_connect(path)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY, text TEXT NOT NULL,"
+                             " admin_chat INTEGER, status_msg INTEGER, cursor TEXT NOT NULL DEFAULT '',"
+                             " sent INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, total INTEGER,"
+                             " started REAL, finished REAL, state TEXT DEFAULT 'run', owner TEXT, lease REAL DEFAULT 0)")
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self.job: Optional[dict] = None
+        self.inflight = 0
+        self.rate = 0.0
+
+    def _sql(self, q: str, args=()) -> list:
+        with self._lock:
+            return self._db.execute(q, args).fetchall()
+
+    async def create(self, text: str, admin_chat: int, status_msg: int) -> int:
+        total = await self.source.count_users()
+        rows = await asyncio.to_thread(self._sql, "INSERT INTO broadcasts (text, admin_chat, status_msg, total, started)"
+                                       " VALUES (?,?,?,?,?) RETURNING id", (text, admin_chat, status_msg, total, time.time()))
+        self._wake.set()
+        return rows[0][0]
+
+    async def cancel(self, job_id: Optional[int] = None) -> int:
+        rows = await asyncio.to_thread(self._sql, "UPDATE broadcasts SET state='cancelled', finished=? WHERE state='run'"
+                                       " AND (? IS NULL OR id=?) RETURNING id", (time.time(), job_id, job_id))
+        return len(rows)
+
+    def _claim(self) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE broadcasts SET owner=?, lease=? WHERE id=(SELECT id FROM broadcasts"
+                             " WHERE state='run' AND (lease < ? OR owner=?) ORDER BY id LIMIT 1)",
+                             (self.owner, now + BROADCAST_LEASE_SEC, now, self.owner))
+            cur = self._db.execute("SELECT * FROM broadcasts WHERE owner=? AND state='run' ORDER BY id LIMIT 1", (self.owner,))
+            row = cur.fetchone()
+            return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+    def _checkpoint(self, job: dict) -> bool:
+        # يعيد False إن أُلغي البث أو استلمه عامل آخر
+        with self._lock:
+            return bool(self._db.execute(
+                "UPDATE broadcasts SET cursor=?, sent=?, blocked=?, failed=?, lease=?, state=?, finished=?"
+                " WHERE id=? AND owner=? AND state='run' RETURNING id",
+                (job["cursor"], job["sent"], job["blocked"], job["failed"], time.time() + BROADCAST_LEASE_SEC,
+                 job["state"], job["finished"], job["id"], self.owner)).fetchall())
+
+    def _renew(self, job: dict) -> bool:
+        # تمديد الإيجار دون تقديم المؤشر (أثناء إعادة المحاولة)
+        with self._lock:
+            return bool(self._db.execute("UPDATE broadcasts SET lease=? WHERE id=? AND owner=? AND state='run' RETURNING id",
+                                         (time.time() + BROADCAST_LEASE_SEC, job["id"], self.owner)).fetchall())
+
+    async def run(self, app: Application):
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), BROADCAST_LEASE_SEC / 2)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.job = job
+            try:
+                await self._run_job(app, job)
+            except Exception:
+                log.exception("broadcast #%s توقف", job["id"])
+                await asyncio.sleep(BROADCAST_LEASE_SEC / 2)
+            finally:
+                self.job = None
+
+    async def _run_job(self, app: Application, job: dict):
+        lim = app.bot.rate_limiter if isinstance(app.bot.rate_limiter, OutboundLimiter) else None
+        t0, done0, last = time.monotonic(), job["sent"] + job["blocked"] + job["failed"], 0.0
+        while True:
+            ids, nxt = await self.source.recipients(job["cursor"], self.batch)
+            wait, tries = 1.0, {}
+            while ids:
+                sends = []
+                for uid in ids:
+                    while lim is not None and lim.waiting > self.inflight:
+                        await asyncio.sleep(0.05)   # ردود تفاعلية تنتظر: تتقدّم على البث
+                    await self.bucket.take()
+                    sends.append(asyncio.ensure_future(self._send(app, job, uid)))
+                ok = await asyncio.gather(*sends)
+                # خطأ عابر (شبكة/RetryAfter): لا يتقدّم المؤشر قبل أن يصل كل من في الدفعة أو تنفد محاولاته
+                retry = []
+                for uid, done in zip(ids, ok):
+                    if done:
+                        continue
+                    tries[uid] = tries.get(uid, 0) + 1
+                    if tries[uid] < BROADCAST_RETRIES:
+                        retry.append(uid)
+                    else:
+                        job["failed"] += 1
+                        M_BCAST.inc("failed")
+                        log.warning("broadcast #%s → %s: فشل بعد %d محاولات", job["id"], uid, tries[uid])
+                ids = retry
+                if ids:
+                    log.warning("broadcast #%s: %d فشل عابر، إعادة بعد %.0f ث", job["id"], len(ids), wait)
+                    await asyncio.sleep(wait)
+                    wait = min(wait * 2, BROADCAST_LEASE_SEC / 4)
+                    if not await asyncio.to_thread(self._renew, job):
+                        await self._report(app, job, "⏹ أُلغي")
+                        return
+            job["cursor"] = nxt
+            if not nxt:
+                job["state"], job["finished"] = "done", time.time()
+            if not await asyncio.to_thread(self._checkpoint, job):
+                await self._report(app, job, "⏹ أُلغي")
+                return
+            self.rate = (job["sent"] + job["blocked"] + job["failed"] - done0) / max(1e-9, time.monotonic() - t0)
+            if not nxt:
+                await self._report(app, job, "✅ انتهى")
+                return
+            if time.monotonic() - last >= BROADCAST_REPORT_SEC:
+                last = time.monotonic()
+                await self._report(app, job, "📣 جارٍ")
+
+    async def _send(self, app: Application, job: dict, uid: int) -> bool:
+        # False = فشل عابر: يُعاد قبل نقطة الحفظ
+        self.inflight += 1
+        try:
+            await app.bot.send_message(uid, job["text"])
+            job["sent"] += 1
+            M_BCAST.inc("sent")
+        except (Forbidden, BadRequest) as e:
+            if isinstance(e, BadRequest) and "chat not found" not in str(e).lower():
+                job["failed"] += 1
+                M_BCAST.inc("failed")
+                return True
+            # حظر البوت أو حساب محذوف: فشل دائم — يُحذف من المستلمين ومن التذكيرات
+            job["blocked"] += 1
+            M_BCAST.inc("blocked")
+            self.source.evicting.discard(uid)   # حذف حقيقي حتى لو أُخرج من الذاكرة للتو
+            app.drop_user_data(uid)   # PTB يمرّرها للتخزين مع التحديث التالي
+            if "reminders" in app.bot_data:
+                app.bot_data["reminders"].cancel(uid)
+        except (NetworkError, RetryAfter, RuntimeError) as e:
+            # انقطاع/مهلة/RetryAfter بعد استنفاد المحاولات، أو عميل HTTP أُغلق أثناء الإيقاف
+            M_BCAST.inc("retry")
+            log.debug("broadcast → %s فشل عابر: %s", uid, e)
+            return False
+        except Exception as e:
+            job["failed"] += 1
+            M_BCAST.inc("failed")
+            log.warning("broadcast → %s فشل: %s", uid, e)
+        finally:
+            self.inflight -= 1
+        return True
+
+    def progress(self, job: dict) -> str:
+        done = job["sent"] + job["blocked"] + job["failed"]
+        eta = ""
+        if job["total"] and self.rate > 0 and job["state"] == "run":
+            eta = f" | المتبقي ~{max(0, job['total'] - done) / self.rate / 60:.0f} د"
+        return (f"بث #{job['id']}: {done}/{job['total'] or '?'} | أُرسل {job['sent']} | محظور/محذوف {job['blocked']}"
+                f" | فشل {job['failed']} | {self.rate:.1f} رسالة/ث{eta}")
+
+    async def _report(self, app: Application, job: dict, head: str):
+        txt = f"{head} {self.progress(job)}"
+        log.info("%s", txt)
+        try:
+            if job["status_msg"]:
+                await app.bot.edit_message_text(txt, chat_id=job["admin_chat"], message_id=job["status_msg"])
+        except BadRequest:
+            pass   # نفس النص أو رسالة محذوفة
+
+    def status(self) -> str:
+        if self.job is not None:
+            return self.progress(self.job)
+        rows = self._sql("SELECT id, state, sent, blocked, failed, total FROM broadcasts ORDER BY id DESC LIMIT 1")
+        if not rows:
+            return "لا يوجد بث."
+        i, state, sent, blocked, failed, total = rows[0]
+        return f"بث #{i} ({state}): أُرسل {sent} | محظور/محذوف {blocked} | فشل {failed} | من {total or '?'}"
+
+    def start(self, app: Application):
+        lim = app.bot.rate_limiter
+        if not self.fixed and isinstance(lim, OutboundLimiter):
+            self.rps = lim.glob.rate * 0.8   # نصيب هذه العملية من الحد العام (وضع العمّال)
+            self.bucket = TokenBucket(self.rps, 1)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run(app))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # تحرير الإيجار: عملية النشر التالية تستأنف فورًا من آخر نقطة حفظ
+        await asyncio.to_thread(self._sql, "UPDATE broadcasts SET lease=0 WHERE owner=? AND state='run'", (self.owner,))
+
+    def stats(self) -> str:
+        return "broadcast " + (self.progress(self.job) if self.job else "idle")
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    b: Optional[Broadcaster] = context.bot_data.get("broadcast")
+    if b is None:
+        await update.message.reply_text("البث يحتاج تخزينًا دائمًا للمستخدمين (PERSIST=1).")
+        return
+    parts = (update.message.text or "").split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text and update.message.reply_to_message:
+        text = update.message.reply_to_message.text or ""
+    if text in ("", "status", "حالة"):
+        await update.message.reply_text(b.status() + "\n/broadcast <نص> | status | cancel")
+        return
+    if text in ("cancel", "إلغاء"):
+        n = await b.cancel()
+        await update.message.reply_text(f"أُلغي {n} بث." if n else "لا يوجد بث جارٍ.")
+        return
+    msg = await update.message.reply_text("📣 بدء البث…")
+    job_id = await b.create(text, update.effective_chat.id, msg.message_id)
+    await msg.edit_text(f"📣 بث #{job_id} في الطابور — سيُحدَّث التقدم هنا كل {BROADCAST_REPORT_SEC:.0f}ث.")
+
+# ========== تصدير مُجهَّل (CSV / Parquet) ==========
+# سلسلة مولّدات: مؤشر SQLite (fetchmany) → دفعات مُجهَّلة → ملفات مقسّمة. الذاكرة ثابتة بحجم دفعة
+# واحدة مهما كبر السجل. المعرّف المستعار = HMAC-SHA256(EXPORT_KEY, user_id) — لا يُعكس بدون المفتاح،
+# وثابت بين التصديرات فتبقى السلاسل الزمنية لكل شخص مترابطة.
+EXPORT_COLS = ("pid", "instrument", "date", "ts", "value", "band")
+
+def pseudonym(user_id: int, key: bytes) -> str:
+    return hmac.new(key, str(user_id).encode(), hashlib.sha256).hexdigest()[:20]
+
+def day_ms(s: str) -> int:
+    return calendar.timegm(time.strptime(s, "%Y-%m-%d")) * 1000    # UTC مثل عمود date
+
+def export_rows(db_path: str, kinds: Optional[List[str]] = None, since: Optional[int] = None,
+                until: Optional[int] = None, key: str = "", batch: int = 50_000):
+    key = (key or EXPORT_KEY).encode()
+    if not key:
+        raise RuntimeError("EXPORT_KEY مطلوب لتجهيل المعرّفات")
+    where, params = [], []
+    if kinds:
+        where.append(f"kind IN ({','.join('?' * len(kinds))})"); params += kinds
+    if since is not None:
+        where.append("ts >= ?"); params.append(since)
+    if until is not None:
+        where.append("ts < ?"); params.append(until)
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)   # قارئ فقط؛ WAL يسمح بالكتابة أثناءه
+    db.execute("PRAGMA busy_timeout=5000")
+    try:
+        cur = db.execute("SELECT user_id, kind, ts, value FROM history"
+                         + (" WHERE " + " AND ".join(where) if where else ""), params)
+        pids, days = {}, {}
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            out = []
+            for u, kind, ts, v in rows:
+                pid = pids.get(u)
+                if pid is None:   # الصفوف بترتيب الإدراج: HMAC مرة لكل مستخدم ما بقي في الذاكرة المؤقتة
+                    if len(pids) >= 100_000:
+                        pids.clear()
+                    pid = pids[u] = pseudonym(u, key)
+                d = ts // 86_400_000
+                date = days.get(d) or days.setdefault(d, time.strftime("%Y-%m-%d", time.gmtime(d * 86_400)))
+                sc = SCORERS.get(kind)
+                out.append((pid, kind, date, ts, v, sc.band(v) if sc else ""))
+            yield out
+    finally:
+        db.close()
+
+class CsvParts:
+    # ملف جديد بعد chunk_rows صف أو عند تجاوز chunk_bytes (0 = بلا سقف حجم)؛ الحجم يُفحص كل STEP صف
+    STEP = 10_000
+
+    def __init__(self, out_dir: str, prefix: str, chunk_rows: int = EXPORT_CHUNK_ROWS, chunk_bytes: int = 0):
+        self.out_dir, self.prefix, self.chunk_rows, self.chunk_bytes = out_dir, prefix, chunk_rows, chunk_bytes
+        self.files: List[str] = []
+        self._f = self._w = None
+        self._left = 0
+
+    def _open(self):
+        self.close_part()
+        path = os.path.join(self.out_dir, f"{self.prefix}-{len(self.files) + 1:04d}.csv")
+        self._f = open(path, "w", newline="", encoding="utf-8")
+        self._w = csv.writer(self._f)
+        self._w.writerow(EXPORT_COLS)
+        self.files.append(path)
+        self._left = self.chunk_rows
+
+    def write(self, batch: List[tuple]):
+        while batch:
+            if self._left == 0:
+                self._open()
+            n = min(self._left, self.STEP)
+            part, batch = batch[:n], batch[n:]
+            self._w.writerows(part)
+            self._left -= len(part)
+            if self.chunk_bytes and self._size() >= self.chunk_bytes:
+                self._left = 0
+
+    def _size(self) -> int:
+        return self._f.tell()
+
+    def close_part(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def close(self) -> List[str]:
+        self.close_part()
+        return self.files
+
+class ParquetParts(CsvParts):
+    # يحتاج pyarrow (اختياري)؛ كل دفعة مجموعة صفوف (row group) مضغوطة بـ zstd
+    def __init__(self, out_dir: str, prefix: str, chunk_rows: int = EXPORT_CHUNK_ROWS, chunk_bytes: int = 0):
+        super().__init__(out_dir, prefix, chunk_rows, chunk_bytes)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa, self.pq = pa, pq
+        self.schema = pa.schema([("pid", pa.string()), ("instrument", pa.string()), ("date", pa.string()),
+                                 ("ts", pa.int64()), ("value", pa.float64()), ("band", pa.string())])
+
+    def _open(self):
+        self.close_part()
+        path = os.path.join(self.out_dir, f"{self.prefix}-{len(self.files) + 1:04d}.parquet")
+        self._f = self.pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.files.append(path)
+        self._left = self.chunk_rows
+
+    def write(self, batch: List[tuple]):
+        while batch:
+            if self._left == 0:
+                self._open()
+            part, batch = batch[:self._left], batch[self._left:]
+            cols = list(zip(*part))
+            self._f.write_table(self.pa.Table.from_arrays([self.pa.array(c, t.type) for c, t in zip(cols, self.schema)],
+                                                          schema=self.schema))
+            self._left -= len(part)
+            if self.chunk_bytes and self._size() >= self.chunk_bytes:
+                self._left = 0
+
+    def _size(self) -> int:
+        return os.path.getsize(self.files[-1])   # مجموعات الصفوف المكتملة (التذييل صغير)
+
+EXPORT_SINKS = {"csv": CsvParts, "parquet": ParquetParts}
+
+def run_export(db_path: str, out_dir: str, formats=("csv",), kinds=None, since=None, until=None,
+               chunk_rows: int = EXPORT_CHUNK_ROWS, key: str = "", chunk_bytes: int = 0) -> Tuple[int, List[str]]:
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = "scores-" + time.strftime("%Y%m%d-%H%M%S")
+    sinks = [EXPORT_SINKS[f](out_dir, prefix, chunk_rows, chunk_bytes) for f in formats]
+    n = 0
+    try:
+        for batch in export_rows(db_path, kinds, since, until, key):
+            for sink in sinks:
+                sink.write(batch)
+            n += len(batch)
+    finally:
+        files = [f for sink in sinks for f in sink.close()]
+    return n, files
+
+EXPORT_USAGE = "/export [phq9,gad7] [2025-01-01] [2025-06-30] [csv|parquet|csv,parquet]"
+
+def parse_export_args(words: List[str]) -> dict:
+    # /export [phq9,gad7] [2025-01-01] [2025-06-30] [csv|parquet|csv,parquet]
+    # اسم مقياس غير معروف يُرفض (ValueError) بدل أن يتّسع التصدير لكل المقاييس
+    opts: dict = {"formats": ("csv",)}
+    dates = [w for w in words if re.fullmatch(r"\d{4}-\d{2}-\d{2}", w)]
+    for w in words:
+        if w in dates:
+            continue
+        parts = w.lower().split(",")
+        if all(p in EXPORT_SINKS for p in parts):
+            opts["formats"] = tuple(parts)
+        else:
+            bad = [k for k in parts if k not in HISTORY_KINDS]
+            if bad:
+                raise ValueError(f"غير معروف: {', '.join(bad)}\nالمقاييس: {', '.join(HISTORY_KINDS)}\n{EXPORT_USAGE}")
+            opts["kinds"] = parts
+    if dates:
+        opts["since"] = day_ms(dates[0])
+    if len(dates) > 1:
+        opts["until"] = day_ms(dates[1]) + 86_400_000     # اليوم الأخير شامل
+    return opts
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    path = HISTORY_DB or (DB_PATH if PERSIST else "")
+    if not path or not EXPORT_KEY:
+        await update.message.reply_text("التصدير يحتاج تخزينًا دائمًا (PERSIST=1) و EXPORT_KEY.")
+        return
+    import tempfile, shutil
+    try:
+        opts = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    out = tempfile.mkdtemp(prefix="export-")
+    try:
+        await score_history().flush()
+        t0 = time.perf_counter()
+        n, files = await asyncio.to_thread(run_export, path, out, chunk_bytes=int(EXPORT_CHUNK_MB * 2**20), **opts)
+        await update.message.reply_text(f"تصدير {n} صف في {len(files)} ملف خلال {time.perf_counter() - t0:.1f}ث.")
+        failed = []
+        for f in files:
+            try:
+                with open(f, "rb") as fh:
+                    await update.effective_chat.send_document(fh, filename=os.path.basename(f))
+            except TelegramError as e:
+                log.warning("export: تعذّر إرسال %s: %s", f, e)
+                failed.append(os.path.basename(f))
+        if failed:
+            await update.message.reply_text(f"⚠️ تعذّر إرسال {len(failed)} من {len(files)} ملف:\n" + "\n".join(failed)
+                                            + "\nاستخدم التصدير من سطر الأوامر: python app.py export")
+    except ImportError:
+        await update.message.reply_text("Parquet يحتاج pyarrow: pip install pyarrow")
+    finally:
+        shutil.rmtree(out, ignore_errors=True)
+
+def export_cli(argv: List[str]):
+    import argparse
+    ap = argparse.ArgumentParser(prog="app.py export", description="تصدير مُجهَّل لسجل الدرجات")
+    ap.add_argument("--db", default=HISTORY_DB or DB_PATH)
+    ap.add_argument("--out", default="export")
+    ap.add_argument("--format", default="csv", help="csv | parquet | csv,parquet")
+    ap.add_argument("--kinds", default="", help="phq9,gad7,... (الافتراضي: الكل)")
+    ap.add_argument("--since", default="", help="YYYY-MM-DD")
+    ap.add_argument("--until", default="", help="YYYY-MM-DD (شامل)")
+    ap.add_argument("--chunk-rows", type=int, default=EXPORT_CHUNK_ROWS)
+    ap.add_argument("--chunk-mb", type=float, default=0, help="سقف حجم الملف (0 = بلا سقف)")
+    a = ap.parse_args(argv)
+    kinds = [k for k in a.kinds.split(",") if k] or None
+    bad = [k for k in kinds or () if k not in HISTORY_KINDS]
+    if bad:
+        ap.error(f"unknown --kinds {','.join(bad)} (valid: {','.join(HISTORY_KINDS)})")
+    t0 = time.perf_counter()
+    n, files = run_export(
+        a.db, a.out, tuple(a.format.split(",")), kinds,
+        day_ms(a.since) if a.since else None, day_ms(a.until) + 86_400_000 if a.until else None, a.chunk_rows,
+        chunk_bytes=int(a.chunk_mb * 2**20))
+    dt = time.perf_counter() - t0
+    print(f"{n} rows, {len(files)} files, {dt:.1f}s ({n / max(dt, 1e-9):,.0f} rows/s)")
+    for f in files:
+        print(f)
+
+# ========== دورة حياة الجلسات (مهلة خمول + سقف ذاكرة LRU) ==========
+# مهلة الحالة: خمول أطول من SESSION_TTL لحالتها يُغلق التمرين/الاختبار المفتوح ويعيده للقائمة.
+# الإقامة: الخامل أكثر من SESSION_IDLE_SEC، أو الأبرد فوق SESSION_MAX_USERS، يُخرج من الذاكرة؛
+# مع التخزين الدائم يُكتب أولًا ثم يُحمَّل كسولًا عند عودته، وبدونه تُفقد جلسته.
+TRANSIENT_KEYS = ("s", "tr", "expo", "ba_wait", "ai_hist", "ai_sum", "ai_mode")
+
+def parse_ttl(spec: str) -> Dict[int, float]:
+    by_name = {v: k for k, v in STATE_NAMES.items()}
+    pairs = dict(x.split("=", 1) for x in spec.replace(" ", "").split(",") if "=" in x)
+    default = float(pairs.pop("*", 0) or 0)
+    ttl = {st: default for st in STATE_NAMES if st != MENU}
+    for name, sec in pairs.items():
+        if name in by_name:
+            ttl[by_name[name]] = float(sec)
+        else:
+            log.warning("SESSION_TTL: حالة غير معروفة %s", name)
+    return {st: sec for st, sec in ttl.items() if sec > 0}
+
+class StaleSession(BaseHandler):
+    # أول معالج في كل حالة لها مهلة: يلتقط أول تحديث بعد انتهاء الجلسة فيعيد المحادثة للقائمة
+    def __init__(self, sessions: "SessionManager"):
+        super().__init__(sessions.resume)
+        self.sessions = sessions
+
+    def check_update(self, update: object) -> bool:
+        return isinstance(update, Update) and self.sessions.key(update) in self.sessions.stale
+
+class SessionManager:
+    # lru: user_id -> آخر chat_id (الأحدث في النهاية). آخر نشاط يُحفظ في user_data["t"] (ثوانٍ)
+    # فيبقى بعد الإخراج وإعادة التحميل، وتُطبَّق مهلة الحالة على العائد أيضًا.
+    # states: نسخة من حالة كل محادثة تُتابَع بتغليف معالجات المحادثة (ما تعيده هو الحالة التالية)،
+    # فلا نقرأ مخازن ConversationHandler الداخلية؛ وتغيير الحالة عند انتهاء المهلة يمر عبر StaleSession.
+    def __init__(self, app: Application, conv: ConversationHandler, max_users: int = SESSION_MAX_USERS,
+                 idle_sec: float = SESSION_IDLE_SEC, ttl: Optional[Dict[int, float]] = None,
+                 sweep_sec: float = SESSION_SWEEP_SEC, batch: int = 500):
+        self.app, self.conv = app, conv
+        self.max_users, self.idle_sec, self.sweep_sec, self.batch = max_users, idle_sec, sweep_sec, batch
+        self.ttl = parse_ttl(SESSION_TTL) if ttl is None else ttl
+        self.lru: OrderedDict = OrderedDict()
+        self.states: Dict[tuple, int] = {}
+        self.running: Dict[tuple, int] = {}     # معالجات محادثة قيد التنفيذ لكل مفتاح
+        self.stale: set = set()                  # انتهت مهلتها ولم يصل تحديثها التالي بعد
+        self.wake = asyncio.Event()
+        self.evicted = 0
+        self.expired = 0
+        self.last_sweep_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+        for st, hs in conv.states.items():
+            if st in STATE_NAMES and st != MENU:
+                hs.insert(0, StaleSession(self))
+        for hs in (conv.entry_points, conv.fallbacks, *conv.states.values()):
+            for h in hs:
+                h.callback = self.track(h.callback)
+
+    @staticmethod
+    def key(update: object) -> Optional[tuple]:
+        user, chat = getattr(update, "effective_user", None), getattr(update, "effective_chat", None)
+        return (chat.id, user.id) if user and chat else None
+
+    def track(self, cb):
+        async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            key = self.key(update)
+            self.stale.discard(key)
+            self.running[key] = self.running.get(key, 0) + 1
+            try:
+                st = await cb(update, context)
+            finally:
+                self.running[key] -= 1
+                if not self.running[key]:
+                    del self.running[key]
+            if st == ConversationHandler.END:
+                self.states.pop(key, None)
+            elif isinstance(st, int):
+                self.states[key] = st
+            return st
+        tracked.__name__ = getattr(cb, "__name__", "tracked")
+        return tracked
+
+    async def resume(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # التحديث الذي كشف انتهاء المهلة يُعالَج كأنه وصل في القائمة الرئيسية
+        for h in (*self.conv.states[MENU], *self.conv.fallbacks):
+            check = h.check_update(update)
+            if check is not None and check is not False:
+                st = await h.handle_update(update, context.application, check, context)
+                return MENU if st is None else st
+        return MENU
+
+    async def load(self):
+        # الحالات المحفوظة (نفس ما يحمّله PTB للمحادثة عبر get_conversations)
+        p = self.app.persistence
+        if p and self.conv.persistent:
+            self.states.update(await p.get_conversations(self.conv.name))
+
+    def busy(self, chat_id: int, key) -> bool:
+        proc = self.app.update_processor
+        return (chat_id in _FLIGHTS or (isinstance(proc, ChatOrderedProcessor) and chat_id in proc.chats)
+                or key in self.running)
+
+    async def touch(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        key = self.key(update)
+        if key is None:
+            return
+        uid, ud, now = key[1], context.user_data, time.time()
+        st = self.states.get(key)     # None = لم يبدأ محادثة (لا /start): لا نخترع له حالة
+        if ud.get("t") and st is not None and now - ud["t"] > self.ttl.get(st, float("inf")):
+            await self.expire(uid, key, st)
+        ud["t"] = int(now)
+        self.lru[uid] = key[0]
+        self.lru.move_to_end(uid)
+        if len(self.lru) > self.max_users * 1.1:
+            self.wake.set()
+
+    async def expire(self, uid: int, key, st: int):
+        ud = self.app.user_data.get(uid, {})
+        for k in TRANSIENT_KEYS:
+            ud.pop(k, None)
+        self.app.mark_data_for_update_persistence(user_ids=uid)
+        self.states[key] = MENU
+        self.stale.add(key)
+        p = self.app.persistence
+        if p and self.conv.persistent:
+            await p.update_conversation(self.conv.name, key, MENU)   # يصمد لإعادة التشغيل قبل عودته
+        self.expired += 1
+        M_EXPIRED.inc(STATE_NAMES.get(st, str(st)))
+
+    def evict(self, uid: int, chat_id: int, reason: str):
+        # user_data فقط يغادر الذاكرة؛ حالة المحادثة (رقم) تبقى مقيمة
+        self.lru.pop(uid, None)
+        p = self.app.persistence
+        if isinstance(p, BatchedPersistence):
+            p.forget(uid)
+        elif self.states.get((chat_id, uid), MENU) != MENU:
+            # بلا تخزين تضيع بيانات التمرين المفتوح: أول تحديث له يبدأ من القائمة
+            self.states[(chat_id, uid)] = MENU
+            self.stale.add((chat_id, uid))
+        self.app.drop_user_data(uid)
+        self.evicted += 1
+        M_EVICT.inc(reason)
+
+    async def sweep(self) -> int:
+        # من الأبرد للأحدث على دفعات مع تسليم الحلقة بينها؛ يتوقف عند أول مستخدم أحدث من كل المهل
+        t0, now, n = time.perf_counter(), time.time(), 0
+        horizon = min([self.idle_sec, *self.ttl.values()])
+        inf, users = float("inf"), self.app.user_data
+        snap = list(self.lru)
+        for i in range(0, len(snap), self.batch):
+            out, stop = [], False
+            for uid in snap[i:i + self.batch]:
+                chat_id = self.lru.get(uid)
+                if chat_id is None:
+                    continue
+                t = users.get(uid, {}).get("t", 0)
+                over = len(self.lru) - len(out) > self.max_users
+                if now - t < horizon and not over:
+                    stop = True
+                    break
+                key = (chat_id, uid)
+                if self.busy(chat_id, key):
+                    continue
+                st = self.states.get(key)
+                if st is not None and now - t > self.ttl.get(st, inf):
+                    await self.expire(uid, key, st)
+                if now - t > self.idle_sec or over:
+                    out.append((uid, chat_id, t, "idle" if now - t > self.idle_sec else "cap"))
+            if out and self.app.persistence:
+                await self.app.update_persistence()    # يسلّم user_data والحالات للدفعة قبل الإخراج
+            for uid, chat_id, t, reason in out:
+                if users.get(uid, {}).get("t", 0) == t and not self.busy(chat_id, (chat_id, uid)):
+                    self.evict(uid, chat_id, reason)
+                    n += 1
+            await asyncio.sleep(0)
+            if stop:
+                break
+        self.last_sweep_ms = (time.perf_counter() - t0) * 1000
+        return n
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.sweep_sec)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.exception("session sweep: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> str:
+        return (f"sessions resident={len(self.lru)}/{self.max_users} | evicted={self.evicted} | "
+                f"expired={self.expired} | last sweep={self.last_sweep_ms:.1f}ms")
+
+# ========== معالجة متزامنة مع ترتيب لكل محادثة ==========
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    # محادثات مختلفة تُعالج بالتوازي (حتى UPDATE_CONCURRENCY)، وتحديثات المحادثة الواحدة بالترتيب
+    # الصارم (TH_SITU→TH_EMO، SURVEY...). الحد العام يُطبَّق بعد قفل المحادثة حتى لا يحجز
+    # تحديثٌ ينتظر دوره مقعدًا من السعة.
+    def __init__(self, max_concurrent: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates=2**20)
+        self.limit = max_concurrent
+        self.sem = asyncio.Semaphore(max_concurrent)
+        self.chats: Dict[int, list] = {}     # chat_id -> [Lock, عمق الطابور]
+        self.active = 0
+        self.processed = 0
+        self.max_depth = 0
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.effective_user.id if update.effective_user else None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.chat_key(update)
+        if key is None:
+            async with self.sem:
+                await coroutine
+            return
+        slot = self.chats.get(key)
+        if slot is None:
+            slot = self.chats[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        self.max_depth = max(self.max_depth, slot[1])
+        try:
+            async with slot[0]:
+                async with self.sem:
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self.chats[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def depths(self) -> Dict[int, int]:
+        return {k: v[1] for k, v in self.chats.items()}
+
+    def stats(self) -> str:
+        d = list(self.depths().values())
+        backlog = sum(x - 1 for x in d)
+        return (f"updates active={self.active}/{self.limit} | processed={self.processed} | "
+                f"chats busy={len(d)} | queued behind own chat={backlog} | "
+                f"depth max now={max(d, default=0)} / ever={self.max_depth}")
+
 # ========== سقوط عام ==========
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("اختر من الأزرار أو اكتب /help.", reply_markup=TOP_KB)
     return MENU
 
 # ========== ربط وتشغيل ==========
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+async def on_startup(app: Application):
+    # التسخين في الخلفية: أول تحديث (طلب الإيقاظ) لا ينتظر مصافحة TLS مع مزوّد AI
+    app.bot_data["warmup"] = asyncio.get_running_loop().create_task(ai_warmup())
+    if "sessions" in app.bot_data:
+        await app.bot_data["sessions"].load()
+        app.bot_data["sessions"].start()
+    if "reminders" in app.bot_data:
+        app.bot_data["reminders"].start(app.bot)
+    if "broadcast" in app.bot_data:
+        app.bot_data["broadcast"].start(app)
+
+async def on_stop(app: Application):
+    # post_stop: قبل Application.shutdown — عميل HTTP للبوت ما زال مفتوحًا، والحفظ النهائي للحالة لم يحدث بعد
+    warm = app.bot_data.pop("warmup", None)
+    if warm is not None and not warm.done():
+        warm.cancel()
+    if "broadcast" in app.bot_data:
+        await app.bot_data["broadcast"].stop()
+    if "reminders" in app.bot_data:
+        await app.bot_data["reminders"].stop()
+    if "sessions" in app.bot_data:
+        await app.bot_data["sessions"].stop()
+
+async def on_shutdown(app: Application):
+    if _HISTORY is not None:
+        await _HISTORY.close()
+    await AI_CACHE.flush()
+    await ai_close()
+
+def make_persistence() -> Optional[BatchedPersistence]:
+    if not PERSIST:
+        return None
+    return RedisPersistence(REDIS_URL) if REDIS_URL else SQLitePersistence(DB_PATH)
+
+def bot_builder():
+    builder = Application.builder().token(BOT_TOKEN)
+    if TG_API_URL:
+        builder = builder.base_url(f"{TG_API_URL}/bot").base_file_url(f"{TG_API_URL}/file/bot")
+    return builder
+
+def build_app(request=None, updater: bool = True) -> Application:
+    builder = (
+        bot_builder()
+        .concurrent_updates(ChatOrderedProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if METRICS_ON:
+        builder = builder.request(MeteredRequest(request or HTTPXRequest(connection_pool_size=256)))
+    elif request is not None:
+        builder = builder.request(request)
+    if not updater:
+        builder = builder.updater(None)
+    if TG_RATE_LIMIT:
+        builder = builder.rate_limiter(OutboundLimiter())
+    persistence = make_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    app = builder.build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", cmd_start)],
@@ -940,33 +4029,304 @@ def main():
                 CallbackQueryHandler(bin_ans_cb, pattern=r"^bin:(yes|no)$"),
             ],
 
+            # ai_chat_flow يسلّم الطلب لمهمة ChatFlight ويعود: الرسائل أثناء انتظار AI تُدمج بدل أن تصطف خلفه
             AI_CHAT:[MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat_flow)],
         },
         fallbacks=[MessageHandler(filters.ALL, fallback)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="main",
+        persistent=PERSIST,
     )
 
+    if PERSIST:
+        app.add_handler(TypeHandler(Update, load_user_state), group=-100)
+    sessions = app.bot_data["sessions"] = SessionManager(app, conv)
+    if REMINDERS:
+        app.bot_data["reminders"] = ReminderScheduler(REMIND_DB or (DB_PATH if PERSIST else ":memory:"))
+    if isinstance(app.persistence, BatchedPersistence):
+        app.bot_data["broadcast"] = Broadcaster(BROADCAST_DB or DB_PATH, app.persistence, BROADCAST_RPS)
+    app.add_handler(TypeHandler(Update, sessions.touch), group=-99)
+
     # سجّل الأوامر فقط خارج المحادثة
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, crisis_guard), group=-1)
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("ping", cmd_ping))
     app.add_handler(CommandHandler("version", cmd_version))
     app.add_handler(CommandHandler("ai_diag", cmd_ai_diag))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("history", cmd_history))
+    app.add_handler(CommandHandler("reminders", cmd_reminders))
+    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    app.add_handler(CommandHandler("export", cmd_export))
     app.add_handler(conv)
+    if METRICS_ON:
+        instrument_app(app)
+    return app
 
+def run_updater(build):
+    # build يبني Application جديدًا: تطبيق بلغ shutdown لا يُعاد تشغيله، فالتحويل إلى polling يبدأ بنسخة جديدة
     if PUBLIC_URL:
         try:
-            app.run_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=f"{BOT_TOKEN}",
-                webhook_url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
-                drop_pending_updates=True
-            )
+            if METRICS_ON:
+                asyncio.run(serve_webhook(build()))
+            else:
+                build().run_webhook(
+                    listen="0.0.0.0",
+                    port=PORT,
+                    url_path=f"{BOT_TOKEN}",
+                    webhook_url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
+                )
+            return
         except Exception as e:
             log.error("Webhook فشل (%s) — التحويل إلى polling.", e)
-            app.run_polling(drop_pending_updates=True)
+            METRICS.collectors.clear()   # مجمّعات التطبيق السابق
+    app = build()
+    if METRICS_ON and METRICS_PORT:
+        base = app.post_init
+
+        async def post_init(a: Application):
+            await base(a)
+            metrics_web().listen(METRICS_PORT)
+            log.info("metrics على المنفذ %d", METRICS_PORT)
+        app.post_init = post_init
+    app.run_polling(drop_pending_updates=True)
+
+async def serve_webhook(app: Application):
+    # ويبهوك بخادم tornado خاص حتى يُخدم /metrics على المنفذ نفسه
+    import signal
+    import tornado.web
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+    # المنفذ يُفتح قبل getMe/setWebhook: طلب الإيقاظ يُقبل فورًا ويُعالَج فور جاهزية التطبيق
+    server = metrics_web([(rf"/{re.escape(BOT_TOKEN)}", WebhookHandler)]).listen(PORT, address="0.0.0.0")
+    log.info("webhook + /metrics على المنفذ %d", PORT)
+    try:
+        async with app:
+            await on_startup(app)
+            await app.start()
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            hook = loop.create_task(ensure_webhook(app))
+            # تعذّر تسجيل الويبهوك: لن تصل تحديثات، فنغلق ونترك run_updater يتحوّل إلى polling
+            hook.add_done_callback(lambda t: t.cancelled() or t.exception() is None or stop.set())
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            try:
+                await stop.wait()
+            finally:
+                hook.cancel()
+                server.stop()
+                await app.stop()
+                await on_stop(app)
+        await on_shutdown(app)
+        if hook.done() and not hook.cancelled() and hook.exception() is not None:
+            raise hook.exception()
+    except BaseException:
+        server.stop()   # فشل التهيئة (توكن خاطئ/شبكة) قبل الوصول للحلقة
+        raise
+
+async def ensure_webhook(app: Application):
+    # لا نعيد الضبط إن كان العنوان مسجّلًا، ولا نُسقط المعلّق: رسالة من أيقظ الخدمة تبقى
+    url = f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}"
+    if (await app.bot.get_webhook_info()).url != url:
+        await app.bot.set_webhook(url)
+
+# ========== تشغيل متعدد العمليات/العُقد ==========
+# عملية استقبال (ingress) تجلب التحديثات وتوزّعها حسب chat_id على أقسام (shards)؛ كل قسم
+# يستهلكه عامل واحد فيبقى ترتيب المحادثة محفوظًا بينما تتوزع المحادثات المختلفة على الأنوية.
+# الحالة المشتركة في PERSIST (SQLite WAL على نفس الجهاز، أو REDIS_URL عبر العُقد).
+WORKERS       = int(os.getenv("WORKERS", "1"))                    # عمليات عاملة على هذه العقدة
+SHARDS        = int(os.getenv("SHARDS", "0") or 0) or WORKERS     # إجمالي الأقسام عبر كل العُقد
+NODE_ROLE     = os.getenv("NODE_ROLE", "all")                     # all | ingress | worker
+WORKER_SHARDS = os.getenv("WORKER_SHARDS", "")                    # مثال "0-3" أو "4,5" (الافتراضي كل الأقسام)
+WORKER_STOP_SEC = float(os.getenv("WORKER_STOP_SEC", "30"))       # مهلة إغلاق العمّال (حفظ الحالة) قبل إنهائهم قسرًا
+BUS_IDLE = object()   # bus.get بلا تحديث خلال المهلة (ليس إشارة إيقاف)
+
+def shard_of(update: Update, shards: int = 0) -> int:
+    chat = update.effective_chat
+    user = update.effective_user
+    key = chat.id if chat else (user.id if user else 0)
+    return key % (shards or SHARDS)
+
+def parse_shards(spec: str, total: int) -> List[int]:
+    if not spec:
+        return list(range(total))
+    out: List[int] = []
+    for part in spec.split(","):
+        a, _, b = part.strip().partition("-")
+        out += range(int(a), int(b or a) + 1)
+    return out
+
+class LocalBus:
+    # طوابير multiprocessing لكل قسم — عقدة واحدة
+    def __init__(self, shards: int):
+        import multiprocessing as mp
+        self.qs = [mp.Queue() for _ in range(shards)]
+
+    async def put(self, shard: int, raw: Optional[dict]):
+        self.qs[shard].put(raw)
+
+    async def get(self, shards: List[int], timeout: float = 1.0):
+        # كل عامل محلي يملك قسمًا واحدًا؛ المهلة تُبقي الخيط قصير العمر فيُلاحَظ SIGTERM
+        import queue
+        try:
+            return await asyncio.to_thread(self.qs[shards[0]].get, True, timeout)
+        except queue.Empty:
+            return BUS_IDLE
+
+class RedisBus:
+    # قوائم Redis لكل قسم — عدة عُقد تستهلك أقسامًا مختلفة (BRPOP على عدة مفاتيح)
+    def __init__(self, url: str, prefix: str = "arabi"):
+        self.url, self.prefix = url, prefix
+        self._r = None
+
+    def _redis(self):
+        if self._r is None:
+            import redis.asyncio as aioredis
+            self._r = aioredis.from_url(self.url)
+        return self._r
+
+    async def put(self, shard: int, raw: Optional[dict]):
+        await self._redis().lpush(f"{self.prefix}:upd:{shard}", json.dumps(raw))
+
+    async def get(self, shards: List[int], timeout: float = 1.0):
+        got = await self._redis().brpop([f"{self.prefix}:upd:{s}" for s in shards], timeout=max(1, int(timeout)))
+        return BUS_IDLE if got is None else json.loads(got[1])
+
+def build_ingress(bus, request=None) -> Application:
+    builder = bot_builder()
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    ingress = builder.build()
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await bus.put(shard_of(update), update.to_dict())
+
+    ingress.add_handler(TypeHandler(Update, forward))
+    return ingress
+
+def run_worker(shards: List[int], bus, request_factory=None, setup=None):
+    asyncio.run(worker_main(shards, bus, request_factory() if request_factory else None, setup))
+
+async def worker_main(shards: List[int], bus, request=None, setup=None):
+    app = build_app(request=request, updater=False)
+    if isinstance(app.bot.rate_limiter, OutboundLimiter):
+        app.bot.rate_limiter.share(len(shards) / SHARDS)
+    if "reminders" in app.bot_data:
+        app.bot_data["reminders"].shards = set(shards)   # كل عامل يرسل تذكيرات مستخدمي أقسامه فقط
+    if setup is not None:
+        setup(app)
+    async with app:
+        await on_startup(app)
+        await app.start()
+        log.info("worker %d يخدم الأقسام %s", os.getpid(), shards)
+        if METRICS_ON and METRICS_PORT:
+            port = METRICS_PORT + 1 + min(shards)   # منفذ لكل عامل: METRICS_PORT+1+أول قسم يخدمه
+            try:
+                metrics_web().listen(port)
+            except OSError as e:
+                log.warning("metrics port %d: %s", port, e)
+        # SIGTERM/SIGINT للعامل نفسه (إعادة نشر، أو إيقاف مجموعة العمليات): إنهاء منظّم لا قتل
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        import signal
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            while not stop.is_set():
+                raw = await bus.get(shards)
+                if raw is BUS_IDLE:
+                    continue
+                if raw is None:       # إشارة إيقاف من الاستقبال
+                    break
+                await app.update_queue.put(Update.de_json(raw, app.bot))
+            while not app.update_queue.empty():
+                await asyncio.sleep(0.01)
+        finally:
+            await app.stop()
+            await on_stop(app)
+    await on_shutdown(app)
+
+def spawn_workers(bus, shards: List[int], workers: int, request_factory=None, setup=None) -> list:
+    import multiprocessing as mp
+    procs = []
+    for w in range(workers):
+        mine = shards[w::workers]
+        if not mine:
+            continue
+        if isinstance(bus, LocalBus):
+            mine = mine[:1]
+        pr = mp.Process(target=run_worker, args=(mine, bus, request_factory, setup), daemon=True)
+        pr.shards = mine
+        pr.start()
+        procs.append(pr)
+    return procs
+
+def run_sharded():
+    bus = RedisBus(REDIS_URL) if REDIS_URL else LocalBus(SHARDS)
+    procs = []
+    if NODE_ROLE in ("all", "worker"):
+        shards = parse_shards(WORKER_SHARDS, SHARDS)
+        workers = WORKERS if REDIS_URL else len(shards)
+        procs = spawn_workers(bus, shards, workers)
+    if NODE_ROLE in ("all", "ingress"):
+        run_updater(lambda: build_ingress(bus))
+        stop_workers(bus, procs)
+    else:
+        # عقدة عمّال فقط: SIGTERM/SIGINT للأب يُمرَّر للعمّال ليُغلقوا بانتظام
+        import signal
+        stopping = []
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stopping.append(1))
+        while not stopping and any(pr.is_alive() for pr in procs):
+            time.sleep(0.5)
+        for pr in procs:
+            pr.terminate()
+    join_workers(procs)
+
+def stop_workers(bus, procs: list):
+    # توقف الاستقبال. LocalBus: إشارة إيقاف خلف آخر تحديث في طابور كل عامل، فيُعالج ما وصل ثم يحفظ حالته.
+    # RedisBus: SIGTERM مباشرة — ما بقي في القوائم ينتظر العامل التالي على نفس القسم ولا يضيع.
+    if isinstance(bus, LocalBus):
+        async def sentinels():
+            for pr in procs:
+                await bus.put(pr.shards[0], None)
+        asyncio.run(sentinels())
+    else:
+        for pr in procs:
+            pr.terminate()
+
+def join_workers(procs: list):
+    deadline = time.monotonic() + WORKER_STOP_SEC
+    for pr in procs:
+        while pr.is_alive() and time.monotonic() < deadline:
+            pr.join(0.5)
+        if pr.is_alive():
+            log.warning("worker %s لم يتوقف خلال %.0fث — إنهاء", pr.pid, WORKER_STOP_SEC)
+            pr.terminate()
+            pr.join(5)
+
+def main():
+    if sys.argv[1:2] == ["export"]:
+        export_cli(sys.argv[2:])
+        return
+    if not BOT_TOKEN:
+        raise RuntimeError("يرجى ضبط TELEGRAM_BOT_TOKEN")
+    if WORKERS > 1 or NODE_ROLE != "all":
+        run_sharded()
     else:
-        app.run_polling(drop_pending_updates=True)
+        run_updater(build_app)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1356 @@
+# bench.py — قياسات أداء عربي سايكو (بدون شبكة افتراضيًا)
+# الاستخدام: python bench.py <benchmark> [--json]
+
+import os, sys, time, json, argparse, asyncio, logging, warnings
+from collections import Counter
+from typing import Dict, List, Tuple
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("PERSIST", "0")
+import app  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+from telegram.warnings import PTBUserWarning  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+warnings.filterwarnings("ignore", category=PTBUserWarning)
+
+
+def report(name: str, rows: list, as_json: bool, meta: dict = None):
+    if as_json:
+        out = {"bench": name, "rows": rows}
+        if meta:
+            out["meta"] = meta
+        print(json.dumps(out, ensure_ascii=False))
+        return
+    print(f"== {name} ==")
+    for k, v in (meta or {}).items():
+        print(f"{k} = {v:.3f}" if isinstance(v, float) else f"{k} = {v}")
+    if not rows:
+        return
+    cols = list(rows[0].keys())
+    print("\t".join(cols))
+    for r in rows:
+        print("\t".join(f"{v:.3f}" if isinstance(v, float) else str(v) for v in r.values()))
+
+
+# ========== نقل Bot API وهمي وتحديثات مصطنعة ==========
+class FakeTelegram(BaseRequest):
+    # يرد على طلبات Bot API محليًا (بدون شبكة)، مع زمن اختياري لكل طلب
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._mid = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Arabi", "username": "arabi_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._mid += 1
+            result = {"message_id": int(params.get("message_id") or self._mid), "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                      "text": params.get("text", "")}
+        elif endpoint == "getUpdates":
+            result = []
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+_uid = 0
+
+
+def text_update(chat_id: int, text: str) -> dict:
+    global _uid
+    _uid += 1
+    msg = {"message_id": _uid, "date": int(time.time()), "text": text,
+           "chat": {"id": chat_id, "type": "private"},
+           "from": {"id": chat_id, "is_bot": False, "first_name": "u"}}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": _uid, "message": msg}
+
+
+def callback_update(chat_id: int, data: str, message_id: int = 1) -> dict:
+    global _uid
+    _uid += 1
+    return {"update_id": _uid, "callback_query": {
+        "id": str(_uid), "chat_instance": str(chat_id), "data": data,
+        "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+        "message": {"message_id": message_id, "date": int(time.time()), "text": "q",
+                    "chat": {"id": chat_id, "type": "private"}}}}
+
+
+# ========== ذاكرة المحادثة: نافذة 20 رسالة مقابل ميزانية التوكنات ==========
+USER_MSG = "أشعر بقلق مستمر منذ شهرين خصوصًا قبل النوم ولا أستطيع التركيز في العمل، ماذا أفعل؟"
+REPLY = ("هذه خطوات عملية تساعدك على تنظيم القلق قبل النوم وتحسين التركيز خلال اليوم. " * 12).strip()
+SUMMARY = ("المستخدم يعاني قلقًا منذ شهرين يشتد ليلًا ويؤثر على التركيز؛ اتُّفق على تنفس 4-7-8 وسجل أفكار. " * 3).strip()
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+def bench_memory(args):
+    turns = args.turns
+    fixed, ud = [], {}
+    rows = []
+    for t in range(1, turns + 1):
+        # النافذة الثابتة القديمة: آخر 20 رسالة خام
+        win_fixed = fixed[-20:]
+        t0 = time.perf_counter()
+        body_fixed = json.dumps(app.ai_payload(app.ai_messages(USER_MSG, win_fixed, False)), ensure_ascii=False)
+        enc_fixed = time.perf_counter() - t0
+        fixed += [{"role": "user", "content": USER_MSG}, {"role": "assistant", "content": REPLY}]
+
+        # مدير الذاكرة: ملخص + أحدث ما تسعه الميزانية (التلخيص يحاكى بنص ثابت)
+        t0 = time.perf_counter()
+        win = app.memory_window(ud)
+        body_mem = json.dumps(app.ai_payload(app.ai_messages(USER_MSG, win, False)), ensure_ascii=False)
+        enc_mem = time.perf_counter() - t0
+        hist = ud.setdefault("ai_hist", [])
+        hist += [{"role": "user", "content": USER_MSG}, {"role": "assistant", "content": REPLY}]
+        if app.hist_tokens(hist) > app.AI_SUMMARY_TRIGGER and len(hist) > app.AI_KEEP_RECENT:
+            del hist[:len(hist) - app.AI_KEEP_RECENT]
+            ud["ai_sum"] = SUMMARY
+
+        rows.append({
+            "turn": t,
+            "fixed_bytes": len(body_fixed.encode()), "fixed_tokens": app.count_tokens(body_fixed),
+            "budget_bytes": len(body_mem.encode()), "budget_tokens": app.count_tokens(body_mem),
+            "fixed_build_ms": enc_fixed * 1000, "budget_build_ms": enc_mem * 1000,
+        })
+    if args.live and app.ai_enabled():
+        asyncio.run(_memory_live(rows))
+    report("memory", rows, args.json)
+
+
+async def _memory_live(rows):
+    # زمن الاستجابة الفعلي لكل دور لدى المزوّد المضبوط في البيئة (AI_*)
+    fixed, ud = [], {}
+    for r in rows:
+        for label, win in (("fixed", fixed[-20:]), ("budget", app.memory_window(ud))):
+            t0 = time.perf_counter()
+            try:
+                await app.ai_call(USER_MSG, win, False)
+            except Exception as e:
+                r[f"{label}_error"] = str(e)
+            r[f"{label}_latency_s"] = time.perf_counter() - t0
+        fixed += [{"role": "user", "content": USER_MSG}, {"role": "assistant", "content": REPLY}]
+        hist = ud.setdefault("ai_hist", [])
+        hist += [{"role": "user", "content": USER_MSG}, {"role": "assistant", "content": REPLY}]
+        if app.hist_tokens(hist) > app.AI_SUMMARY_TRIGGER:
+            del hist[:len(hist) - app.AI_KEEP_RECENT]
+            ud["ai_sum"] = SUMMARY
+    await app.ai_close()
+
+
+# ========== التخزين الدائم: زمن الكتابة المجمّعة والإقلاع مع 100k مستخدم ==========
+def sample_user_data(i: int) -> dict:
+    ud = {"ai_mode": "free", "ai_hist": [
+        {"role": "user", "content": USER_MSG}, {"role": "assistant", "content": REPLY[:600]},
+    ]}
+    if i % 3 == 0:
+        ud["tr"] = app.ThoughtRecord(situation="اجتماع العمل", emotion="قلق 7/10", auto="سأفشل", start=7)
+    if i % 5 == 0:
+        ud["expo"] = app.ExposureState(suds=6, plan="ركوب المصعد")
+    return ud
+
+
+def pct(xs: list, p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(p / 100 * len(xs)))] if xs else 0.0
+
+
+def bench_persist(args):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    n, batch = args.users, args.batch
+
+    async def fill():
+        p = app.SQLitePersistence(path)
+        p.loaded.update(range(n))
+        flush_ms = []
+        for start in range(0, n, batch):
+            for u in range(start, min(n, start + batch)):
+                await p.update_user_data(u, sample_user_data(u))
+                await p.update_conversation("main", (u, u), app.AI_CHAT)
+            t0 = time.perf_counter()
+            await p.flush()
+            flush_ms.append((time.perf_counter() - t0) * 1000)
+        return flush_ms
+
+    t0 = time.perf_counter()
+    flush_ms = asyncio.run(fill())
+    fill_s = time.perf_counter() - t0
+
+    async def startup():
+        t0 = time.perf_counter()
+        p = app.SQLitePersistence(path)
+        await p.get_user_data()
+        await p.get_conversations("main")
+        boot = time.perf_counter() - t0
+        lazy = []
+        for u in range(0, n, max(1, n // 2000)):
+            t1 = time.perf_counter()
+            await p.load_user(u)
+            lazy.append((time.perf_counter() - t1) * 1e6)
+        return boot, lazy
+
+    boot, lazy = asyncio.run(startup())
+    rows = [{
+        "users": n, "batch": batch, "db_mb": os.path.getsize(path) / 2**20, "fill_s": fill_s,
+        "flush_ms_p50": pct(flush_ms, 50), "flush_ms_p99": pct(flush_ms, 99),
+        "startup_ms": boot * 1000,
+        "lazy_load_us_p50": pct(lazy, 50), "lazy_load_us_p99": pct(lazy, 99),
+    }]
+    report("persist", rows, args.json)
+
+
+# ========== التوسّع عبر العمليات: إنتاجية 1..N عامل مع ترتيب لكل محادثة ==========
+MENU_SCRIPT = [
+    "/start", "العلاج السلوكي المعرفي (CBT) 💊", "ما هو CBT؟", "أخطاء التفكير", "طرق علاج القلق",
+    "◀️ رجوع", "الاختبارات النفسية 📝", "اضطرابات الشخصية 📚", "التحويل الطبي 🧑‍⚕️",
+]
+
+
+class Acker:
+    # يُضاف لكل عامل: يبلّغ العملية الأم بعد انتهاء كل تحديث
+    def __init__(self, q):
+        self.q = q
+
+    def __call__(self, application):
+        async def ack(update, context):
+            self.q.put(update.effective_chat.id)
+        application.add_handler(TypeHandler(Update, ack), group=10**6)
+
+
+def bench_shard(args):
+    import multiprocessing as mp
+    rows = []
+    chats = list(range(1, args.chats + 1))
+    updates = [(c, text_update(c, t)) for _ in range(args.rounds) for t in MENU_SCRIPT for c in chats]
+    app.TG_RATE_LIMIT = False   # يُقاس توزيع المعالجة على الأنوية، لا حد Bot API (نصيب كل عامل منه ثابت المجموع)
+    for n in range(1, args.workers + 1):
+        bus = app.LocalBus(n)
+        acks = mp.Queue()
+        procs = app.spawn_workers(bus, list(range(n)), n, request_factory=FakeTelegram, setup=Acker(acks))
+
+        async def drive():
+            for shard in range(n):             # إحماء: انتظر جاهزية كل العمال
+                await bus.put(shard, text_update(shard, "/ping"))
+            for _ in range(n):
+                await asyncio.to_thread(acks.get)
+            t0 = time.perf_counter()
+            for c, raw in updates:
+                await bus.put(c % n, raw)
+            for _ in updates:
+                await asyncio.to_thread(acks.get)
+            elapsed = time.perf_counter() - t0
+            for shard in range(n):
+                await bus.put(shard, None)
+            return elapsed
+
+        elapsed = asyncio.run(drive())
+        for pr in procs:
+            pr.join(timeout=10)
+        rows.append({"workers": n, "updates": len(updates), "seconds": elapsed,
+                     "updates_per_s": len(updates) / elapsed,
+                     "speedup": (rows[0]["seconds"] / elapsed) if rows else 1.0})
+    report("shard", rows, args.json)
+
+
+# ========== التصحيح: حلقة بايثون لكل صف مقابل مصفوفة NumPy ==========
+def bench_scoring(args):
+    import numpy as np
+    rows = []
+    rng = np.random.default_rng(0)
+    for sid, sc in app.SCORERS.items():
+        s = sc.s
+        m = rng.integers(s.min_v, s.max_v + 1, size=(args.rows, len(s.items)))
+        as_lists = m.tolist()
+        t0 = time.perf_counter()
+        for r in as_lists:
+            sc.score(r)
+        loop = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        sc.score_matrix(m)
+        vec = time.perf_counter() - t0
+        rows.append({"survey": sid, "rows": args.rows, "loop_s": loop, "vector_s": vec,
+                     "speedup": loop / vec if vec else float("inf")})
+    report("scoring", rows, args.json)
+
+
+# ========== طبقة العرض ==========
+def _render_session(prebuilt: bool):
+    # جلسة نموذجية: قائمة الاختبارات ← PHQ-9 كاملًا ← اضطرابات الشخصية ← نص CBT طويل
+    s = app.SURVEYS["phq9"]
+    if prebuilt:
+        out = [app.tests_psych_inline()]
+        out += [(app.question_text(s, i), app.scale_kb(s.min_v, s.max_v)) for i in range(len(s.items))]
+        out += [app.pd_inline_keyboard(), app.referral_keyboard(), app.KB_AI_START]
+        out += [app.PRE_SPLIT.get(t) or app.split_message(t) for t in app.CBT_TXT.values()]
+    else:
+        out = [app.build_tests_psych_kb()]
+        out += [(app.survey_prompt(s, i), app.build_scale_kb(s.min_v, s.max_v)) for i in range(len(s.items))]
+        out += [app.build_pd_keyboard(), app.build_referral_keyboard(), app.build_ai_start_kb()]
+        out += [app.split_message(t) for t in app.CBT_TXT.values()]
+    return out
+
+
+def bench_render(args):
+    import tracemalloc
+    rows = []
+    for label, pre in (("rebuild", False), ("prebuilt", True)):
+        _render_session(pre)
+        t0 = time.perf_counter()
+        for _ in range(args.sessions):
+            _render_session(pre)
+        dt = time.perf_counter() - t0
+        tracemalloc.start()
+        keep = [_render_session(pre) for _ in range(200)]
+        cur, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del keep
+        rows.append({"mode": label, "sessions": args.sessions, "us_per_session": dt / args.sessions * 1e6,
+                     "kb_per_session": cur / 200 / 1024})
+    report("render", rows, args.json)
+
+
+# ========== كاشف الأزمات ==========
+AR_LETTERS = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+
+
+def bench_crisis(args):
+    import random
+    rng = random.Random(7)
+    word = lambda: "".join(rng.choice(AR_LETTERS) for _ in range(rng.randint(3, 7)))
+    phrases = list(app.CRISIS_WORDS) + [f"{word()} {word()}" for _ in range(args.patterns)]
+    msgs = [" ".join(word() for _ in range(rng.randint(5, 40))) for _ in range(args.messages)]
+    msgs[::50] = [m + " ابي اموووت" for m in msgs[::50]]
+    t0 = time.perf_counter()
+    m = app.PhraseMatcher(phrases)
+    build = time.perf_counter() - t0
+    norm = [app.normalize_ar(p) for p in phrases]
+
+    def linear(t):
+        t = app.normalize_ar(t)
+        return next((p for p in norm if p in t), None)
+
+    rows = []
+    for label, fn in (("automaton", m.find), ("linear", linear)):
+        sample = msgs if label == "automaton" else msgs[:max(1, len(msgs) // 20)]
+        t0 = time.perf_counter()
+        hits = sum(fn(t) is not None for t in sample)
+        dt = time.perf_counter() - t0
+        rows.append({"matcher": label, "patterns": m.size, "messages": len(sample), "hits": hits,
+                     "us_per_msg": dt / len(sample) * 1e6, "build_ms": build * 1e3 if label == "automaton" else 0.0})
+    report("crisis", rows, args.json)
+
+
+# ========== إجابات محلية (BM25) ==========
+RETRIEVAL_QUERIES = [
+    "عندي قلق قبل النوم وما اقدر انام", "أشعر بالاكتئاب وفقدت المتعة", "كيف أتعامل مع الغضب",
+    "ما هي الشخصية النرجسية", "خوف من الهجر وتقلبات", "ما هو العلاج المعرفي السلوكي",
+    "نوبات هلع مفاجئة", "اشعر بالتوتر والضغط في العمل", "أخاف من الناس في المناسبات", "مرحبا كيفك",
+]
+
+
+def bench_retrieval(args):
+    import random
+    rng = random.Random(11)
+    word = lambda: "".join(rng.choice(AR_LETTERS) for _ in range(rng.randint(3, 7)))
+    base = app.local_docs()
+    queries = [rng.choice(RETRIEVAL_QUERIES) if i % 2 else " ".join(word() for _ in range(rng.randint(3, 25)))
+               for i in range(args.messages)]
+    rows = []
+    for scale in (1, 10, 100):
+        docs = base + [("cbt", " ".join(word() for _ in range(60)), "x") for _ in range(len(base) * (scale - 1))]
+        builds = []
+        for _ in range(5):
+            t0 = time.perf_counter()
+            kb = app.LocalKB(docs)
+            builds.append(time.perf_counter() - t0)
+        lat = []
+        for q in queries:
+            t0 = time.perf_counter()
+            kb.answer(q)
+            lat.append(time.perf_counter() - t0)
+        answered = sum(kb.answer(q) is not None for q in RETRIEVAL_QUERIES)   # أسئلة حقيقية فقط
+        rows.append({"docs": len(docs), "terms": len(kb.post), "build_ms": pct(builds, 50) * 1e3,
+                     "query_us_p50": pct(lat, 50) * 1e6, "query_us_p99": pct(lat, 99) * 1e6,
+                     "answered": f"{answered}/{len(RETRIEVAL_QUERIES)}"})
+    report("retrieval", rows, args.json)
+
+
+# ========== توجيه القوائم ==========
+def bench_routing(args):
+    import random
+    rng = random.Random(3)
+    word = lambda: "".join(rng.choice(AR_LETTERS) for _ in range(rng.randint(3, 7)))
+    base = [item for row in app.CBT_ROWS for item in row]
+    rows = []
+    for size in (len(base), 100, 1000):
+        items = base + [(f"{word()} {word()} {i}", f"r{i}") for i in range(size - len(base))]
+        idx = app.MenuIndex(items)
+        last, typed = items[-1][0], "اريد " + word()   # أسوأ حالة للسلسلة: آخر زر، ونص حر لا يطابق شيئًا
+
+        def chain(t):
+            for label, route in items:
+                if label in t:
+                    return route
+            return None
+
+        for label, fn in (("if-chain", chain), ("index", idx.lookup)):
+            t0 = time.perf_counter()
+            for _ in range(args.messages):
+                fn(last); fn(typed)
+            dt = time.perf_counter() - t0
+            rows.append({"router": label, "buttons": size, "us_per_lookup": dt / (2 * args.messages) * 1e6})
+    report("routing", rows, args.json)
+
+
+# ========== اختبار حِمل: مستخدمون متزامنون + خادم AI محلي ==========
+class StubAI:
+    # خادم OpenAI/OpenRouter وهمي (HTTP/1.1 مع keep-alive): زمن استجابة ونسبة أخطاء قابلة للضبط،
+    # وذيل اختياري (نسبة tail من الطلبات تستغرق tail_s ثانية)
+    def __init__(self, latency: float, error_rate: float, seed: int = 1, tail: float = 0.0, tail_s: float = 0.0):
+        import random
+        self.latency, self.error_rate = latency, error_rate
+        self.tail, self.tail_s = tail, tail_s
+        self.rng = random.Random(seed)
+        self.calls = self.errors = 0
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._conn, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/v1"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _head(status: str, ctype: str, length: int = None) -> bytes:
+        size = f"Content-Length: {length}" if length is not None else "Transfer-Encoding: chunked"
+        return f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\n{size}\r\n\r\n".encode()
+
+    async def _conn(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method = line.split(b" ", 1)[0]
+                length = 0
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.partition(b":")
+                    if k.strip().lower() == b"content-length":
+                        length = int(v)
+                body = await reader.readexactly(length) if length else b""
+                if method != b"POST":
+                    writer.write(self._head("200 OK", "text/plain", 0))
+                    await writer.drain()
+                    continue
+                self.calls += 1
+                slow = self.tail and self.rng.random() < self.tail
+                await asyncio.sleep(self.tail_s if slow else self.latency * self.rng.uniform(0.5, 1.5))
+                if self.rng.random() < self.error_rate:
+                    self.errors += 1
+                    err = b'{"error":{"message":"stub overloaded"}}'
+                    writer.write(self._head("503 Service Unavailable", "application/json", len(err)) + err)
+                    await writer.drain()
+                    continue
+                parts = ["هذه ", "خطوات ", "عملية ", "قصيرة ", "لتجربتها اليوم."]
+                if json.loads(body).get("stream"):
+                    writer.write(self._head("200 OK", "text/event-stream"))
+                    for piece in parts + [None]:
+                        data = ("data: [DONE]" if piece is None else
+                                "data: " + json.dumps({"choices": [{"delta": {"content": piece}}]})) + "\n\n"
+                        data = data.encode()
+                        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                        await writer.drain()
+                        await asyncio.sleep(0.01)
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    out = json.dumps({"choices": [{"message": {"content": "".join(parts)}}]}).encode()
+                    writer.write(self._head("200 OK", "application/json", len(out)) + out)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+# كل سيناريو: خطوات (نوع، قيمة) — "t" نص، "c" زر مضمّن، "ai" رسالة داخل جلسة AI (تنتظر اكتمال الرد)
+LOAD_SCRIPTS = {
+    "phq9": [("t", "/start"), ("t", "الاختبارات النفسية 📝"), ("c", "test:phq9")] + [("c", "s:{n03}")] * 9,
+    "thought_record": [("t", "/start"), ("t", "العلاج السلوكي المعرفي (CBT) 💊"), ("t", "سجلّ الأفكار (تمرين)"),
+                       ("t", "في الاجتماع صباحًا"), ("t", "قلق 7/10"), ("t", "سأفشل أمام الجميع"),
+                       ("t", "تلعثمت مرة"), ("t", "قدّمت عروضًا ناجحة قبل"), ("t", "قد أتوتر لكني مستعد"),
+                       ("t", "4")],
+    "ai_chat": [("t", "/start"), ("t", "عربي سايكو 🧠"), ("c", "start_ai"), ("ai", "أشعر بتوتر قبل النوم {n}"),
+                ("ai", "وماذا أفعل إذا استيقظت ليلًا؟ {n}"), ("ai", "شكرًا {n}"), ("t", "◀️ إنهاء جلسة عربي سايكو")],
+    "pd_browse": [("t", "/start"), ("t", "اضطرابات الشخصية 📚"), ("c", "pd:1"), ("c", "pd:4"), ("c", "pd:7"),
+                  ("c", "pd:back")],
+}
+
+
+def bench_hedge(args):
+    rows = []
+    for kind in ("chat", "stream"):
+        for hedged in (False, True):
+            rows.append(asyncio.run(_hedge(args, kind, hedged)))
+    report("hedge", rows, args.json, {"ai_latency_s": args.ai_latency, "tail": args.ai_tail,
+                                      "tail_s": args.ai_tail_s, "max_rate": app.AI_HEDGE_MAX_RATE})
+
+
+async def _hedge(args, kind: str, hedged: bool) -> dict:
+    # نفس تسلسل الطلبات (بذرة ثابتة) مع التحوّط وبدونه؛ الزمن = حتى أول نص مرئي (بث) أو الرد كاملًا
+    stub = StubAI(args.ai_latency, 0.0, tail=args.ai_tail, tail_s=args.ai_tail_s)
+    app.AI_BASE_URL, app.AI_API_KEY = await stub.start(), "stub"
+    app.AI_HEDGE = hedged
+    app.AI_SCHED = sched = app.AIScheduler()
+    sched.bucket = app.TokenBucket(1e6, 1e6)
+    sem = asyncio.Semaphore(args.chats)
+    lat = []
+
+    async def one(i: int):
+        async with sem:
+            t0 = time.perf_counter()
+            first = []
+
+            async def on_delta(d):
+                if not first:
+                    first.append(time.perf_counter())
+            if kind == "stream":
+                await app.ai_call_stream(f"سؤال {i}", [], False, on_delta)
+            else:
+                await app.ai_call(f"سؤال {i}", [], False)
+            lat.append((first[0] if first else time.perf_counter()) - t0)
+
+    await asyncio.gather(*(one(i) for i in range(args.messages)))
+    await app.ai_close()
+    await stub.stop()
+    return {"kind": kind, "hedge": "on" if hedged else "off", "requests": len(lat),
+            "p50_s": pct(lat, 50), "p95_s": pct(lat, 95), "p99_s": pct(lat, 99), "max_s": max(lat),
+            "extra_calls_pct": 100.0 * (stub.calls - len(lat)) / len(lat), "hedges_won": sched.hedge_wins}
+
+
+# ========== دمج رسائل AI أثناء طلب جارٍ (ChatFlight) ==========
+def bench_flight(args):
+    rows, ok = asyncio.run(_flight(args))
+    report("flight", rows, args.json)
+    if not ok:
+        raise SystemExit("flight: الرسائل أثناء طلب AI لم تُدمج أو لم يصل زر الإنهاء")
+
+
+async def _flight(args):
+    # كل محادثة: رسالة، ثم رسالتان أثناء انتظار AI ← طلبان فقط (الثاني مدموج)؛ ثم رسالة وزر إنهاء أثناء الطلب
+    stub = StubAI(max(args.ai_latency, 0.3), 0.0)
+    app.AI_BASE_URL, app.AI_API_KEY = await stub.start(), "stub"
+    app.AI_SCHED = app.AIScheduler()
+    app.AI_SCHED.bucket = app.TokenBucket(1e6, 1e6)
+    app.AI_DEBOUNCE_SEC, app.TG_RATE_LIMIT = 0.05, False
+    a = app.build_app(request=FakeTelegram(), updater=False)
+    await a.initialize()
+    await a.start()
+    chats = range(1, min(args.chats, 50) + 1)
+
+    async def put(u: dict):
+        await a.update_queue.put(Update.de_json(u, a.bot))
+
+    async def settle():
+        while app._FLIGHTS or a.update_queue.qsize() or a.update_processor.active:
+            await asyncio.sleep(0.05)
+
+    for c in chats:
+        await put(text_update(c, "/start"))
+        await put(callback_update(c, "start_ai"))
+    await asyncio.sleep(0.3)
+    t0 = time.perf_counter()
+    for c in chats:
+        await put(text_update(c, "أشعر بالقلق"))
+    await asyncio.sleep(0.1)
+    for c in chats:
+        await put(text_update(c, "خاصة في العمل"))
+        await put(text_update(c, "منذ شهر"))
+    await asyncio.sleep(0.2)
+    await settle()
+    burst = {"phase": "burst", "chats": len(chats), "messages": 3 * len(chats), "ai_calls": stub.calls,
+             "wall_s": time.perf_counter() - t0}
+    calls0, t0 = stub.calls, time.perf_counter()
+    for c in chats:
+        await put(text_update(c, "سؤال أخير"))
+    await asyncio.sleep(0.1)
+    for c in chats:
+        await put(text_update(c, "◀️ إنهاء جلسة عربي سايكو"))
+    await asyncio.sleep(0.2)
+    await settle()
+    states = a.bot_data["sessions"].states
+    in_menu = sum(states.get((c, c)) == app.MENU for c in chats)
+    leaked = sum(bool(a.user_data[c].get("ai_hist")) for c in chats)
+    exit_row = {"phase": "exit", "chats": len(chats), "messages": 2 * len(chats), "ai_calls": stub.calls - calls0,
+                "wall_s": time.perf_counter() - t0}
+    await a.stop()
+    await a.shutdown()
+    await app.ai_close()
+    await stub.stop()
+    ok = burst["ai_calls"] == 2 * len(chats) and in_menu == len(chats) and not leaked
+    exit_row["in_menu"] = burst["in_menu"] = in_menu
+    return [burst, exit_row], ok
+
+def rss_mb() -> Tuple[float, float]:
+    cur = peak = 0.0
+    with open("/proc/self/status") as f:
+        for ln in f:
+            if ln.startswith("VmRSS:"):
+                cur = int(ln.split()[1]) / 1024
+            elif ln.startswith("VmHWM:"):
+                peak = int(ln.split()[1]) / 1024
+    return cur, peak
+
+
+def bench_load(args):
+    asyncio.run(_load(args))
+
+
+async def _load(args):
+    import random
+    rng = random.Random(11)
+    stub = StubAI(args.ai_latency, args.ai_error)
+    app.AI_BASE_URL, app.AI_API_KEY = await stub.start(), "stub"
+    if args.ai_rps:
+        app.AI_SCHED.bucket = app.TokenBucket(args.ai_rps, max(app.AI_BURST, int(args.ai_rps)))
+
+    # انتظار اكتمال كل خطوة: التحديثات الحاجبة عبر معالج أخير، ورسالة AI عند إرسال الرد فعلًا
+    # (ai_chat_flow يعود فورًا ويجدول الطلب في ai_flight؛ هذا يغلّف ai_reply الذي يستدعيه)
+    waiters: Dict[int, Tuple[str, asyncio.Future]] = {}
+    ai_sent = ai_replied = 0
+
+    def done(kind: str, chat_id: int):
+        w = waiters.get(chat_id)
+        if w and w[0] == kind and not w[1].done():
+            w[1].set_result(time.perf_counter())
+
+    reply = app.ai_reply
+
+    async def timed_reply(message, text, context):
+        nonlocal ai_replied
+        await reply(message, text, context)
+        ai_replied += 1
+        done("ai", message.chat.id)
+
+    app.ai_reply = timed_reply
+    fake = FakeTelegram(args.tg_latency)
+    application = app.build_app(request=fake, updater=False)
+
+    async def ack(update, context):
+        done("sync", update.effective_chat.id)
+
+    errors = Counter()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+        if update is not None and update.effective_chat:
+            done("sync", update.effective_chat.id)
+
+    application.add_handler(TypeHandler(Update, ack), group=10**6)
+    application.add_error_handler(on_error)
+
+    lat: Dict[str, List[float]] = {}
+    lags: List[float] = []
+    timeouts = 0
+    running = True
+
+    async def monitor():
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - t0 - 0.01)
+
+    async def user(i: int):
+        nonlocal timeouts, ai_sent
+        chat = 10_000 + i
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        for _ in range(args.rounds):
+            name = rng.choice(sorted(LOAD_SCRIPTS))
+            for kind, value in LOAD_SCRIPTS[name]:
+                value = value.format(n=rng.randint(1, 10**6), n03=rng.randint(0, 3))
+                raw = callback_update(chat, value) if kind == "c" else text_update(chat, value)
+                fut = asyncio.get_running_loop().create_future()
+                waiters[chat] = ("ai" if kind == "ai" else "sync", fut)
+                ai_sent += kind == "ai"
+                t0 = time.perf_counter()
+                await application.update_queue.put(Update.de_json(raw, application.bot))
+                try:
+                    t1 = await asyncio.wait_for(fut, args.step_timeout)
+                    lat.setdefault("ai_turn" if kind == "ai" else f"{name}", []).append(t1 - t0)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+                if args.think:
+                    await asyncio.sleep(rng.uniform(0, 2 * args.think))
+        waiters.pop(chat, None)
+
+    async with application:
+        await app.on_startup(application)
+        await application.start()
+        mon = asyncio.create_task(monitor())
+        rss0 = rss_mb()[0]
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(args.vus)))
+        elapsed = time.perf_counter() - t0
+        running = False
+        await mon
+        rss, peak = rss_mb()
+        await application.stop()
+        await app.on_stop(application)
+    await app.on_shutdown(application)
+    await stub.stop()
+    app.ai_reply = reply
+
+    rows = []
+    everything = [x for xs in lat.values() for x in xs]
+    for step, xs in sorted(lat.items()) + [("all", everything)]:
+        xs.sort()
+        rows.append({"step": step, "n": len(xs), "p50_ms": pct(xs, 50) * 1e3, "p95_ms": pct(xs, 95) * 1e3,
+                     "p99_ms": pct(xs, 99) * 1e3, "max_ms": (xs[-1] if xs else 0.0) * 1e3})
+    lags.sort()
+    meta = {
+        "vus": args.vus, "rounds": args.rounds, "ai_latency_s": args.ai_latency, "ai_error_rate": args.ai_error,
+        "tg_latency_s": args.tg_latency, "ai_rps": app.AI_SCHED.bucket.rate,
+        "updates": len(everything), "seconds": elapsed, "updates_per_s": len(everything) / elapsed,
+        "loop_lag_p50_ms": pct(lags, 50) * 1e3, "loop_lag_p99_ms": pct(lags, 99) * 1e3,
+        "loop_lag_max_ms": (lags[-1] if lags else 0.0) * 1e3,
+        "rss_start_mb": rss0, "rss_end_mb": rss, "rss_peak_mb": peak,
+        "ai_calls": stub.calls, "ai_errors_injected": stub.errors, "bot_api_calls": sum(fake.calls.values()),
+        "ai_turns": ai_sent, "ai_replies": ai_replied, "timeouts": timeouts, "handler_errors": dict(errors),
+    }
+    report("load", rows, args.json, meta)
+    # كل رسالة AI وصلها رد، وكل رد من طلب فعلي للمزوّد (مع أخطاء مُحقنة: إعادات المحاولة تزيد الطلبات)
+    calls = stub.calls - stub.errors if args.ai_error else stub.calls
+    if ai_replied != ai_sent or (calls != ai_sent if not args.ai_error else calls > ai_sent):
+        raise SystemExit(f"load: {ai_sent} رسالة AI ← {ai_replied} رد و{stub.calls} طلب للمزوّد")
+
+
+# ========== كلفة القياس ==========
+def bench_metrics(args):
+    rows = []
+    script = ["/start", "الاختبارات النفسية 📝"]
+
+    async def run(on: bool) -> float:
+        app.METRICS_ON = on
+        application = app.build_app(request=FakeTelegram(), updater=False)
+        async with application:
+            ups = []
+            for c in range(1, args.chats + 1):
+                ups += [text_update(c, t) for t in script] + [callback_update(c, "test:phq9")]
+                ups += [callback_update(c, f"s:{c % 4}") for _ in range(9)]
+            ups = [Update.de_json(u, application.bot) for u in ups]
+            t0 = time.perf_counter()
+            for u in ups:
+                await application.process_update(u)
+            return (time.perf_counter() - t0) / len(ups)
+
+    best = {False: float("inf"), True: float("inf")}
+    for _ in range(args.rounds):   # بالتناوب، ويؤخذ الأفضل لتقليل الضجيج
+        for on in (False, True):
+            best[on] = min(best[on], asyncio.run(run(on)))
+    for on in (False, True):
+        rows.append({"metrics": "on" if on else "off", "us_per_update": best[on] * 1e6,
+                     "overhead_pct": (best[on] / best[False] - 1) * 100})
+    h = app.Metrics().histogram("x", "x", "state", "handler")
+    t0 = time.perf_counter()
+    for i in range(100_000):
+        h.observe(0.003, "menu", "top_router")
+    observe = (time.perf_counter() - t0) / 100_000
+    t0 = time.perf_counter()
+    body = app.METRICS.render()
+    render = time.perf_counter() - t0
+    report("metrics", rows, args.json, {"updates_per_run": args.chats * 12, "observe_ns": observe * 1e9,
+                                        "render_ms": render * 1e3, "render_lines": len(body.splitlines())})
+
+
+# ========== ذاكرة جلسات الاختبار ==========
+def _legacy_session(sid: str, answered: int) -> dict:
+    # الشكل السابق: نسخة كاملة من Survey (نصوص الأسئلة) + قائمة إجابات + s_i
+    s0 = app.SURVEYS[sid]
+    s = app.Survey(s0.id, s0.title, list(s0.items), s0.scale, s0.min_v, s0.max_v, list(s0.reverse))
+    return {"s": s, "s_i": answered, "ans": [s0.min_v + k % 2 for k in range(answered)]}
+
+
+def _compact_session(sid: str, answered: int) -> dict:
+    s0 = app.SURVEYS[sid]
+    return {"s": app.Progress(sid, answered, bytearray(s0.min_v + k % 2 for k in range(answered)))}
+
+
+def bench_session(args):
+    import tracemalloc
+    sids = [sid for sid in app.SURVEYS]
+    rows = []
+    for label, make in (("legacy", _legacy_session), ("compact", _compact_session)):
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        keep = [make(sids[i % len(sids)], i % 5) for i in range(args.users)]
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        packed = sum(len(app.pack_state(x)) for x in keep[:1000]) / min(1000, len(keep))
+        rows.append({"state": label, "sessions": args.users, "bytes_per_session": used / args.users,
+                     "total_mb": used / 2**20, "persisted_bytes": packed})
+        del keep
+    report("session", rows, args.json)
+
+
+# ========== دورة حياة الجلسات: ذاكرة المقيمين وكلفة الكنس وتأخر الحلقة ==========
+def bench_evict(args):
+    import tempfile, tracemalloc
+    rows = []
+    for persist in (False, True):
+        # تمريرة بـ tracemalloc للذاكرة، وأخرى بدونه للزمن وتأخر الحلقة
+        app.PERSIST, app.DB_PATH = persist, os.path.join(tempfile.mkdtemp(), "evict.db")
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        mem = asyncio.run(_evict_run(args, persist, lambda: tracemalloc.get_traced_memory()[0] - base))
+        tracemalloc.stop()
+        app.DB_PATH = os.path.join(tempfile.mkdtemp(), "evict.db")
+        row = asyncio.run(_evict_run(args, persist, None))
+        row["heap_mb_before"], row["heap_mb_after"] = mem["heap_mb_before"], mem["heap_mb_after"]
+        rows.append(row)
+    report("evict", rows, args.json)
+
+
+async def _evict_run(args, persist: bool, heap):
+    a = app.build_app(request=FakeTelegram(), updater=False)
+    await a.initialize()
+    s = a.bot_data["sessions"]
+    s.max_users, s.idle_sec, s.ttl = args.users // 10, 3600, {}
+    now, p = time.time(), a.persistence
+    for u in range(args.users):
+        # الأقدم أولًا: 80% خاملون أكثر من ساعة
+        a._user_data[u] = dict(sample_user_data(u), t=int(now - (args.users - u) * 7200 / args.users))
+        s.lru[u] = u
+        s.states[(u, u)] = app.AI_CHAT
+        if p:
+            p.loaded.add(u)
+    if p:   # الحالة المستقرة: الكتابات الدورية سبقت الكنس
+        a.mark_data_for_update_persistence(user_ids=range(args.users))
+        await a.update_persistence()
+        await p.flush()
+    before = heap() if heap else 0
+
+    lags: List[float] = []
+    running = True
+
+    async def monitor():
+        while running:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t0 - 0.001)
+
+    mon = asyncio.create_task(monitor())
+    await asyncio.sleep(0.01)
+    t0 = time.perf_counter()
+    n = await s.sweep()
+    sweep_s = time.perf_counter() - t0
+    running = False
+    await mon
+    if p:
+        await p.flush()
+    after = heap() if heap else 0
+    lags.sort()
+    row = {
+        "persist": persist, "users": args.users, "evicted": n, "resident": len(s.lru),
+        "heap_mb_before": before / 2**20, "heap_mb_after": after / 2**20,
+        "sweep_ms": sweep_s * 1000, "loop_lag_p99_ms": pct(lags, 99) * 1e3,
+        "loop_lag_max_ms": (lags[-1] if lags else 0.0) * 1e3,
+    }
+    await a.shutdown()
+    return row
+
+
+# ========== الإرسال المقيّد: دفقة رسائل أمام Bot API يطبّق حدود الإغراق ==========
+class FloodTelegram(FakeTelegram):
+    # يرد 429 (retry_after) عند تجاوز ~1/ث لكل محادثة (دفقة 3) أو 30/ث عمومًا، ويسجّل ترتيب التسليم
+    def __init__(self, chat_rps: float = 1.0, global_rps: float = 30.0):
+        super().__init__()
+        self.chat_rps, self.glob = chat_rps, app.TokenBucket(global_rps, global_rps)
+        self.buckets: Dict[int, object] = {}
+        self.delivered: Dict[int, List[str]] = {}
+        self.floods = 0
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        if url.endswith("/sendMessage"):
+            chat = int(params["chat_id"])
+            b = self.buckets.setdefault(chat, app.TokenBucket(self.chat_rps, 3))
+            wait = max(b.delay(), self.glob.delay())
+            if wait > 0:
+                self.floods += 1
+                body = {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                        "parameters": {"retry_after": max(1, round(wait))}}
+                return 429, json.dumps(body).encode()
+            b.tokens -= 1
+            self.glob.tokens -= 1
+            self.delivered.setdefault(chat, []).append(params["text"])
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+def bench_outbound(args):
+    rows = []
+    for limited in (False, True):
+        app.TG_RATE_LIMIT = limited
+        rows.append(asyncio.run(_outbound(args, limited)))
+    report("outbound", rows, args.json)
+
+
+async def _outbound(args, limited: bool):
+    fake = FloodTelegram()
+    a = app.build_app(request=fake, updater=False)
+    await a.initialize()
+    chats = max(1, min(args.chats, args.sends))
+    lat: List[float] = []
+
+    async def send(i: int):
+        t0 = time.perf_counter()
+        await a.bot.send_message(1000 + i % chats, str(i))
+        lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    res = await asyncio.gather(*(send(i) for i in range(args.sends)), return_exceptions=True)
+    wall = time.perf_counter() - t0
+    # الترتيب داخل كل محادثة يجب أن يطابق ترتيب الطلب
+    misordered = sum(1 for msgs in fake.delivered.values() if list(map(int, msgs)) != sorted(map(int, msgs)))
+    await a.shutdown()
+    return {
+        "limiter": limited, "sends": args.sends, "chats": chats,
+        "delivered": sum(map(len, fake.delivered.values())),
+        "dropped": sum(isinstance(r, Exception) for r in res), "flood_429": fake.floods,
+        "misordered_chats": misordered, "wall_s": wall,
+        "latency_p50_s": pct(lat, 50), "latency_p99_s": pct(lat, 99),
+    }
+
+
+# ========== سجل الدرجات: زمن الإضافة المجمّعة و/history لمستخدم بآلاف القياسات ==========
+def bench_history(args):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "history.db")
+    rows = [asyncio.run(_history(args, path))]
+    report("history", rows, args.json)
+
+
+async def _history(args, path: str):
+    h = app.ScoreHistory(path, flush_sec=0.05)
+    kinds = ("phq9", "gad7", "suds")
+    heavy, others = 1, max(1, args.users // 10)
+    t_ms = int(time.time() * 1000) - args.entries * 60_000
+    # خلفية: مستخدمون آخرون بعشرة قياسات لكل منهم
+    h._write_sync([(2 + u, kinds[i % 3], t_ms + i, i % 27) for u in range(others) for i in range(10)])
+    rec = []
+    for i in range(args.entries):
+        t0 = time.perf_counter()
+        h.record(heavy, kinds[i % 3], i % 27, ts=t_ms + i * 60_000)
+        rec.append((time.perf_counter() - t0) * 1e6)
+        if i % 1000 == 999:
+            await asyncio.sleep(0.06)    # دع الكتابة المجمّعة تجري كما في التشغيل
+    await h.flush()
+    q = []
+    for _ in range(200):
+        t0 = time.perf_counter()
+        txt = app.history_text(h, heavy)
+        q.append((time.perf_counter() - t0) * 1000)
+    await h.close()
+    total = others * 10 + args.entries
+    return {
+        "rows_total": total, "rows_user": args.entries, "record_us_p50": pct(rec, 50), "record_us_p99": pct(rec, 99),
+        "last_flush_ms": h.last_flush_ms, "history_ms_p50": pct(q, 50), "history_ms_p99": pct(q, 99),
+        "db_bytes_per_row": sum(os.path.getsize(f) for f in (path, path + "-wal") if os.path.exists(f)) / total,
+        "lines": txt.count("•"),
+    }
+
+
+
+# ========== التصدير المُجهَّل: إنتاجية وذاكرة عند 10M صف ==========
+def bench_export(args):
+    import tempfile, shutil
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "history.db")
+    h = app.ScoreHistory(path)
+    kinds = ("phq9", "gad7", "who5", "suds")
+    per_user = 50
+    t_ms = int(time.time() * 1000) - per_user * 86_400_000
+    t0 = time.perf_counter()
+    for start in range(0, args.export_rows, 500_000):
+        n = min(500_000, args.export_rows - start)
+        h._write_sync([(i // per_user, kinds[i % 4], t_ms + (i % per_user) * 86_400_000, i % 25)
+                       for i in range(start, start + n)])
+    fill_s = time.perf_counter() - t0
+    formats = [("csv",)]
+    try:
+        import pyarrow  # noqa: F401
+        formats.append(("parquet",))
+    except ImportError:
+        print("pyarrow غير مثبت: Parquet متخطّى", file=sys.stderr)
+    rows = []
+    for fmt in formats:
+        try:
+            with open("/proc/self/clear_refs", "w") as f:   # صفّر ذروة RSS (VmHWM)
+                f.write("5")
+        except OSError:
+            pass
+        rss0 = rss_mb()[0]
+        t0 = time.perf_counter()
+        n, files = app.run_export(path, os.path.join(tmp, "out"), fmt, key="bench")
+        dt = time.perf_counter() - t0
+        rows.append({
+            "format": fmt[0], "rows": n, "files": len(files), "seconds": dt, "rows_per_s": n / dt,
+            "mb_out": sum(os.path.getsize(f) for f in files) / 2**20,
+            "rss_start_mb": rss0, "rss_peak_mb": rss_mb()[1],
+        })
+        for f in files:
+            os.remove(f)
+    shutil.rmtree(tmp, ignore_errors=True)
+    report("export", rows, args.json, {"fill_s": fill_s})
+
+
+# ========== التذكيرات: إضافة/إلغاء عند مليون مؤقّت، إعادة التحميل بعد إعادة التشغيل، وسرعة الإرسال ==========
+def bench_remind(args):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "remind.db")
+    app.TG_RATE_LIMIT = False
+    report("remind", [asyncio.run(_remind(args, path))], args.json)
+
+
+async def _remind(args, path: str):
+    r = app.ReminderScheduler(path, flush_sec=3600)
+    now = time.time()
+    await r.refill(now)
+    n, span = args.timers, 14 * 86400
+    ins, can = [], []
+    for i in range(n):
+        due = now + 60 + (i * 7919 % n) / n * span   # ~0.4% منها داخل نافذة الساعة
+        t0 = time.perf_counter()
+        r.schedule(i, i, ("expo", "ba", "phq9", "gad7")[i % 4], due)
+        ins.append(time.perf_counter() - t0)
+    for i in range(0, n, 10):
+        t0 = time.perf_counter()
+        r.cancel(i, ("expo", "ba", "phq9", "gad7")[i % 4])
+        can.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    await r.flush()
+    flush_s = time.perf_counter() - t0
+    window = len(r.due)
+    # «إعادة تشغيل»: مجدول جديد على نفس الملف
+    lat = {"insert_us_p50": pct(ins, 50) * 1e6, "insert_us_p99": pct(ins, 99) * 1e6, "cancel_us_p50": pct(can, 50) * 1e6}
+    timers = n - len(can)
+    del r, ins, can
+    import gc
+    gc.collect()
+    rss0 = rss_mb()[0]
+    t0 = time.perf_counter()
+    r2 = app.ReminderScheduler(path, flush_sec=0.05)
+    await r2.refill(now)
+    reload_s = time.perf_counter() - t0
+    rss1, reloaded = rss_mb()[0], len(r2.due)
+    # إرسال: args.due تذكير مستحق الآن عبر Bot API وهمي (بلا محدِّد المعدل)
+    fake = FakeTelegram(args.tg_latency)
+    a = app.build_app(request=fake, updater=False)
+    await a.initialize()
+    for i in range(args.due):
+        r2.schedule(n + i, n + i, "expo", now - 1)
+    t0 = time.perf_counter()
+    r2.start(a.bot)
+    while r2.sent < args.due and time.perf_counter() - t0 < 120:
+        await asyncio.sleep(0.01)
+    send_s = time.perf_counter() - t0
+    await r2.stop()
+    await a.shutdown()
+    return {
+        "timers": timers, **lat, "flush_s": flush_s, "window": window,
+        "reload_ms": reload_s * 1000, "reload_window": reloaded, "reload_rss_mb": rss1 - rss0,
+        "db_mb": sum(os.path.getsize(f) for f in (path, path + "-wal") if os.path.exists(f)) / 1e6,
+        "dispatched": r2.sent, "dispatch_per_s": r2.sent / send_s,
+    }
+
+
+
+# ========== البث الإداري: الإنتاجية وزمن الردود التفاعلية أثناءه ==========
+def bench_broadcast(args):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "bot.db")
+    app.PERSIST, app.DB_PATH, app.TG_RATE_LIMIT = True, path, True
+    rows, meta = asyncio.run(_broadcast(args, path))
+    report("broadcast", rows, args.json, meta)
+
+
+async def _broadcast(args, path: str):
+    fake = FakeTelegram(args.tg_latency)
+    a = app.build_app(request=fake, updater=False)
+    a.persistence._write_sync({u: app.pack_state({}) for u in range(1, args.recipients + 1)}, {})
+    lim = a.bot.rate_limiter
+    lim.glob = app.TokenBucket(args.tg_rps, args.tg_rps)   # حد عام مُكبَّر ليقصر القياس؛ النسب هي المهمة
+    b = a.bot_data["broadcast"]
+    b.rps = args.tg_rps * 0.8
+    b.bucket = app.TokenBucket(b.rps, 1)
+    await a.initialize()
+
+    async def interactive(seconds: float) -> List[float]:
+        # ردود محادثات عادية بمعدل ثابت (~10% من الحد العام) على محادثات مختلفة
+        lat, tasks, i, end = [], [], 0, time.perf_counter() + seconds
+
+        async def one(chat: int):
+            t0 = time.perf_counter()
+            await a.bot.send_message(chat, "reply")
+            lat.append(time.perf_counter() - t0)
+        while time.perf_counter() < end:
+            i += 1
+            tasks.append(asyncio.ensure_future(one(10**9 + i)))
+            await asyncio.sleep(10 / args.tg_rps)
+        await asyncio.gather(*tasks)
+        return lat
+
+    rows = []
+    base = await interactive(args.rounds)
+    rows.append({"phase": "idle", "reply_ms_p50": pct(base, 50) * 1000, "reply_ms_p99": pct(base, 99) * 1000,
+                 "broadcast_per_s": 0.0})
+    t0 = time.perf_counter()
+    await b.create("📣 bench", 0, 0)
+    b.start(a)
+    while b.job is None:
+        await asyncio.sleep(0.01)
+    busy = await interactive(args.rounds)
+    eta = (args.recipients - sum(b.job[k] for k in ("sent", "blocked", "failed"))) / max(b.rate, 1e-9)
+    rows.append({"phase": "broadcast", "reply_ms_p50": pct(busy, 50) * 1000, "reply_ms_p99": pct(busy, 99) * 1000,
+                 "broadcast_per_s": b.rate})
+    elapsed = time.perf_counter() - t0
+    while b.job is not None:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - t0
+    await b.stop()
+    await a.shutdown()
+    return rows, {"recipients": args.recipients, "eta_predicted_s": elapsed + eta, "wall_s": wall}
+
+class FakeBotAPI:
+    # Bot API وهمي عبر HTTP لعملية app.py منفصلة (TG_API_URL): يسجّل وقت أول استدعاء لكل طريقة
+    def __init__(self):
+        self.first: Dict[str, float] = {}
+        self.got = asyncio.Event()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._conn, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _conn(self, reader, writer):
+        from urllib.parse import parse_qs
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                endpoint = line.split(b" ")[1].decode().rsplit("/", 1)[-1]
+                length = 0
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.partition(b":")
+                    if k.strip().lower() == b"content-length":
+                        length = int(v)
+                body = await reader.readexactly(length) if length else b""
+                self.first.setdefault(endpoint, time.perf_counter())
+                params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                if endpoint == "getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "Arabi", "username": "arabi_bot"}
+                elif endpoint == "getWebhookInfo":
+                    result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+                elif endpoint == "sendMessage":
+                    chat = int(params.get("chat_id", "0"))
+                    result = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat, "type": "private"},
+                              "text": params.get("text", "")}
+                    self.got.set()
+                else:
+                    result = True
+                out = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(StubAI._head("200 OK", "application/json", len(out)) + out)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _slow_server(delay: float) -> Tuple[object, str]:
+    # مزوّد AI بطيء المصافحة: يقيس أن التسخين لا يؤخر أول رد
+    async def conn(reader, writer):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            pass
+        writer.close()
+    server = await asyncio.start_server(conn, "127.0.0.1", 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1"
+
+
+def import_profile(top: int = 6) -> Tuple[float, List[dict]]:
+    # python -X importtime: الزمن التراكمي لـ app وأثقل استيراداته المباشرة
+    import subprocess
+    env = dict(os.environ)
+    env.pop("TELEGRAM_BOT_TOKEN", None)   # الاستيراد لا يحتاج التوكن
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stderr
+    total, kids = 0.0, []
+    for ln in err.splitlines():
+        if not ln.startswith("import time:") or "cumulative" in ln:
+            continue
+        _, cum, name = ln[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0 and name.strip() == "app":
+            total = int(cum) / 1000
+        elif depth == 1:
+            kids.append({"module": name.strip(), "ms": int(cum) / 1000})
+    return total, sorted(kids, key=lambda r: -r["ms"])[:top]
+
+
+def bench_startup(args):
+    total, kids = import_profile()
+    rounds = [asyncio.run(_first_hit(args)) for _ in range(args.rounds)]
+    rows = [{"round": i + 1, **r} for i, r in enumerate(rounds)]
+    meta = {"import_app_ms": total}
+    for k in kids:
+        meta[f"import_{k['module']}_ms"] = k["ms"]
+    for key in ("port_open_ms", "first_reply_ms"):
+        meta[f"{key}_p50"] = pct([r[key] for r in rounds], 50)
+    report("startup", rows, args.json, meta)
+
+
+async def _first_hit(args) -> dict:
+    # تشغيل بارد لـ app.py (webhook) ثم /start فور فتح المنفذ: زمن فتح المنفذ وزمن أول sendMessage
+    import socket, tempfile, subprocess, signal
+    tg = FakeBotAPI()
+    tg_url = await tg.start()
+    slow, ai_url = await _slow_server(args.warm_delay)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    token = "123:bench"
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN=token, PUBLIC_URL=f"http://127.0.0.1:{port}", PORT=str(port),
+               TG_API_URL=tg_url, AI_BASE_URL=ai_url, AI_API_KEY="x", PERSIST="1",
+               DB_PATH=os.path.join(tmp, "state.db"), HISTORY_DB=os.path.join(tmp, "history.db"), METRICS="1")
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                _, w = await asyncio.open_connection("127.0.0.1", port)
+                break
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("app.py خرج قبل فتح المنفذ")
+                await asyncio.sleep(0.005)
+        t_port = time.perf_counter()
+        body = json.dumps(text_update(42, "/start")).encode()
+        w.write(f"POST /{token} HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await w.drain()
+        await asyncio.wait_for(tg.got.wait(), 30)
+        t_reply = tg.first["sendMessage"]
+        w.close()
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        slow.close()
+        await tg.stop()
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {"port_open_ms": (t_port - t0) * 1000, "first_reply_ms": (t_reply - t0) * 1000,
+            "getme_ms": (tg.first.get("getMe", t_reply) - t0) * 1000}
+
+
+BENCHES = {
+    "memory": bench_memory,
+    "persist": bench_persist,
+    "shard": bench_shard,
+    "scoring": bench_scoring,
+    "render": bench_render,
+    "crisis": bench_crisis,
+    "routing": bench_routing,
+    "load": bench_load,
+    "metrics": bench_metrics,
+    "session": bench_session,
+    "evict": bench_evict,
+    "outbound": bench_outbound,
+    "history": bench_history,
+    "export": bench_export,
+    "startup": bench_startup,
+    "retrieval": bench_retrieval,
+    "hedge": bench_hedge,
+    "flight": bench_flight,
+    "remind": bench_remind,
+    "broadcast": bench_broadcast,
+}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Arabi Psycho benchmarks")
+    ap.add_argument("bench", choices=sorted(BENCHES))
+    ap.add_argument("--json", action="store_true", help="machine-readable output")
+    ap.add_argument("--turns", type=int, default=30)
+    ap.add_argument("--live", action="store_true", help="also call the configured AI provider")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--batch", type=int, default=500, help="dirty users per flush")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    ap.add_argument("--chats", type=int, default=200)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--rows", type=int, default=100_000, help="response rows for scoring")
+    ap.add_argument("--sessions", type=int, default=20_000, help="simulated UI sessions for render")
+    ap.add_argument("--patterns", type=int, default=5000, help="synthetic crisis phrases")
+    ap.add_argument("--messages", type=int, default=20_000)
+    ap.add_argument("--vus", type=int, default=300, help="concurrent virtual users for load")
+    ap.add_argument("--ramp", type=float, default=1.0, help="seconds over which users start")
+    ap.add_argument("--think", type=float, default=0.0, help="mean think time between steps")
+    ap.add_argument("--step-timeout", type=float, default=120.0)
+    ap.add_argument("--ai-latency", type=float, default=0.3, help="stub AI mean latency (s)")
+    ap.add_argument("--ai-error", type=float, default=0.02, help="stub AI error rate")
+    ap.add_argument("--ai-tail", type=float, default=0.03, help="share of stub AI calls that are slow (hedge)")
+    ap.add_argument("--ai-tail-s", type=float, default=8.0, help="latency of the slow stub AI calls (s)")
+    ap.add_argument("--ai-rps", type=float, default=0.0, help="override AI_RPS for the run (0 = as configured)")
+    ap.add_argument("--tg-latency", type=float, default=0.0, help="fake Bot API latency (s)")
+    ap.add_argument("--sends", type=int, default=300, help="messages in the outbound burst")
+    ap.add_argument("--entries", type=int, default=5000, help="history rows for one user")
+    ap.add_argument("--export-rows", type=int, default=10_000_000)
+    ap.add_argument("--timers", type=int, default=1_000_000, help="scheduled reminders for remind")
+    ap.add_argument("--due", type=int, default=5000, help="reminders due at once for remind dispatch")
+    ap.add_argument("--recipients", type=int, default=20_000, help="stored users for broadcast")
+    ap.add_argument("--tg-rps", type=float, default=1000.0, help="global Bot API limit for broadcast (scaled up)")
+    ap.add_argument("--warm-delay", type=float, default=3.0, help="stub AI handshake delay for startup (s)")
+    args = ap.parse_args()
+    BENCHES[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.py يقرأ الإعداد من البيئة عند الاستيراد: بلا توكن حقيقي وبلا تخزين دائم أو مقاييس
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:test")
+os.environ.setdefault("PERSIST", "0")
+os.environ.setdefault("METRICS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,137 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError
+
+import app as A
+
+
+class FakeBot:
+    # fail: uid -> أخطاء تُرفع بالترتيب ثم ينجح الإرسال؛ down: مستلمون يفشلون دائمًا بخطأ شبكة
+    def __init__(self, fail=None, down=()):
+        self.rate_limiter = None
+        self.fail, self.down = fail or {}, set(down)
+        self.tries: Counter = Counter()
+        self.got: Counter = Counter()
+
+    async def send_message(self, chat_id, text):
+        self.tries[chat_id] += 1
+        if chat_id in self.down:
+            raise NetworkError("down")
+        if self.fail.get(chat_id):
+            raise self.fail[chat_id].pop(0)
+        self.got[chat_id] += 1
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        pass
+
+
+def fake_app(bot):
+    dropped = []
+    return SimpleNamespace(bot=bot, bot_data={}, drop_user_data=dropped.append, dropped=dropped)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(A, "BROADCAST_LEASE_SEC", 0.4)      # إعادة المحاولة: 1ث ثم 0.1ث
+    monkeypatch.setattr(A, "BROADCAST_RETRIES", 3)
+    path = str(tmp_path / "b.db")
+
+    async def fill():
+        p = A.SQLitePersistence(path)
+        p.loaded.update(range(1, 11))
+        for u in range(1, 11):
+            await p.update_user_data(u, {"t": u})
+        await p.flush()
+        return p
+    return path, asyncio.run(fill())
+
+
+def row(b, job_id):
+    return b._sql("SELECT state, cursor, sent, blocked, failed FROM broadcasts WHERE id=?", (job_id,))[0]
+
+
+async def run_job(b, app):
+    job = await asyncio.to_thread(b._claim)
+    await b._run_job(app, job)
+    return job["id"]
+
+
+def test_recipients_cursor_pages_through_every_user(store):
+    _, p = store
+
+    async def main():
+        seen, cursor = [], ""
+        while True:
+            ids, cursor = await p.recipients(cursor, 3)
+            seen += ids
+            if not cursor:
+                return seen
+    assert asyncio.run(main()) == list(range(1, 11))
+
+
+def test_job_runs_to_done_and_prunes_blocked(store):
+    path, p = store
+    bot = FakeBot({3: [Forbidden("bot was blocked by the user")], 5: [BadRequest("Chat not found")],
+                   6: [BadRequest("message is too long")]})
+    app = fake_app(bot)
+
+    async def main():
+        b = A.Broadcaster(path, p, rps=10_000, batch=4)
+        job_id = await b.create("hi", 0, 0)
+        await run_job(b, app)
+        return b, job_id
+    b, job_id = asyncio.run(main())
+    assert row(b, job_id) == ("done", "", 7, 2, 1)
+    assert sorted(app.dropped) == [3, 5]
+    assert set(bot.got) == set(range(1, 11)) - {3, 5, 6}
+    assert max(bot.tries.values()) == 1
+
+
+def test_transient_errors_are_retried_before_the_cursor_moves(store):
+    path, p = store
+    bot = FakeBot({2: [NetworkError("reset"), NetworkError("reset")], 9: [NetworkError("timeout")]})
+
+    async def main():
+        b = A.Broadcaster(path, p, rps=10_000, batch=4)
+        job_id = await b.create("hi", 0, 0)
+        await run_job(b, fake_app(bot))
+        return b, job_id
+    b, job_id = asyncio.run(main())
+    assert row(b, job_id) == ("done", "", 10, 0, 0)
+    assert bot.got == Counter(range(1, 11))        # كلٌّ مرة واحدة
+    assert bot.tries[2] == 3 and bot.tries[9] == 2
+
+
+def test_stuck_recipient_is_failed_after_retry_cap(store):
+    path, p = store
+    bot = FakeBot(down={4})
+
+    async def main():
+        b = A.Broadcaster(path, p, rps=10_000, batch=4)
+        job_id = await b.create("hi", 0, 0)
+        await run_job(b, fake_app(bot))
+        return b, job_id
+    b, job_id = asyncio.run(main())
+    assert row(b, job_id) == ("done", "", 9, 0, 1)
+    assert bot.tries[4] == A.BROADCAST_RETRIES
+
+
+def test_resume_from_checkpoint_and_cancel(store):
+    path, p = store
+    bot = FakeBot()
+
+    async def main():
+        b = A.Broadcaster(path, p, rps=10_000, batch=4)
+        job_id = await b.create("hi", 0, 0)
+        b._sql("UPDATE broadcasts SET cursor='4', sent=4 WHERE id=?", (job_id,))   # نقطة حفظ بعد الدفعة الأولى
+        await run_job(b, fake_app(bot))
+        second = await b.create("again", 0, 0)
+        assert await b.cancel(second) == 1
+        assert await asyncio.to_thread(b._claim) is None
+        return b, job_id
+    b, job_id = asyncio.run(main())
+    assert row(b, job_id) == ("done", "", 10, 0, 0)
+    assert set(bot.got) == set(range(5, 11))
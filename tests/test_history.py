@@ -0,0 +1,81 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import app as A
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_series_is_oldest_first_and_includes_pending(tmp_path):
+    async def main():
+        h = A.ScoreHistory(str(tmp_path / "h.db"), flush_sec=60)
+        for i, v in enumerate([12, 9, 7]):
+            h.record(1, "phq9", v, ts=1000 + i)
+        h.record(2, "phq9", 20, ts=1000)
+        assert h.series(1, "phq9") == [(1000, 12), (1001, 9), (1002, 7)]   # قبل الكتابة
+        await h.flush()
+        h.record(1, "phq9", 5, ts=1003)
+        assert h.series(1, "phq9", n=2) == [(1002, 7), (1003, 5)]
+        assert h.summary(1, "phq9") == (4, (1000, 12))
+        assert h.summary(1, "gad7") == (0, None)
+        await h.close()
+        assert h.rows_written == 5
+    run(main())
+
+
+def test_same_millisecond_results_are_all_kept(tmp_path):
+    async def main():
+        h = A.ScoreHistory(str(tmp_path / "h.db"))
+        h.record(1, "gad7", 5, ts=42)
+        h.record(1, "gad7", 9, ts=42)
+        await h.flush()
+        assert h.summary(1, "gad7")[0] == 2
+        assert sorted(v for _, v in h.series(1, "gad7")) == [5, 9]
+        await h.close()
+    run(main())
+
+
+def test_failed_write_is_rebuffered(tmp_path, monkeypatch):
+    async def main():
+        h = A.ScoreHistory(str(tmp_path / "h.db"))
+        write = h._write_sync
+
+        def locked(rows):
+            raise sqlite3.OperationalError("database is locked")
+
+        monkeypatch.setattr(h, "_write_sync", locked)
+        h.record(1, "k10", 30, ts=1)
+        with pytest.raises(sqlite3.OperationalError):
+            await h.flush()
+        assert h.summary(1, "k10") == (1, (1, 30))      # ما زال معلّقًا ومرئيًا
+        h.record(1, "k10", 25, ts=2)
+        monkeypatch.setattr(h, "_write_sync", write)
+        await h.flush()
+        assert h.series(1, "k10") == [(1, 30), (2, 25)]
+        await h.close()
+    run(main())
+
+
+def test_old_without_rowid_table_is_migrated(tmp_path):
+    path = str(tmp_path / "h.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE history (user_id INTEGER, kind TEXT, ts INTEGER, value REAL,"
+               " PRIMARY KEY (user_id, kind, ts)) WITHOUT ROWID")
+    db.executemany("INSERT INTO history VALUES (?,?,?,?)", [(1, "phq9", 1000 + i, i) for i in range(5)])
+    db.commit()
+    db.close()
+
+    async def main():
+        h = A.ScoreHistory(path)
+        assert h.summary(1, "phq9") == (5, (1000, 0))
+        h.record(1, "phq9", 3, ts=1004)       # نفس ts لقياس موجود: يُضاف ولا يستبدله
+        await h.flush()
+        assert h.summary(1, "phq9")[0] == 6
+        await h.close()
+    run(main())
+    sql = sqlite3.connect(path).execute("SELECT sql FROM sqlite_master WHERE name='history'").fetchone()[0]
+    assert "WITHOUT ROWID" not in sql.upper()
@@ -0,0 +1,77 @@
+import pytest
+
+import app as A
+
+
+def answers(s: A.Survey, total: int) -> list:
+    # إجابات خام مجموعها total (قبل المضاعِف) لاستبيان بلا بنود عكسية
+    out = []
+    for _ in s.items:
+        v = max(s.min_v, min(s.max_v, total - sum(out)))
+        out.append(v)
+    assert sum(out) == total
+    return out
+
+
+@pytest.mark.parametrize("total, band", [(0, 0), (4, 0), (5, 1), (9, 1), (10, 2), (14, 2), (15, 3), (19, 3), (20, 4), (27, 4)])
+def test_phq9_band_edges_are_inclusive(total, band):
+    r = A.SCORERS["phq9"].score(answers(A.PHQ9, total))
+    assert r.total == total
+    assert r.band == A.PHQ9.bands[band][1]
+
+
+@pytest.mark.parametrize("total, band", [(4, 0), (5, 1), (9, 1), (10, 2), (15, 3), (21, 3)])
+def test_gad7_bands(total, band):
+    assert A.SCORERS["gad7"].score(answers(A.GAD7, total)).band == A.GAD7.bands[band][1]
+
+
+def test_phq9_self_harm_item_raises_alert():
+    sc = A.SCORERS["phq9"]
+    assert sc.score([0] * 9).alerts == []
+    r = sc.score([0] * 8 + [1])
+    assert r.alerts == [A.PHQ9.alerts[0][2]]
+    assert A.PHQ9.alerts[0][2] in r.text
+
+
+def test_who5_multiplier_and_max():
+    sc = A.SCORERS["who5"]
+    r = sc.score([5] * 5)
+    assert r.total == 100 and "100/100" in r.text
+    assert r.band == A.WHO5.bands[1][1]
+    assert sc.score([2, 3, 2, 3, 2]).band == A.WHO5.bands[0][1]   # 12×4 = 48 ≤ 50
+
+
+def test_tipi_reverse_items_and_subscales():
+    sc = A.SCORERS["tipi"]
+    assert sc.values([1] * 10) == [1, 7, 1, 1, 1, 7, 1, 7, 7, 7]
+    subs = sc.score([4] * 10).subscales
+    assert set(subs) == set(A.TIPI.subscales)
+    assert all(v == 4 and band == "متوسط" for v, band in subs.values())
+    r = sc.score([7, 1, 7, 7, 7, 1, 7, 1, 1, 1])     # الأعلى في كل سمة بعد عكس البنود العكسية
+    assert all(v == 7 and band == "عالٍ" for v, band in r.subscales.values())
+    assert sc.score([1, 7, 1, 1, 1, 7, 1, 7, 7, 7]).subscales["الانبساط"] == (1.0, "منخفض")
+
+
+@pytest.mark.parametrize("sid, yes, band", [("sapas", 2, 0), ("sapas", 3, 1), ("msi", 6, 0), ("msi", 7, 1),
+                                            ("pcptsd5", 2, 0), ("pcptsd5", 3, 1), ("panic", 1, 0), ("panic", 2, 1)])
+def test_yes_no_thresholds(sid, yes, band):
+    s = A.SURVEYS[sid]
+    ans = [1] * yes + [0] * (len(s.items) - yes)
+    assert A.SCORERS[sid].score(ans).band == s.bands[band][1]
+
+
+@pytest.mark.parametrize("sid", sorted(A.SURVEYS))
+def test_score_matrix_matches_score(sid):
+    np = pytest.importorskip("numpy")
+    s, sc = A.SURVEYS[sid], A.SCORERS[sid]
+    m = np.random.default_rng(7).integers(s.min_v, s.max_v + 1, size=(200, len(s.items)))
+    out = sc.score_matrix(m)
+    for i, row in enumerate(m.tolist()):
+        r = sc.score(row)
+        assert r.total == pytest.approx(out["total"][i])
+        if s.bands:
+            assert r.band == s.bands[out["band"][i]][1]
+        for name, (v, _) in r.subscales.items():
+            assert out[f"sub:{name}"][i] == pytest.approx(v)
+        for j, thr, _ in s.alerts:
+            assert bool(out[f"alert:{j}"][i]) == (row[j] >= thr)
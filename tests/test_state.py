@@ -0,0 +1,60 @@
+import asyncio
+
+import app as A
+
+
+def sample() -> dict:
+    return {
+        "s": A.Progress("phq9", 3, bytearray([0, 2, 3])),
+        "tr": A.ThoughtRecord("اجتماع", "قلق", start=7),
+        "expo": A.ExposureState(suds=60, plan="مصعد"),
+        "ai_hist": [{"role": "user", "content": "مرحبا"}],
+        "t": 1700000000,
+        "remind_off": True,
+    }
+
+
+def test_pack_state_round_trip():
+    data = sample()
+    out = A.unpack_state(A.pack_state(data))
+    assert out == data
+    assert isinstance(out["s"], A.Progress) and isinstance(out["s"].ans, bytearray)
+    assert out["s"].survey is A.PHQ9
+
+
+def test_pack_state_compresses_large_records_only():
+    small = A.pack_state({"t": 1})
+    big = A.pack_state({"ai_hist": [{"role": "user", "content": "نص طويل " * 40}] * 4})
+    assert small[:1] == b"j" and big[:1] == b"z"
+    assert A.unpack_state(big)["ai_hist"][3]["content"].startswith("نص طويل")
+
+
+def test_unknown_dataclass_tag_stays_a_dict():
+    assert A.unpack_state(b'j{"x":{"$":"Gone","v":[1]}}') == {"x": {"$": "Gone", "v": [1]}}
+
+
+def test_sqlite_persistence_lazy_load_and_eviction(tmp_path):
+    path = str(tmp_path / "s.db")
+
+    async def write():
+        p = A.SQLitePersistence(path)
+        p.loaded.update({1, 2})
+        await p.update_user_data(1, sample())
+        await p.update_user_data(2, {"t": 5})
+        await p.update_user_data(3, {"t": 9})       # لم يُحمَّل: لا يُكتب فوق سجله
+        await p.update_conversation("main", (1, 1), A.AI_CHAT)
+        p.forget(1)                                   # إخراج من الذاكرة
+        await p.drop_user_data(1)
+        await p.drop_user_data(2)                     # حذف حقيقي
+        await p.flush()
+
+    async def read():
+        p = A.SQLitePersistence(path)
+        assert await p.get_conversations("main") == {(1, 1): A.AI_CHAT}
+        assert await p.load_user(1) == sample()
+        assert await p.load_user(2) == {}
+        assert await p.load_user(3) == {}
+        assert p.loaded == {1, 2, 3}
+
+    asyncio.run(write())
+    asyncio.run(read())